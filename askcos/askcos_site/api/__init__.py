@@ -1 +1,3 @@
 from . import celery 
+from . import fast_filter
+from . import price
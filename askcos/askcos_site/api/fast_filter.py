@@ -0,0 +1,48 @@
+import json
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from askcos_site.askcos_celery.treebuilder.tb_c_worker import fast_filter_check_batch, MAX_FAST_FILTER_BATCH
+
+TIMEOUT = 60
+
+@csrf_exempt
+def fast_filter_batch(request):
+    '''Score many reactions with the fast filter in one task
+
+    Expects a POST with a JSON body {"reactions": [...]}, where each
+    reaction is either a "reactants>>product" SMILES string or a
+    [reactants, product] pair. Returns {"scores": [...]} in the same order.
+    '''
+    resp = {}
+    try:
+        reactions = json.loads(request.body.decode('utf-8'))['reactions']
+        if not isinstance(reactions, list):
+            raise TypeError
+    except (ValueError, KeyError, TypeError):
+        resp['error'] = 'Expected a JSON body with a "reactions" list'
+        return JsonResponse(resp, status=400)
+
+    pairs = []
+    for rxn in reactions:
+        if isinstance(rxn, str):
+            if '>>' not in rxn:
+                resp['error'] = 'Could not parse reaction SMILES {}'.format(rxn)
+                return JsonResponse(resp, status=400)
+            reactants, product = rxn.split('>>')[:2]
+        elif isinstance(rxn, list) and len(rxn) == 2 and all(isinstance(smi, str) for smi in rxn):
+            reactants, product = rxn
+        else:
+            resp['error'] = 'Expected a reaction SMILES string or a [reactants, product] pair, got {}'.format(json.dumps(rxn))
+            return JsonResponse(resp, status=400)
+        pairs.append([reactants, product])
+
+    if len(pairs) > MAX_FAST_FILTER_BATCH:
+        resp['error'] = 'At most {} reactions can be scored per request'.format(MAX_FAST_FILTER_BATCH)
+        return JsonResponse(resp, status=400)
+
+    if pairs:
+        res = fast_filter_check_batch.delay(pairs)
+        resp['scores'] = res.get(TIMEOUT)
+    else:
+        resp['scores'] = []
+    return JsonResponse(resp)
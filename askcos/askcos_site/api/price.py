@@ -0,0 +1,39 @@
+import json
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from askcos_site.main.globals import Pricer
+
+MAX_PRICE_BATCH = 10000
+
+@csrf_exempt
+def price_batch(request):
+    '''Price a list of SMILES in one request
+
+    Accepts a POST with a JSON body {"smiles": [...], "isomericSmiles": true}
+    or a GET with a comma-separated "smiles" parameter. Returns the price per
+    gram for each SMILES (0 = not buyable) in the same order.
+    '''
+    resp = {}
+    if request.method == 'POST':
+        try:
+            body = json.loads(request.body.decode('utf-8'))
+            smiles = body['smiles']
+            if not isinstance(smiles, list) or not all(isinstance(smi, str) for smi in smiles):
+                raise TypeError
+            isomericSmiles = body.get('isomericSmiles', True)
+            if not isinstance(isomericSmiles, bool):
+                raise TypeError
+        except (ValueError, KeyError, TypeError):
+            resp['error'] = 'Expected a JSON body with a "smiles" list of strings and an optional "isomericSmiles" boolean'
+            return JsonResponse(resp, status=400)
+    else:
+        smiles = [smi for smi in request.GET.get('smiles', '').split(',') if smi]
+        isomericSmiles = request.GET.get('isomericSmiles', 'true').lower() in ('true', '1')
+
+    if len(smiles) > MAX_PRICE_BATCH:
+        resp['error'] = 'At most {} SMILES can be priced per request'.format(MAX_PRICE_BATCH)
+        return JsonResponse(resp, status=400)
+
+    ppgs = Pricer.lookup_many(smiles, alreadyCanonical=False, isomericSmiles=isomericSmiles)
+    resp['results'] = [{'smiles': smi, 'ppg': ppg, 'buyable': ppg != 0.} for (smi, ppg) in zip(smiles, ppgs)]
+    return JsonResponse(resp)
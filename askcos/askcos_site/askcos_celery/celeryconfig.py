@@ -31,6 +31,8 @@ worker_prefetch_multiplier = 1
 TASK_ROUTES = {
     'askcos_site.askcos_celery.treebuilder.tb_c_worker.get_top_precursors': {'queue': 'tb_c_worker'},
     'askcos_site.askcos_celery.treebuilder.tb_c_worker.fast_filter_check': {'queue': 'tb_c_worker'},
+    'askcos_site.askcos_celery.treebuilder.tb_c_worker.fast_filter_check_batch': {'queue': 'tb_c_worker'},
+    'askcos_site.askcos_celery.treebuilder.tb_c_worker.apply_templates_by_idx': {'queue': 'tb_c_worker'},
     'askcos_site.askcos_celery.treebuilder.tb_c_worker.apply_one_template_by_idx': {'queue': 'tb_c_worker'},
     'askcos_site.askcos_celery.treebuilder.tb_c_worker.reserve_worker_pool': {'queue': 'tb_c_worker_reservable'},
     'askcos_site.askcos_celery.treebuilder.tb_worker.get_top_precursors': {'queue': 'tb_worker'},
@@ -14,12 +14,18 @@ from celery.signals import celeryd_init
 from pymongo import MongoClient
 import makeit.global_config as gc
 from makeit.retrosynthetic.transformer import RetroTransformer
+from makeit.retrosynthetic.mcts.instrumentation import PhaseTimer
+import time
 from rdkit import RDLogger
 lg = RDLogger.logger()
 lg.setLevel(RDLogger.CRITICAL)
 CORRESPONDING_QUEUE = 'tb_c_worker'
 CORRESPONDING_RESERVABLE_QUEUE = 'tb_c_worker_reservable'
 retroTransformer = None
+# Largest number of reactions scored by a single fast_filter_check_batch call
+MAX_FAST_FILTER_BATCH = 5000
+# Largest number of templates applied by a single apply_templates_by_idx call
+MAX_TEMPLATE_BATCH = 1000
 
 
 @celeryd_init.connect
@@ -71,6 +77,36 @@ def get_top_precursors(smiles, template_prioritizer, precursor_prioritizer, minc
 def apply_one_template_by_idx(*args, **kwargs):
     return retroTransformer.apply_one_template_by_idx(*args, **kwargs)
 
+@shared_task(bind=True)
+def apply_templates_by_idx(self, _id, smiles, template_idxs, chunk_size=None, **kwargs):
+    '''Apply a list of templates to one SMILES in a single task, returning
+    (_id, groups, phases) with one list of outcomes per template (see
+    RetroTransformer.apply_templates_by_idx) and the time spent in each
+    phase of the task (see PhaseTimer.as_dict).
+
+    If chunk_size is given, the groups finished since the previous update are
+    published every chunk_size templates as PROGRESS state meta
+    {'_id': _id, 'start': start, 'groups': groups}, where start is the index
+    of the first of them, so the caller can start on them before the whole
+    task is done. Each group is only sent once this way; the result still
+    holds all groups, for callers that missed an update.'''
+    if len(template_idxs) > MAX_TEMPLATE_BATCH:
+        raise ValueError('Template batch of {} templates exceeds the limit of {}'.format(
+            len(template_idxs), MAX_TEMPLATE_BATCH))
+    timer = PhaseTimer()
+    start = time.perf_counter()
+    groups = []
+    published = 0 # groups sent in PROGRESS updates so far
+    for all_outcomes in retroTransformer.iter_templates_by_idx(_id, smiles, template_idxs, chunk_size=chunk_size, stats=timer, **kwargs):
+        groups.append(all_outcomes)
+        if chunk_size and len(groups) % chunk_size == 0 and len(groups) < len(template_idxs):
+            progress = time.perf_counter()
+            self.update_state(state='PROGRESS', meta={'_id': _id, 'start': published, 'groups': groups[published:]})
+            published = len(groups)
+            timer.add('result_transfer', progress)
+    timer.add('expansion', start)
+    return (_id, groups, timer.as_dict())
+
 @shared_task
 def fast_filter_check(*args, **kwargs):
     '''Wrapper for fast filter check, since these workers will 
@@ -78,6 +114,17 @@ def fast_filter_check(*args, **kwargs):
     print('got request for fast filter')
     return retroTransformer.fast_filter.evaluate(*args, **kwargs)
 
+@shared_task
+def fast_filter_check_batch(reactions):
+    '''Score a list of [reactant_smiles, product_smiles] pairs with the
+    fast filter in one forward pass. Returns scores in the same order
+    (None where the SMILES could not be parsed)'''
+    if len(reactions) > MAX_FAST_FILTER_BATCH:
+        raise ValueError('Fast filter batch of {} reactions exceeds the limit of {}'.format(
+            len(reactions), MAX_FAST_FILTER_BATCH))
+    print('got request for fast filter batch of {} reactions'.format(len(reactions)))
+    return retroTransformer.fast_filter.score_batch(reactions)
+
 
 @shared_task(bind=True)
 def reserve_worker_pool(self):
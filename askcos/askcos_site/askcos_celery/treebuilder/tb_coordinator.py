@@ -22,7 +22,7 @@ import time
 from askcos_site.askcos_celery.treebuilder.tb_worker import get_top_precursors, reserve_worker_pool, unreserve_worker_pool
 from rdkit import RDLogger
 import makeit.global_config as gc
-from makeit.utilities.buyable.pricer import Pricer
+from makeit.utilities.registry import get_shared_pricer
 from makeit.retrosynthetic.tree_builder import TreeBuilder
 from makeit.synthetic.evaluation.evaluator import Evaluator
 lg = RDLogger.logger()
@@ -46,8 +46,7 @@ def configure_coordinator(options={}, **kwargs):
 
     # Prices
     print('Loading prices...')
-    pricer = Pricer()
-    pricer.load()
+    pricer = get_shared_pricer()
     print('Loaded known prices')
     treeBuilder = TreeBuilder(celery=True, pricer=pricer)
 
@@ -50,3 +50,36 @@ def get_buyable_paths(*args, **kwargs):
     result = treeBuilder.get_buyable_paths(*args, **kwargs)
     print('Task completed, returning results.')
     return result
+
+
+@shared_task(bind=True)
+def get_buyable_paths_batch(self, targets, **kwargs):
+    '''Searches a list of targets, several at a time (concurrent_targets),
+    over this coordinator's workers (see MCTS.get_buyable_paths_batch). Each
+    target's (smiles, result) pair is published as it finishes as PROGRESS
+    state meta {'start': start, 'results': [(smiles, result)]}, where start is
+    the number of targets finished before it; the task result holds all of
+    them in the order they finished'''
+    print('Treebuilder MCTS coordinator was asked to expand a batch of {} targets'.format(len(targets)))
+    results = []
+    for (smiles, result) in treeBuilder.get_buyable_paths_batch(targets, **kwargs):
+        self.update_state(state='PROGRESS', meta={'start': len(results), 'results': [(smiles, result)]})
+        results.append((smiles, result))
+    print('Task completed, returning results.')
+    return results
+
+
+@shared_task()
+def resume_buyable_paths(checkpoint_path, **kwargs):
+    print('Treebuilder MCTS coordinator was asked to resume {}'.format(checkpoint_path))
+    result = treeBuilder.resume(checkpoint_path, **kwargs)
+    print('Task completed, returning results.')
+    return result
+
+
+@shared_task()
+def get_routes_from_checkpoint(checkpoint_path):
+    print('Treebuilder MCTS coordinator was asked for the routes in {}'.format(checkpoint_path))
+    result = treeBuilder.routes_from_checkpoint(checkpoint_path)
+    print('Task completed, returning results.')
+    return result
@@ -69,9 +69,8 @@ CHEMICAL_DB_OLD = db[settings.CHEMICALS_OLD['collection']]
 
 ### Prices
 print('Loading prices...')
-import makeit.utilities.buyable.pricer as pricer
-Pricer = pricer.Pricer()
-Pricer.load()
+from makeit.utilities.registry import get_shared_pricer
+Pricer = get_shared_pricer(lazy=True) # web views price a few SMILES per request
 print('Loaded known prices')
 
 TransformerOnlyKnown = None 
@@ -112,4 +112,6 @@ urlpatterns += [
     # Celery status
     url(r'^status/$', views.status),
     url(r'^api/celery/$', api.celery.celery_status, name='celery_api'),
+    url(r'^api/fast_filter/batch/$', api.fast_filter.fast_filter_batch, name='fast_filter_batch_api'),
+    url(r'^api/price/$', api.price.price_batch, name='price_batch_api'),
 ]
@@ -80,6 +80,9 @@ local_db_dumps = os.path.join(data_path, 'local_db_dumps')
 fingerprint_bits = 256
 reaction_fingerprint_bits = 2048
 
+# Max number of parsed molecules / fingerprints kept by the shared featurizer
+featurization_cache_size = 100000
+
 historian_data = os.path.join(data_path, 'historian', 'chemicals.pickle')
 reactionhistorian_data = os.path.join(data_path, 'historian', 'reactions.pickle')
 retro_template_data = os.path.join(data_path,'retrosynthetic')
@@ -163,6 +166,12 @@ PREDICTOR = {
 # Fast filter evaluation
 FAST_FILTER_MODEL = {
     'trained_model_path': os.path.join(os.path.dirname(__file__), 'data', 'fast_filter','fast_filter_cleandata.h5'),
+    # numpy export of the same model, used instead of Keras when present
+    'numpy_model_path': os.path.join(os.path.dirname(__file__), 'data', 'fast_filter','fast_filter_cleandata.npz'),
+    # in-memory score cache size, and optional sqlite file to persist scores across runs
+    'score_cache_size': 500000,
+    'score_cache_path': os.environ.get('FAST_FILTER_SCORE_CACHE', None),
+    'score_cache_commit_rows': 10000, # new scores written to the sqlite tier per commit
 }
 
 # Hard coded mincounts to maintain compatibility of the relevance method (weights are numpy matrices)
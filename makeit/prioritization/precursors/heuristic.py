@@ -2,7 +2,7 @@ from makeit.prioritization.prioritizer import Prioritizer
 import rdkit.Chem as Chem
 from rdkit.Chem import AllChem
 import numpy as np
-from makeit.utilities.buyable.pricer import Pricer
+from makeit.utilities.registry import get_shared_pricer
 from makeit.utilities.io.logger import MyLogger
 heuristic_precursor_prioritizer_loc = 'heuristic_precursor_prioritizer'
 
@@ -43,6 +43,5 @@ class HeuristicPrecursorPrioritizer(Prioritizer):
         return np.sum(scores) - 4.00 * np.power(necessary_reagent_atoms, 2.0)
 
     def load_model(self):
-        self.pricer = Pricer()
-        self.pricer.load()
+        self.pricer = get_shared_pricer()
         self._loaded = True
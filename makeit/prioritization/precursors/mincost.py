@@ -3,11 +3,8 @@ import makeit.global_config as gc
 import rdkit.Chem as Chem
 from rdkit.Chem import AllChem
 import numpy as np
-from makeit.utilities.buyable.pricer import Pricer
+from makeit.utilities.registry import get_shared_pricer
 from makeit.utilities.io.logger import MyLogger
-from keras.models import Sequential
-from keras.layers import Dense, Lambda
-from keras import backend as K
 import math
 import sys
 import random
@@ -35,7 +32,11 @@ class MinCostPrecursorPrioritizer(Prioritizer):
         self._loaded = False
  
     def load_model(self, FP_len=1024, input_layer=6144, hidden_layer=512, modelpath=""):
-        
+        # Keras is only needed once this prioritizer is actually used
+        from keras.models import Sequential
+        from keras.layers import Dense, Lambda
+        from keras import backend as K
+
         self.FP_len = FP_len
 
         def last_layer(x):
@@ -58,11 +59,10 @@ class MinCostPrecursorPrioritizer(Prioritizer):
             if mol is None:
                 return np.zeros((self.FP_len,), dtype=np.float32)
             return np.array(AllChem.GetMorganFingerprintAsBitVect(mol, self.FP_rad, nBits=self.FP_len,
-                                                                  useChirality=True), dtype=np.bool)
+                                                                  useChirality=True), dtype=bool)
         self.mol_to_fp = mol_to_fp
 
-        self.pricer = Pricer()
-        self.pricer.load()
+        self.pricer = get_shared_pricer()
         self._restored = True
         self._loaded = True
 
@@ -2,7 +2,7 @@ from makeit.prioritization.prioritizer import Prioritizer
 import rdkit.Chem as Chem
 from rdkit.Chem import AllChem
 import numpy as np
-from makeit.utilities.buyable.pricer import Pricer
+from makeit.utilities.registry import get_shared_pricer
 from makeit.utilities.io.logger import MyLogger
 heuristic_precursor_prioritizer_loc = 'relevanceheuristic_precursor_prioritizer'
 
@@ -44,6 +44,5 @@ class RelevanceHeuristicPrecursorPrioritizer(Prioritizer):
         return sco / retroPrecursor.template_score
 
     def load_model(self):
-        self.pricer = Pricer()
-        self.pricer.load()
+        self.pricer = get_shared_pricer()
         self._loaded = True
@@ -3,8 +3,9 @@ import makeit.global_config as gc
 import rdkit.Chem as Chem
 from rdkit.Chem import AllChem
 import numpy as np
-from makeit.utilities.buyable.pricer import Pricer
+from makeit.utilities.registry import get_shared_pricer
 from makeit.utilities.io.logger import MyLogger
+from makeit.utilities.fingerprinting import smiles_to_morgan_fp
 import math
 import sys
 import os
@@ -28,6 +29,7 @@ class SCScorePrecursorPrioritizer(Prioritizer):
         self._restored = False
         self.pricer = None
         self._loaded = False
+        self.use_counts = False
 
     def load_model(self, FP_len=1024, model_tag='1024bool'):
         self.FP_len = FP_len
@@ -42,7 +44,8 @@ class SCScorePrecursorPrioritizer(Prioritizer):
             MyLogger.print_and_log('Loaded synthetic complexity score prioritization model from {}'.format(
             gc.SCScore_Prioritiaztion[filename]), scscore_prioritizer_loc)
 
-        if 'uint8' in gc.SCScore_Prioritiaztion[filename]:
+        self.use_counts = 'uint8' in gc.SCScore_Prioritiaztion[filename]
+        if self.use_counts:
             def mol_to_fp(mol):
                 if mol is None:
                     return np.array((self.FP_len,), dtype=np.uint8)
@@ -57,18 +60,23 @@ class SCScorePrecursorPrioritizer(Prioritizer):
                 if mol is None:
                     return np.zeros((self.FP_len,), dtype=np.float32)
                 return np.array(AllChem.GetMorganFingerprintAsBitVect(mol, self.FP_rad, nBits=self.FP_len,
-                                                                      useChirality=True), dtype=np.bool)
+                                                                      useChirality=True), dtype=bool)
         self.mol_to_fp = mol_to_fp
 
-        self.pricer = Pricer()
-        self.pricer.load()
+        self.pricer = get_shared_pricer()
         self._restored = True
         self._loaded = True
 
     def smi_to_fp(self, smi):
         if not smi:
             return np.zeros((self.FP_len,), dtype=np.float32)
-        return self.mol_to_fp(Chem.MolFromSmiles(str(smi)))
+        fp = smiles_to_morgan_fp(str(smi), radius=self.FP_rad, nBits=self.FP_len,
+            useChirality=True, counts=self.use_counts)
+        if fp is None:
+            return self.mol_to_fp(None)
+        if self.use_counts:
+            return fp
+        return fp.astype(bool)
 
     def apply(self, x):
         if not self._restored:
@@ -84,6 +92,21 @@ class SCScorePrecursorPrioritizer(Prioritizer):
         x = 1 + (self.score_scale - 1) * sigmoid(x)
         return x
 
+    def apply_batch(self, X):
+        '''Same as apply, for a matrix with one fingerprint per row, in one
+        forward pass'''
+        if not self._restored:
+            raise ValueError('Must restore model weights!')
+        for i in range(0, len(self.vars), 2):
+            last_layer = (i == (len(self.vars)-2))
+            W = self.vars[i]
+            b = self.vars[i+1]
+            X = np.dot(X, W) + b
+            if not last_layer:
+                X = X * (X > 0)  # ReLU
+        X = 1 + (self.score_scale - 1) * sigmoid_array(X)
+        return X
+
     def get_priority(self, retroProduct, **kwargs):
         mode = kwargs.get('mode', gc.max)
         if not self._loaded:
@@ -127,6 +150,19 @@ class SCScorePrecursorPrioritizer(Prioritizer):
             cur_score = self.apply(fp)
         return cur_score
 
+    def get_scores_from_smiles_list(self, smiles_list):
+        '''Scores of many SMILES strings in one forward pass, without checking
+        if they are buyable. As in get_score_from_smiles, chemicals without
+        any fingerprint bits score 0'''
+        if not self._loaded:
+            self.load_model()
+        if not smiles_list:
+            return np.zeros((0,), dtype=np.float32)
+        fps = np.array([self.smi_to_fp(smiles) for smiles in smiles_list], dtype=np.float32)
+        scores = self.apply_batch(fps).reshape((len(smiles_list),))
+        scores[fps.sum(axis=1) == 0] = 0.
+        return scores
+
 
 def sigmoid(x):
     if x < -10:
@@ -135,6 +171,10 @@ def sigmoid(x):
         return 1
     return 1. / (1 + math.exp(-x))
 
+def sigmoid_array(x):
+    '''Elementwise sigmoid, with the same cutoffs'''
+    return np.where(x < -10, 0., np.where(x > 10, 1., 1. / (1 + np.exp(-np.clip(x, -10, 10)))))
+
 if __name__ == '__main__':
     model = SCScorePrecursorPrioritizer()
     model.load_model(model_tag='1024bool')
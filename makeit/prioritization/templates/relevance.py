@@ -4,6 +4,7 @@ import rdkit.Chem as Chem
 from rdkit.Chem import AllChem
 import numpy as np
 from makeit.utilities.io.logger import MyLogger
+from makeit.utilities.fingerprinting import smiles_to_morgan_fp
 import math
 import sys
 import random
@@ -90,8 +91,8 @@ class RelevanceTemplatePrioritizer(Prioritizer):
 
 
         if use_tf:
-            def get_topk_from_mol(mol, k=100):
-                fp = self.mol_to_fp(mol).astype(np.float32).reshape((1, self.FP_len))
+            def get_topk_from_fp(fp, k=100):
+                fp = fp.astype(np.float32).reshape((1, self.FP_len))
                 cur_scores, = self.session.run([self.score], feed_dict={
                     self.input_mol: fp,
                 })
@@ -101,13 +102,17 @@ class RelevanceTemplatePrioritizer(Prioritizer):
                 return probs[-k:][::-1].tolist(), indices
 
         else:
-            def get_topk_from_mol(mol, k=100):
-                fp = self.mol_to_fp(mol).astype(np.float32)
+            def get_topk_from_fp(fp, k=100):
+                fp = fp.astype(np.float32)
                 cur_scores = self.apply(fp)
                 indices = cur_scores.argsort()[-k:][::-1].tolist()
                 cur_scores.sort()
                 probs = softmax(cur_scores)
                 return probs[-k:][::-1].tolist(), indices
+        self.get_topk_from_fp = get_topk_from_fp
+
+        def get_topk_from_mol(mol, k=100):
+            return self.get_topk_from_fp(self.mol_to_fp(mol), k=k)
         self.get_topk_from_mol = get_topk_from_mol
 
     def mol_to_fp(self, mol):
@@ -119,7 +124,10 @@ class RelevanceTemplatePrioritizer(Prioritizer):
     def smi_to_fp(self, smi):
         if not smi:
             return np.zeros((self.FP_len,), dtype=np.float32)
-        return self.mol_to_fp(Chem.MolFromSmiles(smi))
+        fp = smiles_to_morgan_fp(smi, radius=self.FP_rad, nBits=self.FP_len, useChirality=True)
+        if fp is None:
+            return np.zeros((self.FP_len,), dtype=np.float32)
+        return fp
 
     def get_priority(self, input_tuple, **kwargs):
         (templates, target) = input_tuple
@@ -153,10 +161,10 @@ class RelevanceTemplatePrioritizer(Prioritizer):
     def get_topk_from_smi(self, smi='', k=100):
         if not smi:
             return []
-        mol = Chem.MolFromSmiles(smi)
-        if not mol:
+        fp = smiles_to_morgan_fp(smi, radius=self.FP_rad, nBits=self.FP_len, useChirality=True)
+        if fp is None:
             return []
-        return self.get_topk_from_mol(mol, k=k)
+        return self.get_topk_from_fp(fp, k=k)
 
     def sigmoid(x):
         return 1 / (1 + math.exp(-x))
@@ -0,0 +1,187 @@
+'''
+Benchmark of the MCTS backup steps (MCTS.update and MCTS.full_update) on
+synthetic deep trees, against the recursive versions they replaced.
+
+Two graphs are built directly from nodes, without any chemistry:
+
+    chain   - chemical i is made from chemical i+1 and a buyable chemical, so
+              a selected pathway is as deep as the graph
+    ladder  - chemical i is made either from chemical i+1 and a buyable
+              chemical or from chemical i+1 alone, so the number of pathways
+              doubles with every level and the recursive full_update walks
+              each of them
+
+    python -m makeit.retrosynthetic.mcts.benchmark --depth 20 --chain_depth 5000
+'''
+
+import sys
+import time
+import argparse
+from makeit.retrosynthetic.mcts.nodes import Chemical, Reaction, ChemicalTemplateApplication
+from makeit.retrosynthetic.mcts.tree_builder import MCTS, VIRTUAL_LOSS
+
+
+def synthetic_tree(depth, alternatives=1):
+    '''MCTS holding a graph of depth + 2 chemicals: 0 ... depth, where depth is
+    buyable, and a buyable chemical depth + 1. Chemical i has one reaction per
+    template: template 0 gives (i+1, depth+1), template 1 (if alternatives > 1)
+    gives (i+1,). Returns the tree and the pathway selecting template 0 down
+    the whole chain.'''
+    tree = MCTS.__new__(MCTS)
+    tree.max_depth = depth + 1
+    tree.max_branching = 20
+    tree.dag = False
+    tree.dirty_chemicals = set()
+    tree.dirty_reactions = set()
+    buyable = depth + 1
+    tree.Chemicals = [Chemical('C{}'.format(i)) for i in range(depth + 2)]
+    for chem_id in (depth, buyable):
+        tree.Chemicals[chem_id].terminal = True
+        tree.Chemicals[chem_id].done = True
+        tree.Chemicals[chem_id].set_price(1.0)
+
+    pathway = {}
+    for chem_id in range(depth):
+        C = tree.Chemicals[chem_id]
+        C.virtual_loss = VIRTUAL_LOSS
+        C.prob = {}
+        for template_idx in range(alternatives):
+            reactant_ids = (chem_id + 1, buyable) if template_idx == 0 else (chem_id + 1,)
+            CTA = ChemicalTemplateApplication(chem_id, template_idx, rank=template_idx)
+            CTA.waiting = False
+            R = Reaction(chem_id, template_idx)
+            R.reactant_ids = reactant_ids
+            R.virtual_loss = VIRTUAL_LOSS
+            CTA.reactions[reactant_ids] = R
+            C.template_idx_results[template_idx] = CTA
+            for reactant_id in reactant_ids:
+                tree.Chemicals[reactant_id].parents.append(R)
+        pathway[chem_id] = (0, (chem_id + 1, buyable))
+    return (tree, pathway)
+
+
+def recursive_update(tree, chem_id, pathway, depth=0):
+    '''MCTS.update as it was before it used an explicit stack'''
+    if depth == 0:
+        for node_id in pathway:
+            (template_idx, reactants_key) = pathway[node_id]
+            C = tree.Chemicals[node_id]
+            C.virtual_loss -= VIRTUAL_LOSS
+            C.visit_count += 1
+            if reactants_key:
+                R = C.template_idx_results[template_idx].reactions[reactants_key]
+                R.virtual_loss -= VIRTUAL_LOSS
+                R.visit_count += 1
+
+    if (chem_id not in pathway) or (depth >= tree.max_depth):
+        return
+    (template_idx, reactants_key) = pathway[chem_id]
+    C = tree.Chemicals[chem_id]
+    CTA = C.template_idx_results[template_idx]
+    if CTA.waiting:
+        return
+
+    if reactants_key:
+        R = CTA.reactions[reactants_key]
+        if R.valid and (not R.done):
+            R.done = all([tree.Chemicals[reactant_id].done for reactant_id in R.reactant_ids])
+
+            for reactant_id in R.reactant_ids:
+                recursive_update(tree, reactant_id, pathway, depth+1)
+
+            estimate_price = sum([tree.Chemicals[reactant_id].estimate_price for reactant_id in R.reactant_ids])
+            R.update_estimate_price(estimate_price)
+            C.update_estimate_price(estimate_price)
+
+            if tree.dag:
+                for reactant_id in set(R.reactant_ids):
+                    if reactant_id in pathway:
+                        tree.propagate(reactant_id, skip=R)
+
+            price_list = [tree.Chemicals[reactant_id].price for reactant_id in R.reactant_ids]
+            if all([price != -1 for price in price_list]):
+                R.price = sum(price_list)
+                if R.price < C.price or C.price == -1:
+                    C.price = R.price
+
+    if sum(len(CTA.reactions) for tid,CTA in list(C.template_idx_results.items())) >= tree.max_branching:
+        C.done = all([(R.done or (not R.valid)) for rsmi,R in list(CTA.reactions.items()) for tid,CTA in list(C.template_idx_results.items())])
+
+
+def recursive_full_update(tree, chem_id, depth=0, path=[]):
+    '''MCTS.full_update as it was before it used an explicit stack'''
+    C = tree.Chemicals[chem_id]
+    C.pathway_count = 0
+    if C.terminal:
+        C.pathway_count = 1
+        return
+    if depth > tree.max_depth:
+        return
+
+    for template_idx in C.template_idx_results:
+        CTA = C.template_idx_results[template_idx]
+        for reactants_key in CTA.reactions:
+            R = CTA.reactions[reactants_key]
+            R.pathway_count = 0
+            if (not R.valid) or len(set(R.reactant_ids) & set(path)) > 0:
+                continue
+            for reactant_id in R.reactant_ids:
+                recursive_full_update(tree, reactant_id, depth+1, path+[chem_id])
+            price_list = [tree.Chemicals[reactant_id].price for reactant_id in R.reactant_ids]
+            if all([price != -1 for price in price_list]):
+                R.price = sum(price_list)
+                if R.price < C.price or C.price == -1:
+                    C.price = R.price
+                    C.best_template = template_idx
+                R.pathway_count = 1
+                for reactant_id in R.reactant_ids:
+                    R.pathway_count *= tree.Chemicals[reactant_id].pathway_count
+
+    C.pathway_count = 0
+    for CTA in C.template_idx_results.values():
+        for R in CTA.reactions.values():
+            C.pathway_count += R.pathway_count
+
+
+def timed(function, *args):
+    '''Seconds taken by function(*args), or the name of the exception it raised'''
+    start = time.perf_counter()
+    try:
+        function(*args)
+    except RecursionError:
+        return 'RecursionError'
+    return '{:.4f} s'.format(time.perf_counter() - start)
+
+
+def run(depth=20, chain_depth=5000):
+    print('Recursion limit: {}'.format(sys.getrecursionlimit()))
+
+    (tree, pathway) = synthetic_tree(chain_depth)
+    print('update, chain of depth {}'.format(chain_depth))
+    print('    recursive: {}'.format(timed(recursive_update, tree, 0, pathway)))
+    (tree, pathway) = synthetic_tree(chain_depth)
+    print('    iterative: {}'.format(timed(tree.update, 0, pathway)))
+
+    for d in range(depth // 2, depth + 1, max(depth // 4, 1)):
+        print('full_update, ladder of depth {} ({} pathways)'.format(d, 2 ** d))
+        (tree, pathway) = synthetic_tree(d, alternatives=2)
+        print('    recursive: {}'.format(timed(recursive_full_update, tree, 0)))
+        (tree, pathway) = synthetic_tree(d, alternatives=2)
+        print('    iterative: {}'.format(timed(tree.full_update, 0)))
+        assert tree.Chemicals[0].pathway_count == 2 ** d
+
+    (tree, pathway) = synthetic_tree(chain_depth, alternatives=2)
+    print('full_update, ladder of depth {}'.format(chain_depth))
+    print('    iterative: {}'.format(timed(tree.full_update, 0)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--depth', default=20, type=int,
+                        help='largest ladder depth to run the recursive full_update on')
+    parser.add_argument('-c', '--chain_depth', default=5000, type=int,
+                        help='depth of the chain used beyond the recursion limit')
+    args = parser.parse_args()
+
+    run(depth=args.depth, chain_depth=args.chain_depth)
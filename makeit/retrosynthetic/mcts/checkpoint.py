@@ -0,0 +1,122 @@
+'''
+Checkpoint files for long MCTS searches.
+
+A checkpoint is an append-only stream of pickled records in one local file.
+The first record holds the search settings and the target. Every later
+record is a delta written by the coordinator: the events since the previous
+record (template applications started, chemicals looked up, expansion
+outcomes received) and the statistics of the nodes that were added or
+touched since then, which the tree builder tracks as it updates them. Since
+the graph is rebuilt by replaying the events through the same code that
+built it, the file only grows by what is new, and a write only visits the
+nodes that changed, so writing a checkpoint stays cheap no matter how large
+the search gets.
+
+A record torn by a crash mid-write is ignored when reading, which leaves
+the state of the previous checkpoint.
+'''
+
+import os
+import numpy as np
+import makeit.utilities.io.pickle as pickle
+from makeit.utilities.io.logger import MyLogger
+checkpoint_loc = 'mcts_checkpoint'
+
+# (field, dtype) of the statistics saved per node. Pathway counts are kept
+# as Python ints, since they can exceed the range of int64
+CHEMICAL_STATS = (('visit_count', np.int64), ('estimate_price', np.float64), ('estimate_price_sum', np.float64),
+                  ('estimate_price_cnt', np.int64), ('price', np.float64), ('done', bool),
+                  ('best_template', np.int64), ('pathway_count', object))
+REACTION_STATS = (('visit_count', np.int64), ('estimate_price', np.float64), ('estimate_price_sum', np.float64),
+                  ('estimate_price_cnt', np.int64), ('price', np.float64), ('done', bool),
+                  ('pathway_count', object))
+
+
+def dirty_rows(dirty, num_written, num_nodes):
+    '''Sorted rows to write: the dirty ones and the nodes added since the
+    last write'''
+    rows = np.fromiter(dirty, dtype=np.int64, count=len(dirty))
+    return np.union1d(rows, np.arange(num_written, num_nodes, dtype=np.int64))
+
+
+def stats_columns(nodes, fields, rows):
+    '''Statistics of the nodes at rows, as one array per field'''
+    return dict((field, np.array([getattr(nodes[i], field) for i in rows], dtype=dtype))
+                for (field, dtype) in fields)
+
+
+def apply_stats(nodes, fields, rows, columns):
+    for (field, _) in fields:
+        for (i, value) in zip(rows, columns[field]):
+            setattr(nodes[i], field, value.item() if isinstance(value, np.generic) else value)
+
+
+class CheckpointWriter(object):
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.num_chemicals = 0 # rows written so far
+        self.num_reactions = 0
+
+    def start(self, header):
+        '''Starts a new checkpoint file, replacing any old one'''
+        directory = os.path.dirname(self.file_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.file_path, 'wb') as file:
+            pickle.dump(header, file)
+        self.num_chemicals = 0
+        self.num_reactions = 0
+
+    def resume(self, num_chemicals, num_reactions):
+        '''Continues a checkpoint file that was just restored'''
+        self.num_chemicals = num_chemicals
+        self.num_reactions = num_reactions
+
+    def write(self, events, chemical_rows, chemical_stats, reaction_rows, reaction_stats, **extra):
+        '''Appends the events since the last write and the statistics (see
+        stats_columns) of the rows that changed since then, which include
+        every row added since then'''
+        record = {
+            'events': events,
+            'chemical_rows': chemical_rows,
+            'chemical_stats': chemical_stats,
+            'reaction_rows': reaction_rows,
+            'reaction_stats': reaction_stats,
+        }
+        record.update(extra)
+        with open(self.file_path, 'ab') as file:
+            pickle.dump(record, file)
+        if len(chemical_rows):
+            self.num_chemicals = max(self.num_chemicals, int(chemical_rows[-1]) + 1)
+        if len(reaction_rows):
+            self.num_reactions = max(self.num_reactions, int(reaction_rows[-1]) + 1)
+
+
+def final_stats(records, name, fields):
+    '''Latest value of every row of the chemical or reaction statistics
+    written in a sequence of delta records, as one array per field'''
+    size = max([int(record[name + '_rows'][-1]) + 1 for record in records if len(record[name + '_rows'])] + [0])
+    columns = dict((field, np.zeros((size,), dtype=dtype)) for (field, dtype) in fields)
+    for record in records:
+        rows = record[name + '_rows']
+        for (field, _) in fields:
+            columns[field][rows] = record[name + '_stats'][field]
+    return (size, columns)
+
+
+def read_checkpoint(file_path):
+    '''Returns the header and the list of delta records of a checkpoint'''
+    records = []
+    with open(file_path, 'rb') as file:
+        while True:
+            try:
+                records.append(pickle.load(file))
+            except EOFError:
+                break
+            except Exception as e:
+                MyLogger.print_and_log('Ignoring torn checkpoint record in {} ({})'.format(file_path, e), checkpoint_loc, level=1)
+                break
+    if not records:
+        raise ValueError('{} is not an MCTS checkpoint'.format(file_path))
+    return records[0], records[1:]
@@ -0,0 +1,68 @@
+'''
+Counters and timers for the phases of an MCTS search.
+
+The coordinator and every worker keep a PhaseTimer. Each phase (selection,
+template application, fast filter scoring, ...) accumulates the number of
+items it processed and the wall time it took, using two perf_counter calls
+per timed step, so the timers stay on all the time. The timers are combined
+with queue depth samples into a report dictionary (see MCTS.search_report)
+which only holds JSON types.
+'''
+
+import json
+import time
+
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.phases = {} # phase -> [count, seconds]
+
+    def add(self, phase, start, count=1):
+        '''Adds the time since start (a time.perf_counter() value) and count
+        items to phase. Returns the current time, so consecutive phases can
+        be timed as t = timer.add(phase, t)'''
+        now = time.perf_counter()
+        totals = self.phases.get(phase)
+        if totals is None:
+            self.phases[phase] = [count, now - start]
+        else:
+            totals[0] += count
+            totals[1] += now - start
+        return now
+
+    def merge(self, phases):
+        '''Adds the totals of another timer (as returned by as_dict)'''
+        for (phase, totals) in phases.items():
+            mine = self.phases.setdefault(phase, [0, 0.])
+            mine[0] += totals['count']
+            mine[1] += totals['seconds']
+
+    def as_dict(self):
+        return dict((phase, {'count': count, 'seconds': seconds})
+                    for (phase, (count, seconds)) in self.phases.items())
+
+
+def subtract_phases(after, before):
+    '''Totals of a timer between two of its as_dict snapshots'''
+    phases = {}
+    for (phase, totals) in after.items():
+        old = before.get(phase, {'count': 0, 'seconds': 0.})
+        if totals['count'] != old['count'] or totals['seconds'] != old['seconds']:
+            phases[phase] = {'count': totals['count'] - old['count'],
+                             'seconds': totals['seconds'] - old['seconds']}
+    return phases
+
+
+def summarize_samples(samples, field):
+    '''Mean and maximum of one field of the queue depth samples'''
+    values = [sample[field] for sample in samples if sample[field] is not None]
+    if not values:
+        return None
+    return {'mean': sum(values) / float(len(values)), 'max': max(values)}
+
+
+def export_report(report, file_path):
+    '''Writes a search report as JSON'''
+    with open(file_path, 'w') as file:
+        json.dump(report, file, indent=2, sort_keys=True)
@@ -1,6 +1,121 @@
+import numpy as np
+
+# Nodes use __slots__ instead of a per-instance __dict__, since a search
+# creates a very large number of them. They refer to each other by the
+# integer IDs the tree builder interns SMILES to, not by SMILES strings.
+
+
+class ChildStats(object):
+    '''Statistics of the reactions of every chemical in one tree, kept in
+    contiguous arrays shared by all of them so that UCB can score all
+    children of a chemical at once. A chemical owns no arrays, only the list
+    of its child rows (Chemical.children), so sparse nodes stay small.
+
+    Reaction rows hold the visit count, virtual loss, estimated price, done
+    flag and reactant IDs (padded with -1) of each distinct Reaction. The
+    virtual loss of the pathways in flight is kept apart from the visits and
+    only added to them when UCB scores the children. Child rows are
+    what UCB iterates over: one per (template application, reaction) pair,
+    so a reaction found by two templates is two children sharing one
+    reaction row. Each child records its reaction row, the template it came
+    from, whether that template application is still valid and the rank of
+    the template application, which reproduces the iteration order of
+    Chemical.template_idx_results for tie-breaking.
+    '''
+
+    __slots__ = ('num_rxns', 'rxn_visits', 'rxn_virtual_loss', 'rxn_estimate', 'rxn_done', 'rxn_reactants',
+                 'num_children', 'child_rxn', 'child_rank', 'child_valid', 'child_keys',
+                 'child_probs', 'scaled_probs', 'scaled_c')
+
+    def __init__(self, capacity=1024):
+        self.num_rxns = 0
+        self.rxn_visits = np.zeros((capacity,), dtype=np.int64)
+        self.rxn_virtual_loss = np.zeros((capacity,), dtype=np.int64)
+        self.rxn_estimate = np.zeros((capacity,), dtype=np.float64)
+        self.rxn_done = np.zeros((capacity,), dtype=bool)
+        self.rxn_reactants = -np.ones((capacity, 2), dtype=np.int64)
+
+        self.num_children = 0
+        self.child_rxn = np.zeros((capacity,), dtype=np.int64)
+        self.child_rank = np.zeros((capacity,), dtype=np.int64)
+        self.child_valid = np.zeros((capacity,), dtype=bool)
+        self.child_keys = [] # (template_idx, reactant IDs) of each child
+        self.child_probs = [] # template relevance of each child, as given
+
+        # c_exploration * prob per child, cached for the last c_exploration
+        self.scaled_probs = np.zeros((0,), dtype=np.float64)
+        self.scaled_c = None
+
+    @staticmethod
+    def _grow(array, size):
+        if size <= len(array):
+            return array
+        grown = np.zeros((max(size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+        if array.ndim == 2:
+            grown[:] = -1
+        grown[:len(array)] = array
+        return grown
+
+    def add_reaction(self, reactant_ids, visit_count, virtual_loss, estimate_price, done):
+        i = self.num_rxns
+        self.num_rxns += 1
+        self.rxn_visits = self._grow(self.rxn_visits, self.num_rxns)
+        self.rxn_virtual_loss = self._grow(self.rxn_virtual_loss, self.num_rxns)
+        self.rxn_estimate = self._grow(self.rxn_estimate, self.num_rxns)
+        self.rxn_done = self._grow(self.rxn_done, self.num_rxns)
+        self.rxn_reactants = self._grow(self.rxn_reactants, self.num_rxns)
+        if len(reactant_ids) > self.rxn_reactants.shape[1]:
+            wider = -np.ones((len(self.rxn_reactants), len(reactant_ids)), dtype=np.int64)
+            wider[:, :self.rxn_reactants.shape[1]] = self.rxn_reactants
+            self.rxn_reactants = wider
+        self.rxn_visits[i] = visit_count
+        self.rxn_virtual_loss[i] = virtual_loss
+        self.rxn_estimate[i] = estimate_price
+        self.rxn_done[i] = done
+        self.rxn_reactants[i, :len(reactant_ids)] = reactant_ids
+        return i
+
+    def add_child(self, rank, template_idx, reactants_key, rxn_index, prob):
+        '''Adds a child row and returns its index'''
+        i = self.num_children
+        self.num_children += 1
+        self.child_rxn = self._grow(self.child_rxn, self.num_children)
+        self.child_rank = self._grow(self.child_rank, self.num_children)
+        self.child_valid = self._grow(self.child_valid, self.num_children)
+        self.child_rxn[i] = rxn_index
+        self.child_rank[i] = rank
+        self.child_valid[i] = True
+        self.child_keys.append((template_idx, reactants_key))
+        self.child_probs.append(prob)
+        return i
+
+    def invalidate(self, rows, rank):
+        '''Marks the children among rows that came from template application
+        rank as invalid'''
+        rows = np.array(rows, dtype=np.int64)
+        self.child_valid[rows[self.child_rank[rows] == rank]] = False
+
+    def get_scaled_probs(self, c_exploration):
+        '''c_exploration * prob for every child, each product computed like
+        the scalar expression it replaces'''
+        if self.scaled_c != c_exploration:
+            self.scaled_probs = np.zeros((0,), dtype=np.float64)
+            self.scaled_c = c_exploration
+        done = len(self.scaled_probs)
+        if done < self.num_children:
+            new = np.array([c_exploration * prob for prob in self.child_probs[done:]], dtype=np.float64)
+            self.scaled_probs = np.concatenate((self.scaled_probs, new))
+        return self.scaled_probs
+
+
 class Chemical(object):
     """Represents a chemical compound."""
 
+    __slots__ = ('smiles', 'template_idx_results', 'purchase_price', 'as_reactant', 'as_product',
+                 'visit_count', 'virtual_loss', 'terminal', 'estimate_price', 'estimate_price_sum', 'estimate_price_cnt',
+                 'best_template', 'prob', 'value', 'sorted_id', 'top_probs', 'top_indeces',
+                 'price', 'done', 'pathway_count', 'children', 'parents')
+
     def __init__(self, chem_smi):
         # Initialize lists for incoming and outgoing reactions.
         self.smiles = chem_smi
@@ -9,6 +124,7 @@ class Chemical(object):
         self.as_reactant = -1
         self.as_product = -1
         self.visit_count = 0
+        self.virtual_loss = 0 # of the pathways in flight through this chemical
         self.terminal = False 
 
         # Counter param used for the DFS search. 
@@ -21,12 +137,17 @@ class Chemical(object):
         self.prob = None
         self.value = None         # output of vaue network, not currently used
         self.sorted_id = None
+        self.top_probs = None
+        self.top_indeces = None
 
         self.price = -1           # valid min cost - means not buyable
         self.done = False
 
         self.pathway_count = 0
 
+        self.children = None # rows of the tree's ChildStats, created with the first reaction
+        self.parents = [] # Reactions using this chemical as a reactant
+
     def __repr__(self):
         return "%s(%r)" % (self.__class__, self.smiles)
 
@@ -58,6 +179,24 @@ class Chemical(object):
         self.estimate_price_cnt += 1
         self.estimate_price = self.estimate_price_sum / self.estimate_price_cnt
 
+    def add_reaction(self, R, stats):
+        '''Moves the statistics of a new Reaction producing this chemical into
+        the tree's ChildStats arrays; R keeps reading and writing them there'''
+        R.attach(stats)
+
+    def add_child(self, CTA, R, stats):
+        '''Records that template application CTA leads to reaction R'''
+        row = stats.add_child(CTA.rank, CTA.template_idx, tuple(R.reactant_ids), R.index,
+                              self.prob[CTA.template_idx])
+        if self.children is None:
+            self.children = []
+        self.children.append(row)
+
+    def invalidate(self, CTA, stats):
+        CTA.valid = False
+        if self.children is not None:
+            stats.invalidate(self.children, CTA.rank)
+
     def reset(self):
         return
 
@@ -66,27 +205,40 @@ class ChemicalTemplateApplication(object):
     a list-wrapper for the Reaction class because applying one template to one
     product can lead to many distinct product sets."""
 
-    def __init__(self, smiles, template_idx):
-        self.smiles = smiles.strip()
+    __slots__ = ('chem_id', 'template_idx', 'rank', 'waiting', 'valid', 'reactions')
+
+    def __init__(self, chem_id, template_idx, rank=0):
+        self.chem_id = chem_id
         self.template_idx = template_idx
+        self.rank = rank # creation order among the templates applied to this chemical
 
         self.waiting = True 
         self.valid = True
 
-        self.reactions = {} # key is reactant SMILES string, value is a Reaction
+        self.reactions = {} # key is tuple of reactant IDs, value is a Reaction
 
 
 class Reaction(object):
     """Represents a reaction."""
 
-    def __init__(self, smiles, template_idx):
+    __slots__ = ('chem_id', 'template_idx', 'valid', 'reactant_ids', 'stats', 'index',
+                 '_visit_count', '_virtual_loss', '_done', '_estimate_price',
+                 'estimate_price_sum', 'estimate_price_cnt', 'price', 'pathway_count',
+                 'filter_score', 'tforms', 'template_score', 'plausibility')
+
+    def __init__(self, chem_id, template_idx):
         """Initialize entry."""
-        self.smiles = smiles.strip()
+        self.chem_id = chem_id # product
         self.template_idx = template_idx
         # self.depth  = depth 
         self.valid = True
-        self.reactant_smiles = []
+        self.reactant_ids = []
+        # visit_count, virtual_loss, done and estimate_price live in the
+        # tree's ChildStats once the reaction is attached to it
+        self.stats = None
+        self.index = None
         self.visit_count = 0
+        self.virtual_loss = 0
 
         # self.waiting = True
         self.done = False
@@ -111,10 +263,64 @@ class Reaction(object):
         # note: no necessary_reagent or num_examples considered yet
 
     def __repr__(self):
-        return "%s(%r)" % (self.__class__, self.smiles)
+        return "%s(%r, %r)" % (self.__class__, self.chem_id, self.reactant_ids)
 
-    def __str__(self):
-        return "%s" % self.smiles
+    def attach(self, stats):
+        self.index = stats.add_reaction(self.reactant_ids, self._visit_count, self._virtual_loss,
+                                        self._estimate_price, self._done)
+        self.stats = stats
+
+    @property
+    def visit_count(self):
+        if self.stats is None:
+            return self._visit_count
+        return int(self.stats.rxn_visits[self.index])
+
+    @visit_count.setter
+    def visit_count(self, value):
+        if self.stats is None:
+            self._visit_count = value
+        else:
+            self.stats.rxn_visits[self.index] = value
+
+    @property
+    def virtual_loss(self):
+        if self.stats is None:
+            return self._virtual_loss
+        return int(self.stats.rxn_virtual_loss[self.index])
+
+    @virtual_loss.setter
+    def virtual_loss(self, value):
+        if self.stats is None:
+            self._virtual_loss = value
+        else:
+            self.stats.rxn_virtual_loss[self.index] = value
+
+    @property
+    def done(self):
+        if self.stats is None:
+            return self._done
+        return bool(self.stats.rxn_done[self.index])
+
+    @done.setter
+    def done(self, value):
+        if self.stats is None:
+            self._done = value
+        else:
+            self.stats.rxn_done[self.index] = value
+
+    @property
+    def estimate_price(self):
+        if self.stats is None:
+            return self._estimate_price
+        return float(self.stats.rxn_estimate[self.index])
+
+    @estimate_price.setter
+    def estimate_price(self, value):
+        if self.stats is None:
+            self._estimate_price = value
+        else:
+            self.stats.rxn_estimate[self.index] = value
 
     def update_estimate_price(self, value):
         self.estimate_price_sum += value
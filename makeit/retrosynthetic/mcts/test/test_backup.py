@@ -0,0 +1,274 @@
+'''
+The iterative MCTS.update and MCTS.full_update against the recursive
+versions they replaced (kept in benchmark.py), on a chain deeper than a
+search normally goes and on random graphs where intermediates are shared
+by several reactions, in tree and DAG mode.
+
+The recursive full_update read reactant pathway counts from whatever depth
+a reactant was last reached at, so the two only agree on pathway counts
+when the depth limit cuts no route; below the limit, counts are checked
+against a direct count of the routes instead. The same holds in cyclic
+graphs, where a reactant can also be reached again with other ancestors,
+unless every reaction has at most one reactant that is not buyable (as in
+protection and deprotection, or ester and acid interconversion).
+'''
+
+import copy
+import random
+import unittest
+from makeit.retrosynthetic.mcts.nodes import Chemical, Reaction, ChemicalTemplateApplication
+from makeit.retrosynthetic.mcts.tree_builder import MCTS, VIRTUAL_LOSS
+from makeit.retrosynthetic.mcts.benchmark import synthetic_tree, recursive_update, recursive_full_update
+
+
+def random_graph(rng, num_chemicals=12, max_depth=20, dag=False):
+    '''MCTS holding a random acyclic graph: reactions of chemical i only use
+    chemicals with larger ids, picked from a few so that they are shared.
+    The last chemicals are buyable and some template applications are still
+    waiting or made invalid reactions'''
+    tree = MCTS.__new__(MCTS)
+    tree.max_depth = max_depth
+    tree.max_branching = rng.choice([2, 20])
+    tree.dag = dag
+    tree.dirty_chemicals = set()
+    tree.dirty_reactions = set()
+    tree.Chemicals = [Chemical('C{}'.format(i)) for i in range(num_chemicals)]
+    for (chem_id, C) in enumerate(tree.Chemicals):
+        C.update_estimate_price(rng.uniform(1, 5))
+        if chem_id >= num_chemicals - 3 or (chem_id > 0 and rng.random() < 0.2):
+            C.terminal = True
+            C.done = True
+            C.set_price(1.0)
+            continue
+        for template_idx in range(rng.randint(1, 3)):
+            CTA = ChemicalTemplateApplication(chem_id, template_idx, rank=template_idx)
+            C.template_idx_results[template_idx] = CTA
+            if rng.random() < 0.1:
+                continue
+            CTA.waiting = False
+            for _ in range(rng.randint(1, 2)):
+                reactant_ids = tuple(rng.sample(range(chem_id + 1, num_chemicals), rng.randint(1, 2)))
+                if any(reactant_ids in other.reactions for other in C.template_idx_results.values()):
+                    continue
+                R = Reaction(chem_id, template_idx)
+                R.reactant_ids = reactant_ids
+                R.valid = rng.random() < 0.9
+                R.update_estimate_price(rng.uniform(1, 5))
+                CTA.reactions[reactant_ids] = R
+                for reactant_id in reactant_ids:
+                    tree.Chemicals[reactant_id].parents.append(R)
+    return tree
+
+
+def empty_tree(num_chemicals, max_depth=20):
+    tree = MCTS.__new__(MCTS)
+    tree.max_depth = max_depth
+    tree.max_branching = 20
+    tree.dag = False
+    tree.dirty_chemicals = set()
+    tree.dirty_reactions = set()
+    tree.Chemicals = [Chemical('C{}'.format(i)) for i in range(num_chemicals)]
+    return tree
+
+
+def cyclic_graph(rng, num_chemicals=8, max_depth=20, one_intermediate=False):
+    '''MCTS holding a random graph with cycles: reactions may use any other
+    chemical. The last two chemicals are buyable; with one_intermediate,
+    each reaction uses one other chemical and maybe a buyable one'''
+    tree = empty_tree(num_chemicals, max_depth=max_depth)
+    buyable = range(num_chemicals - 2, num_chemicals)
+    for (chem_id, C) in enumerate(tree.Chemicals):
+        if chem_id in buyable:
+            C.terminal = True
+            C.done = True
+            C.set_price(1.0)
+            continue
+        others = [other_id for other_id in range(num_chemicals) if other_id != chem_id]
+        for template_idx in range(rng.randint(1, 3)):
+            CTA = ChemicalTemplateApplication(chem_id, template_idx, rank=template_idx)
+            CTA.waiting = False
+            C.template_idx_results[template_idx] = CTA
+            if one_intermediate:
+                reactant_ids = (rng.choice(others),)
+                if reactant_ids[0] not in buyable and rng.random() < 0.5:
+                    reactant_ids += (rng.choice(buyable),)
+            else:
+                reactant_ids = tuple(rng.sample(others, rng.randint(1, 2)))
+            if any(reactant_ids in other.reactions for other in C.template_idx_results.values()):
+                continue
+            R = Reaction(chem_id, template_idx)
+            R.reactant_ids = reactant_ids
+            R.valid = rng.random() < 0.9
+            CTA.reactions[reactant_ids] = R
+            for reactant_id in reactant_ids:
+                tree.Chemicals[reactant_id].parents.append(R)
+    return tree
+
+
+def add_reaction(tree, chem_id, template_idx, reactant_ids):
+    CTA = tree.Chemicals[chem_id].template_idx_results.setdefault(
+        template_idx, ChemicalTemplateApplication(chem_id, template_idx, rank=template_idx))
+    CTA.waiting = False
+    R = Reaction(chem_id, template_idx)
+    R.reactant_ids = tuple(reactant_ids)
+    CTA.reactions[R.reactant_ids] = R
+    return R
+
+
+def random_pathway(rng, tree):
+    '''Pathway a selection could return from the root, with the virtual loss
+    selection adds to its chemicals and reactions'''
+    pathway = {}
+    queue = [0]
+    while queue:
+        chem_id = queue.pop(0)
+        C = tree.Chemicals[chem_id]
+        if chem_id in pathway or C.terminal or not C.template_idx_results:
+            continue
+        template_idx = rng.choice(list(C.template_idx_results))
+        CTA = C.template_idx_results[template_idx]
+        reactants_key = rng.choice(list(CTA.reactions)) if CTA.reactions else None
+        pathway[chem_id] = (template_idx, reactants_key)
+        C.virtual_loss += VIRTUAL_LOSS
+        if reactants_key:
+            CTA.reactions[reactants_key].virtual_loss += VIRTUAL_LOSS
+            queue.extend(reactants_key)
+    return pathway
+
+
+def count_routes(tree, chem_id, depth=0, path=()):
+    '''Number of routes from chem_id, reached at depth below the chemicals of
+    path, to buyable chemicals that do not go back to a chemical on the route'''
+    C = tree.Chemicals[chem_id]
+    if C.terminal:
+        return 1
+    if depth > tree.max_depth:
+        return 0
+    count = 0
+    for CTA in C.template_idx_results.values():
+        for R in CTA.reactions.values():
+            if R.valid and set(path).isdisjoint(R.reactant_ids):
+                routes = 1
+                for reactant_id in R.reactant_ids:
+                    routes *= count_routes(tree, reactant_id, depth+1, path + (chem_id,))
+                count += routes
+    return count
+
+
+def state(tree):
+    '''Everything update and full_update write, for every node'''
+    chemicals = [(C.visit_count, C.estimate_price, C.estimate_price_sum, C.estimate_price_cnt,
+                  C.price, C.done, C.best_template, C.pathway_count) for C in tree.Chemicals]
+    reactions = [(R.visit_count, R.estimate_price, R.estimate_price_cnt, R.price, R.done, R.pathway_count)
+                 for C in tree.Chemicals for CTA in C.template_idx_results.values() for R in CTA.reactions.values()]
+    return (chemicals, reactions)
+
+
+class TestBackup(unittest.TestCase):
+
+    def test_update_chain(self):
+        (tree, pathway) = synthetic_tree(300)
+        (reference, _) = synthetic_tree(300)
+        tree.update(0, pathway)
+        recursive_update(reference, 0, pathway)
+        self.assertEqual(state(tree), state(reference))
+        self.assertEqual(tree.Chemicals[0].price, 301)
+        self.assertEqual(tree.Chemicals[0].visit_count, 1)
+
+    def test_update_beyond_recursion_limit(self):
+        (tree, pathway) = synthetic_tree(5000)
+        tree.update(0, pathway)
+        self.assertEqual(tree.Chemicals[0].price, 5001)
+        self.assertEqual(tree.Chemicals[0].visit_count, 1)
+
+    def test_update_random(self):
+        rng = random.Random(0)
+        for dag in (False, True):
+            for _ in range(50):
+                tree = random_graph(rng, max_depth=rng.choice([3, 20]), dag=dag)
+                reference = copy.deepcopy(tree)
+                for _ in range(20):
+                    seed = rng.random()
+                    pathway = random_pathway(random.Random(seed), tree)
+                    self.assertEqual(random_pathway(random.Random(seed), reference), pathway)
+                    tree.update(0, pathway)
+                    recursive_update(reference, 0, pathway)
+                    self.assertEqual(state(tree), state(reference))
+
+    def test_full_update_chain(self):
+        for (depth, alternatives) in ((300, 1), (12, 2)):
+            (tree, _) = synthetic_tree(depth, alternatives=alternatives)
+            (reference, _) = synthetic_tree(depth, alternatives=alternatives)
+            tree.full_update(0)
+            recursive_full_update(reference, 0)
+            self.assertEqual(state(tree), state(reference))
+            self.assertEqual(tree.Chemicals[0].pathway_count, alternatives ** depth)
+
+    def test_full_update_beyond_recursion_limit(self):
+        (tree, _) = synthetic_tree(5000, alternatives=2)
+        tree.full_update(0)
+        self.assertEqual(tree.Chemicals[0].pathway_count, 2 ** 5000)
+
+    def test_full_update_random(self):
+        rng = random.Random(0)
+        for _ in range(100):
+            tree = random_graph(rng)
+            reference = copy.deepcopy(tree)
+            tree.full_update(0)
+            recursive_full_update(reference, 0)
+            self.assertEqual(state(tree), state(reference))
+            self.assertEqual(tree.Chemicals[0].pathway_count, count_routes(tree, 0))
+
+    def test_full_update_depth_limit(self):
+        rng = random.Random(1)
+        for _ in range(100):
+            tree = random_graph(rng, max_depth=rng.randint(0, 3))
+            tree.full_update(0)
+            self.assertEqual(tree.Chemicals[0].pathway_count, count_routes(tree, 0))
+
+    def test_full_update_cycle(self):
+        # 0 <- 1 | 2, 1 <- 3 | 5, 2 <- 3 and 3 <- 1 | 4, where 4 and 5 are
+        # buyable: 3 is reached at depth 2 below 1 and below 2, but can only
+        # be made from 1 below 2, so it has one route below 1 and two below 2
+        for order in ((1, 2), (2, 1)):
+            tree = empty_tree(6)
+            for chem_id in (4, 5):
+                tree.Chemicals[chem_id].terminal = True
+                tree.Chemicals[chem_id].set_price(1.0)
+            for (template_idx, reactant_id) in enumerate(order):
+                add_reaction(tree, 0, template_idx, (reactant_id,))
+            add_reaction(tree, 1, 0, (3,))
+            add_reaction(tree, 1, 1, (5,))
+            add_reaction(tree, 2, 0, (3,))
+            add_reaction(tree, 3, 0, (1,))
+            add_reaction(tree, 3, 1, (4,))
+            reference = copy.deepcopy(tree)
+            tree.full_update(0)
+            recursive_full_update(reference, 0)
+            self.assertEqual(tree.Chemicals[0].pathway_count, 4)
+            self.assertEqual(reference.Chemicals[0].pathway_count, 4)
+            self.assertEqual(tree.Chemicals[0].price, 1.0)
+
+    def test_full_update_cyclic(self):
+        rng = random.Random(2)
+        for one_intermediate in (True, False):
+            for _ in range(300):
+                tree = cyclic_graph(rng, max_depth=rng.choice([2, 4, 20]), one_intermediate=one_intermediate)
+                reference = copy.deepcopy(tree)
+                tree.full_update(0)
+                self.assertEqual(tree.Chemicals[0].pathway_count, count_routes(tree, 0))
+                if one_intermediate:
+                    recursive_full_update(reference, 0)
+                    self.assertEqual(tree.Chemicals[0].pathway_count, reference.Chemicals[0].pathway_count)
+
+                # The same count whatever order the reactions are visited in
+                for C in reference.Chemicals:
+                    C.template_idx_results = dict(reversed(list(C.template_idx_results.items())))
+                    for CTA in C.template_idx_results.values():
+                        CTA.reactions = dict(reversed(list(CTA.reactions.items())))
+                reference.full_update(0)
+                self.assertEqual(reference.Chemicals[0].pathway_count, tree.Chemicals[0].pathway_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
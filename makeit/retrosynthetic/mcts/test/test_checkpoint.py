@@ -0,0 +1,68 @@
+'''
+Checkpoint records: only the rows that were touched or added since the
+last write are saved, each field keeps its type, and the latest value of
+every row is rebuilt from the sequence of records.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from makeit.retrosynthetic.mcts.nodes import Chemical
+from makeit.retrosynthetic.mcts.checkpoint import CheckpointWriter, read_checkpoint, dirty_rows, stats_columns, \
+    apply_stats, final_stats, CHEMICAL_STATS
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'search.ckpt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, writer, chemicals, dirty):
+        rows = dirty_rows(dirty, writer.num_chemicals, len(chemicals))
+        writer.write([], rows, stats_columns(chemicals, CHEMICAL_STATS, rows),
+                     np.zeros((0,), dtype=np.int64), {}, elapsed=0.)
+        return rows
+
+    def test_dirty_rows(self):
+        self.assertEqual(dirty_rows(set(), 3, 3).tolist(), [])
+        self.assertEqual(dirty_rows({4, 0, 2}, 3, 6).tolist(), [0, 2, 3, 4, 5])
+
+    def test_round_trip(self):
+        chemicals = [Chemical('C{}'.format(i)) for i in range(4)]
+        writer = CheckpointWriter(self.path)
+        writer.start({'settings': {}})
+        self.assertEqual(self.write(writer, chemicals, set()).tolist(), [0, 1, 2, 3])
+
+        chemicals[1].visit_count = 7
+        chemicals[1].pathway_count = 2 ** 70
+        chemicals[2].update_estimate_price(2.5)
+        chemicals[2].done = True
+        chemicals.append(Chemical('C4'))
+        chemicals[4].best_template = 12
+        self.assertEqual(self.write(writer, chemicals, {1, 2}).tolist(), [1, 2, 4])
+        self.assertEqual(self.write(writer, chemicals, set()).tolist(), [])
+
+        (header, records) = read_checkpoint(self.path)
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[1]['chemical_stats']['visit_count'].dtype, np.int64)
+        (num_chemicals, columns) = final_stats(records, 'chemical', CHEMICAL_STATS)
+        self.assertEqual(num_chemicals, 5)
+
+        restored = [Chemical('C{}'.format(i)) for i in range(5)]
+        apply_stats(restored, CHEMICAL_STATS, range(num_chemicals), columns)
+        for (C, expected) in zip(restored, chemicals):
+            for (field, dtype) in CHEMICAL_STATS:
+                self.assertEqual(getattr(C, field), getattr(expected, field))
+                if dtype is not np.float64:
+                    self.assertIs(type(getattr(C, field)), type(getattr(expected, field)))
+        self.assertEqual(restored[1].pathway_count, 2 ** 70)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+'''
+MCTS.return_trees, which picks the best routes bottom-up, against the
+iterative deepening depth-first search it replaced, on small synthetic
+trees with shared subtrees, reactions shared by two templates, waiting
+template applications and invalid or unpriced reactions.
+
+The search took the first max_trees routes in depth-first order and
+sorted those, while return_trees keeps the best max_trees of all routes.
+Both give the same list when there are at most max_trees routes, and
+otherwise return_trees gives the start of the search's list with no cap.
+'''
+
+import random
+import unittest
+from types import SimpleNamespace
+import numpy as np
+from makeit.retrosynthetic.mcts.nodes import Chemical, Reaction, ChemicalTemplateApplication
+from makeit.retrosynthetic.mcts.tree_builder import MCTS
+from makeit.utilities.formats import chem_dict, rxn_dict
+
+SORT_OPTIONS = ('plausibility', 'number_of_starting_materials', 'number_of_reactions')
+
+
+def reference_return_trees(tree, max_trees):
+    '''MCTS.return_trees as an iterative deepening depth-first search'''
+
+    def cheminfodict(chem_id):
+        C = tree.Chemicals[chem_id]
+        return {
+            'smiles': C.smiles,
+            'ppg': C.purchase_price,
+            'as_reactant': C.as_reactant,
+            'as_product': C.as_product,
+        }
+
+    def tidlisttoinfodict(tids):
+        return {
+            'tforms': [str(tree.retroTransformer.templates[tid]['_id']) for tid in tids],
+            'num_examples': int(sum([tree.retroTransformer.templates[tid]['count'] for tid in tids])),
+            'necessary_reagent': tree.retroTransformer.templates[tids[0]]['necessary_reagent'],
+        }
+
+    ids = {}
+    def to_id(key):
+        if key not in ids:
+            ids[key] = len(ids) + 1
+        return ids[key]
+
+    def IDDFS():
+        for path in DLS_chem(tree.target_id, depth=0):
+            yield chem_dict(to_id(tree.target_id), children=path, **cheminfodict(tree.target_id))
+
+    def DLS_chem(chem_id, depth):
+        C = tree.Chemicals[chem_id]
+        if C.terminal:
+            yield []
+
+        if depth > tree.max_depth:
+            return
+
+        done_children_of_this_chemical = []
+        for tid, CTA in list(C.template_idx_results.items()):
+            if CTA.waiting:
+                continue
+            for reactants_key, R in list(CTA.reactions.items()):
+                if (not R.valid) or R.price == -1:
+                    continue
+                rxn_smiles = '.'.join(sorted(tree.Chemicals[i].smiles for i in R.reactant_ids)) + '>>' + C.smiles
+                if rxn_smiles not in done_children_of_this_chemical:
+                    for path in DLS_rxn(R.reactant_ids, depth):
+                        yield [rxn_dict(to_id(rxn_smiles), rxn_smiles, children=path,
+                            plausibility=R.plausibility,
+                            template_score=R.template_score, **tidlisttoinfodict(R.tforms))]
+                    done_children_of_this_chemical.append(rxn_smiles)
+
+    def DLS_rxn(reactant_ids, depth):
+        '''All combinations of the reactants' paths, the first reactant
+        varying slowest (the search spelled this out for 1 to 4 reactants)'''
+        if not reactant_ids:
+            yield []
+            return
+        chem_id0 = reactant_ids[0]
+        for path0 in DLS_chem(chem_id0, depth+1):
+            for rest in DLS_rxn(reactant_ids[1:], depth):
+                yield [chem_dict(to_id(chem_id0), children=path0, **cheminfodict(chem_id0))] + rest
+
+    trees = []
+    for route in IDDFS():
+        trees.append(route)
+        if len(trees) >= max_trees:
+            break
+
+    def number_of_starting_materials(tree):
+        if tree != []:
+            if tree['children']:
+                return sum(number_of_starting_materials(tree_child) for tree_child in tree['children'][0]['children'])
+        return 1.0
+    def number_of_reactions(tree):
+        if tree != []:
+            if tree['children']:
+                return 1.0 + max(number_of_reactions(tree_child) for tree_child in tree['children'][0]['children'])
+        return 0.0
+    def overall_plausibility(tree):
+        if tree != []:
+            if tree['children']:
+                producing_reaction = tree['children'][0]
+                return producing_reaction['plausibility'] * np.prod([overall_plausibility(tree_child) for tree_child in producing_reaction['children']])
+        return 1.0
+
+    if tree.sort_trees_by == 'plausibility':
+        trees = sorted(trees, key=lambda x: overall_plausibility(x), reverse=True)
+    elif tree.sort_trees_by == 'number_of_starting_materials':
+        trees = sorted(trees, key=lambda x: number_of_starting_materials(x))
+    elif tree.sort_trees_by == 'number_of_reactions':
+        trees = sorted(trees, key=lambda x: number_of_reactions(x))
+    return trees
+
+
+def without_ids(node):
+    '''Route with the node ids left out, since they number the nodes in the
+    order they were first reached'''
+    return dict((key, [without_ids(child) for child in value] if key == 'children' else value)
+                for (key, value) in node.items() if key != 'id')
+
+
+def make_tree(num_chemicals, max_depth=3):
+    tree = MCTS.__new__(MCTS)
+    tree.checkpoint = None
+    tree.status = {}
+    tree.target_id = 0
+    tree.max_depth = max_depth
+    tree.max_trees = 500
+    tree.sort_trees_by = 'plausibility'
+    tree.Chemicals = [Chemical('C{}'.format(i)) for i in range(num_chemicals)]
+    tree.retroTransformer = SimpleNamespace(templates=[{'_id': 't{}'.format(i), 'count': i + 1, 'necessary_reagent': ''}
+                                                       for i in range(10)])
+    return tree
+
+
+def add_reaction(tree, chem_id, template_idx, reactant_ids, plausibility=1.0, price=1.0):
+    '''Adds a reaction, sharing an existing reaction with the same reactants
+    the way MCTS.add_outcome does'''
+    C = tree.Chemicals[chem_id]
+    if template_idx not in C.template_idx_results:
+        CTA = ChemicalTemplateApplication(chem_id, template_idx, rank=len(C.template_idx_results))
+        CTA.waiting = False
+        C.template_idx_results[template_idx] = CTA
+    CTA = C.template_idx_results[template_idx]
+    key = tuple(reactant_ids)
+    for other in C.template_idx_results.values():
+        if key in other.reactions:
+            other.reactions[key].tforms.append(template_idx)
+            CTA.reactions[key] = other.reactions[key]
+            return other.reactions[key]
+    R = Reaction(chem_id, template_idx)
+    R.reactant_ids = list(reactant_ids)
+    R.plausibility = plausibility
+    R.template_score = 0.1 * template_idx
+    R.price = price
+    CTA.reactions[key] = R
+    return R
+
+
+def random_tree(rng, num_chemicals=7):
+    '''Reactions only use chemicals with larger ids, so the routes are
+    finite; plausibilities come from a short list so that scores tie, and
+    include 0 in some trees, where worse routes can tie with better ones'''
+    tree = make_tree(num_chemicals, max_depth=rng.choice([1, 2, 3]))
+    plausibilities = rng.choice([[0.5, 0.8, 1.0], [0.0, 0.5, 1.0]])
+    for (chem_id, C) in enumerate(tree.Chemicals):
+        C.terminal = chem_id > 0 and rng.random() < 0.5
+        C.purchase_price = 1.0 if C.terminal else -1
+        if chem_id == num_chemicals - 1:
+            C.terminal = True
+            continue
+        for _ in range(rng.randint(1, 4)):
+            reactant_ids = rng.sample(range(chem_id + 1, num_chemicals), rng.randint(1, min(3, num_chemicals - chem_id - 1)))
+            R = add_reaction(tree, chem_id, rng.randrange(10), reactant_ids,
+                             plausibility=rng.choice(plausibilities),
+                             price=rng.choice([1.0] * 5 + [-1]))
+            R.valid = rng.random() < 0.9
+        for CTA in C.template_idx_results.values():
+            CTA.waiting = rng.random() < 0.1
+    return tree
+
+
+class TestReturnTrees(unittest.TestCase):
+
+    def assertSameRoutes(self, tree, max_trees):
+        tree.max_trees = max_trees
+        (_, trees) = tree.return_trees()
+        expected = reference_return_trees(tree, max_trees=float('inf'))
+        if len(expected) <= max_trees:
+            self.assertEqual(len(reference_return_trees(tree, max_trees)), len(expected))
+        self.assertEqual([without_ids(route) for route in trees],
+                         [without_ids(route) for route in expected[:max_trees]])
+
+        # Each node id stands for one chemical or reaction SMILES
+        smiles_of_id = {}
+        def check_ids(node):
+            self.assertEqual(smiles_of_id.setdefault(node['id'], node['smiles']), node['smiles'])
+            for child in node['children']:
+                check_ids(child)
+        for route in trees:
+            check_ids(route)
+
+    def test_hand_built(self):
+        tree = make_tree(6)
+        for chem_id in (3, 4, 5):
+            tree.Chemicals[chem_id].terminal = True
+        tree.Chemicals[2].terminal = True
+        # 0 <- 1 + 2, where 1 and 2 each have two routes, shared with 0 <- 1
+        add_reaction(tree, 0, 0, (1, 2), plausibility=0.9)
+        add_reaction(tree, 0, 1, (1,), plausibility=0.5)
+        add_reaction(tree, 0, 2, (1, 2)) # same reaction from another template
+        add_reaction(tree, 1, 0, (3, 4), plausibility=0.8)
+        add_reaction(tree, 1, 3, (5,), plausibility=0.8)
+        add_reaction(tree, 2, 0, (5,), plausibility=0.7)
+        add_reaction(tree, 2, 4, (3,), price=-1)
+        for sort_trees_by in SORT_OPTIONS:
+            tree.sort_trees_by = sort_trees_by
+            for max_trees in (1, 2, 3, 500):
+                self.assertSameRoutes(tree, max_trees)
+        tree.sort_trees_by = 'plausibility'
+        tree.max_trees = 500
+        (_, trees) = tree.return_trees()
+        self.assertEqual(len(trees), 6)
+        self.assertEqual(trees[0]['children'][0]['tforms'], ['t0', 't2'])
+
+    def test_tie_under_max(self):
+        tree = make_tree(5)
+        tree.Chemicals[4].terminal = True
+        tree.sort_trees_by = 'number_of_reactions'
+        # 1 is made in two (first) or one (second) reactions and 2 in two, so
+        # 0 <- 1 + 2 takes three reactions either way and the first route to
+        # 1 wins the tie, although the second one is better on its own
+        add_reaction(tree, 0, 0, (1, 2))
+        add_reaction(tree, 1, 0, (3,))
+        add_reaction(tree, 1, 1, (4,))
+        add_reaction(tree, 2, 0, (3,))
+        add_reaction(tree, 3, 0, (4,))
+        for max_trees in (1, 2, 500):
+            self.assertSameRoutes(tree, max_trees)
+        tree.max_trees = 1
+        (_, trees) = tree.return_trees()
+        self.assertEqual(trees[0]['children'][0]['children'][0]['children'][0]['smiles'], 'C3>>C1')
+
+    def test_random(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            tree = random_tree(rng)
+            for sort_trees_by in SORT_OPTIONS:
+                tree.sort_trees_by = sort_trees_by
+                for max_trees in (1, 4, 25, 500):
+                    self.assertSameRoutes(tree, max_trees)
+
+
+if __name__ == '__main__':
+    unittest.main()
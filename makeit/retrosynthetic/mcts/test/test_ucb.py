@@ -0,0 +1,178 @@
+'''
+The array version of MCTS.UCB against the per-child loop it replaced, on
+hand-built chemicals with ties, virtual losses, invalid template
+applications, done reactions and reactions shared by two templates.
+'''
+
+import random
+import unittest
+import numpy as np
+from makeit.retrosynthetic.mcts.nodes import Chemical, Reaction, ChildStats
+from makeit.retrosynthetic.mcts.tree_builder import MCTS, VIRTUAL_LOSS
+
+
+def reference_ucb(tree, chem_id, c_exploration=0.2, path=[]):
+    '''MCTS.UCB as a loop over template applications and their reactions'''
+    rxn_scores = []
+
+    C = tree.Chemicals[chem_id]
+    product_visits = C.visit_count + C.virtual_loss
+    max_estimate_price = 0
+
+    for template_idx in C.template_idx_results:
+        CTA = C.template_idx_results[template_idx]
+        if CTA.waiting or not CTA.valid:
+            continue
+
+        for reactants_key in CTA.reactions:
+            R = CTA.reactions[reactants_key]
+
+            if len(set(R.reactant_ids) & set(path)) > 0: # avoid cycles
+                continue
+            if R.done:
+                continue
+            max_estimate_price = max(max_estimate_price, R.estimate_price)
+            Q_sa = - R.estimate_price
+            U_sa = c_exploration * C.prob[template_idx] * np.sqrt(product_visits) / (1 + R.visit_count + R.virtual_loss)
+            score = Q_sa + U_sa
+            rxn_scores.append((score, template_idx, reactants_key))
+
+    num_branches = len(rxn_scores)
+    if num_branches < tree.max_branching or chem_id == tree.target_id:
+        for template_idx in C.top_indeces:
+            if template_idx not in C.template_idx_results:
+                Q_sa = - (max_estimate_price + 0.1)
+                U_sa = c_exploration * C.prob[template_idx] * np.sqrt(product_visits) / 1
+                score = Q_sa + U_sa
+                rxn_scores.append((score, template_idx, None))
+                break
+
+    if len(rxn_scores) > 0:
+        sorted_rxn_scores = sorted(rxn_scores, key=lambda x: x[0], reverse=True)
+        best_rxn_score, selected_template_idx, selected_reactants_key = sorted_rxn_scores[0]
+    else:
+        selected_template_idx, selected_reactants_key = None, None
+
+    return selected_template_idx, selected_reactants_key
+
+
+def make_tree(num_chemicals, num_templates, max_branching=20):
+    tree = MCTS.__new__(MCTS)
+    tree.checkpoint = None
+    tree.max_branching = max_branching
+    tree.target_id = -1
+    tree.child_stats = ChildStats(capacity=2) # small, so the arrays have to grow
+    tree.Chemicals = [Chemical('C{}'.format(i)) for i in range(num_chemicals)]
+    probs = np.linspace(0.3, 0.05, num_templates).astype(np.float32)
+    for C in tree.Chemicals:
+        C.set_template_relevance_probs(probs, np.arange(num_templates), 1)
+    return tree
+
+
+def add_reaction(tree, chem_id, template_idx, reactant_ids, visit_count=0, virtual_loss=0, estimate_price=1.,
+                 done=False):
+    '''Adds a reaction the way MCTS.add_outcome does, merging it into an
+    existing reaction with the same reactants'''
+    C = tree.Chemicals[chem_id]
+    if template_idx not in C.template_idx_results:
+        tree.add_template_application(chem_id, template_idx).waiting = False
+    CTA = C.template_idx_results[template_idx]
+    key = tuple(reactant_ids)
+    for other in C.template_idx_results.values():
+        if key in other.reactions:
+            CTA.reactions[key] = other.reactions[key]
+            C.add_child(CTA, other.reactions[key], tree.child_stats)
+            return other.reactions[key]
+    R = Reaction(chem_id, template_idx)
+    R.reactant_ids = list(reactant_ids)
+    C.add_reaction(R, tree.child_stats)
+    R.visit_count = visit_count
+    R.virtual_loss = virtual_loss
+    R.estimate_price = estimate_price
+    R.done = done
+    CTA.reactions[key] = R
+    C.add_child(CTA, R, tree.child_stats)
+    return R
+
+
+class TestUCB(unittest.TestCase):
+
+    def assertSameSelection(self, tree, chem_id, c_exploration=0.2, path=[]):
+        self.assertEqual(tree.UCB(chem_id, c_exploration=c_exploration, path=path),
+                         reference_ucb(tree, chem_id, c_exploration=c_exploration, path=path))
+
+    def test_hand_built(self):
+        tree = make_tree(8, 6)
+        C = tree.Chemicals[0]
+        C.visit_count = 40
+        # Two reactions of one template with identical scores
+        add_reaction(tree, 0, 2, (1, 2), visit_count=3, estimate_price=2.)
+        add_reaction(tree, 0, 2, (3,), visit_count=3, estimate_price=2.)
+        # The same score from a later template, and a reaction shared with it
+        add_reaction(tree, 0, 0, (4, 5), visit_count=3, estimate_price=2.)
+        add_reaction(tree, 0, 0, (1, 2))
+        # A done reaction that would otherwise win
+        add_reaction(tree, 0, 1, (6,), visit_count=0, estimate_price=0.5, done=True)
+        # A template application that failed
+        add_reaction(tree, 0, 3, (7,), visit_count=0, estimate_price=0.5)
+        C.invalidate(C.template_idx_results[3], tree.child_stats)
+        # Template 0 is the most relevant; its two children tie, and the
+        # one added to it first wins
+        self.assertEqual(tree.UCB(0), (0, (4, 5)))
+        self.assertEqual(tree.UCB(0, path=[4]), (0, (1, 2)))
+        for c in (0.2, 1., 5., 100.):
+            for path in ([], [0], [1], [3], [1, 3], [1, 3, 4]):
+                self.assertSameSelection(tree, 0, c_exploration=c, path=path)
+
+        # Virtual loss on the chemical and on the leading reaction
+        C.virtual_loss += VIRTUAL_LOSS
+        C.template_idx_results[2].reactions[(1, 2)].virtual_loss += VIRTUAL_LOSS
+        for c in (0.2, 1., 5.):
+            for path in ([], [3], [4]):
+                self.assertSameSelection(tree, 0, c_exploration=c, path=path)
+
+        # Every child done or excluded: the next untried template, or nothing
+        # once max_branching is reached
+        for CTA in C.template_idx_results.values():
+            for R in CTA.reactions.values():
+                R.done = True
+        self.assertEqual(tree.UCB(0), (4, None))
+        self.assertSameSelection(tree, 0)
+        tree.max_branching = 0
+        self.assertSameSelection(tree, 0)
+        tree.target_id = 0
+        self.assertSameSelection(tree, 0)
+
+    def test_random(self):
+        rng = random.Random(0)
+        for trial in range(300):
+            num_templates = rng.randint(1, 8)
+            tree = make_tree(10, num_templates, max_branching=rng.randint(1, 12))
+            C = tree.Chemicals[0]
+            C.visit_count = rng.choice([0, 1, 7, 50])
+            C.virtual_loss = rng.choice([0, VIRTUAL_LOSS])
+            for template_idx in rng.sample(range(num_templates), rng.randint(0, num_templates)):
+                for _ in range(rng.randint(0, 3)):
+                    reactant_ids = tuple(sorted(rng.sample(range(1, 10), rng.randint(1, 2))))
+                    R = add_reaction(tree, 0, template_idx, reactant_ids,
+                                     visit_count=rng.choice([0, 1, 3]),
+                                     virtual_loss=rng.choice([0, 0, VIRTUAL_LOSS]),
+                                     estimate_price=rng.choice([0.5, 1., 2.]),
+                                     done=rng.random() < 0.2)
+                if template_idx in C.template_idx_results and rng.random() < 0.2:
+                    C.invalidate(C.template_idx_results[template_idx], tree.child_stats)
+            path = rng.sample(range(10), rng.randint(0, 3))
+            for c in (0.2, 1.):
+                self.assertSameSelection(tree, 0, c_exploration=c, path=path)
+
+    def test_sparse_chemicals_own_no_arrays(self):
+        tree = make_tree(4, 3)
+        add_reaction(tree, 0, 0, (1,))
+        add_reaction(tree, 2, 1, (3,))
+        for C in tree.Chemicals:
+            self.assertTrue(C.children is None or isinstance(C.children, list))
+        self.assertEqual(tree.child_stats.num_rxns, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+'''
+Leaf value estimators: one shared estimator per name, loaded once, and
+one estimate call per expansion result with each new chemical scored once.
+'''
+
+import threading
+import unittest
+from unittest import mock
+from makeit.prioritization.precursors.scscore import SCScorePrecursorPrioritizer
+from makeit.retrosynthetic.mcts.tree_builder import MCTS
+from makeit.retrosynthetic.mcts.value_estimators import SCScoreValueEstimator, get_value_estimator
+
+
+class CountingScorer(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def get_scores_from_smiles_list(self, smiles_list):
+        self.calls.append(list(smiles_list))
+        return [2.0] * len(smiles_list)
+
+
+class TestValueEstimators(unittest.TestCase):
+
+    def test_shared_by_name(self):
+        estimator = get_value_estimator('scscore')
+        self.assertIs(get_value_estimator('scscore'), estimator)
+        self.assertIs(get_value_estimator(estimator), estimator)
+        self.assertIsNone(get_value_estimator(None))
+        with self.assertRaises(ValueError):
+            get_value_estimator('unknown')
+
+    def test_load_once(self):
+        estimator = SCScoreValueEstimator()
+        with mock.patch.object(SCScorePrecursorPrioritizer, 'load_model') as load_model:
+            threads = [threading.Thread(target=estimator.load) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            estimator.load()
+        load_model.assert_called_once_with(FP_len=1024, model_tag='1024bool')
+
+    def test_estimate_leaf_values(self):
+        tree = MCTS.__new__(MCTS)
+        tree.chem_ids = {'CC': 0}
+        scorer = CountingScorer()
+        tree.value_estimator = SCScoreValueEstimator(weight=0.5, scorer=scorer)
+        groups = [
+            [(0, 'CC', 1, [('CO', 0, 0, 0), ('N', 0, 0, 0)], 0.9),
+             (0, 'CC', 2, [('CC', 0, 0, 0), ('CO', 0, 0, 0)], 0.8)],
+            [(0, 'CC', 3, [('N', 0, 0, 0), ('O', 0, 0, 0)], 0.7)],
+        ]
+        self.assertEqual(tree.estimate_leaf_values(groups), 3)
+        self.assertEqual(scorer.calls, [['CO', 'N', 'O']])
+        self.assertEqual(tree.leaf_values, {'CO': 1.5, 'N': 1.5, 'O': 1.5})
+        self.assertEqual(tree.estimate_leaf_values([]), 0)
+        self.assertEqual(tree.leaf_values, {})
+        self.assertEqual(len(scorer.calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
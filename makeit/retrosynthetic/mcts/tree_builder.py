@@ -1,5 +1,5 @@
 from makeit.retrosynthetic.transformer import RetroTransformer
-from makeit.utilities.buyable.pricer import Pricer
+from makeit.utilities.registry import get_shared_pricer, get_shared_chemhistorian
 from multiprocessing import Process, Manager, Queue, Pool
 from celery.result import allow_join_result
 from pymongo import MongoClient
@@ -7,7 +7,12 @@ from pymongo import MongoClient
 # from makeit.mcts.cost import Reset, score_max_depth, MinCost, BuyablePathwayCount
 # from makeit.mcts.misc import get_feature_vec, save_sparse_tree
 # from makeit.mcts.misc import value_network_training_states
-from makeit.retrosynthetic.mcts.nodes import Chemical, Reaction, ChemicalTemplateApplication
+from makeit.retrosynthetic.mcts.nodes import Chemical, Reaction, ChemicalTemplateApplication, ChildStats
+from makeit.retrosynthetic.mcts.warm_start import settings_key
+from makeit.retrosynthetic.mcts.checkpoint import CheckpointWriter, read_checkpoint, dirty_rows, stats_columns, \
+    apply_stats, final_stats, CHEMICAL_STATS, REACTION_STATS
+from makeit.retrosynthetic.mcts.instrumentation import PhaseTimer, subtract_phases, summarize_samples
+from makeit.retrosynthetic.mcts.value_estimators import get_value_estimator
 from makeit.utilities.io.logger import MyLogger
 from makeit.utilities.io import model_loader
 from makeit.utilities.formats import chem_dict, rxn_dict
@@ -28,6 +33,7 @@ import multiprocessing as mp
 import numpy as np
 import traceback
 import itertools
+import bisect
 import random
 import time 
 import gzip 
@@ -39,6 +45,45 @@ treebuilder_loc = 'mcts_tree_builder'
 VIRTUAL_LOSS = 1000000
 WAITING = 0
 DONE = 1
+COORDINATOR_TIMEOUT = 1.0 # max seconds the coordinator blocks before re-checking time limits
+WORKER_TIMEOUT = 1.0 # max seconds a worker blocks before re-checking the done flag
+CELERY_POLL_MIN = 0.005 # backoff bounds when waiting on Celery results
+CELERY_POLL_MAX = 0.1
+CHECKPOINT_INTERVAL = 60.0 # seconds between checkpoints of a search
+MAX_GRAPH_CHEMICALS = 500000 # graph size at which a batch search starts over with an empty graph
+PATHWAYS_PER_TARGET = 4 # default active pathways per target when a batch search runs several at once
+QUEUE_SAMPLE_INTERVAL = 0.5 # seconds between samples of the expansion queue depth
+CONVERGENCE_TOP_K = 10 # number of best root reactions compared by the convergence criterion
+MIN_ROOT_VISITS = 100 # root visits before the visit concentration criterion applies
+PATHWAYS_PER_PROC = 2 # default active pathways per worker in leaf-parallel mode
+
+
+class TargetSearch(object):
+    '''One target of the coordination loop: its root chemical, the active
+    pathways that select leaves under it, its time budget and how its
+    search went'''
+
+    __slots__ = ('smiles', 'target_id', 'ids', 'expansion_time', 'elapsed_offset', 'start_time',
+                 'time_for_first_path', 'termination_reason', 'top_prices', 'last_improvement')
+
+    def __init__(self, smiles, target_id, ids, expansion_time, elapsed_offset=0., time_for_first_path=-1):
+        self.smiles = smiles
+        self.target_id = target_id
+        self.ids = ids # IDs of the active pathways of this target
+        self.expansion_time = expansion_time
+        self.elapsed_offset = elapsed_offset # expansion time spent before the search was resumed
+        self.start_time = time.time()
+        self.time_for_first_path = time_for_first_path
+        # Why the search stopped: 'time', 'first_path', 'exhausted' (nothing
+        # left to expand), 'converged' (no better root reaction for
+        # convergence_window seconds) or 'concentrated' (one root reaction
+        # gets visit_concentration of the root visits)
+        self.termination_reason = 'time'
+        self.top_prices = None # top_root_prices of the target when they last changed
+        self.last_improvement = self.start_time
+
+    def elapsed(self):
+        return time.time() - self.start_time
 
 
 class MCTS:
@@ -111,6 +156,24 @@ class MCTS:
         self.chiral = chiral
         self.max_cum_template_prob = 1
         self.sort_trees_by = 'plausibility'
+        self.expansion_batch_size = 1
+        self.leaf_batch_size = None
+        self.stream_chunk_size = None
+        self.value_estimator = None
+        self.dag = False
+        self.warm_start = None
+        self.warm_start_key = None
+        self.checkpoint = None
+        self.checkpoint_interval = CHECKPOINT_INTERVAL
+        self.restored = None # (header, records) of a checkpoint to resume from
+        self.search_settings = {}
+        self.batch_search = False
+        self.report = None # search_report() of the last search
+        self.convergence_window = None
+        self.convergence_top_k = CONVERGENCE_TOP_K
+        self.visit_concentration = None
+        self.min_root_visits = MIN_ROOT_VISITS
+        self.termination_reason = None
 
         if num_active_pathways is None:
             num_active_pathways = self.nproc
@@ -120,15 +183,12 @@ class MCTS:
         if pricer:
             self.pricer = pricer
         else:
-            self.pricer = Pricer()
-            self.pricer.load()
+            self.pricer = get_shared_pricer()
 
 
         self.chemhistorian = chemhistorian
         if chemhistorian is None:
-            from makeit.utilities.historian.chemicals import ChemHistorian 
-            self.chemhistorian = ChemHistorian()
-            self.chemhistorian.load_from_file(refs=False, compressed=True)
+            self.chemhistorian = get_shared_chemhistorian(refs=False, compressed=True)
 
         # Initialize vars, reset dicts, etc.
         self.reset(soft_reset=False) # hard
@@ -162,24 +222,36 @@ class MCTS:
 
 
 
+        # Expansions apply a list of templates to one chemical as one unit of
+        # work; results come back as (_id, groups, final) with one group of
+        # outcomes per template. Streamed partial results have final=False.
         if self.celery:
-            def expand(_id, smiles, template_idx): # TODO: make Celery workers
+            def expand(_id, chem_id, template_idxs): # TODO: make Celery workers
                 # Chiral transformation or heuristic prioritization requires
                 # same database. _id is _id of active pathway
-                self.pending_results.append(tb_c_worker.apply_one_template_by_idx.apply_async(
-                    args=(_id, smiles, template_idx),
+                template_idxs = self.expand_from_warm_start(_id, chem_id, template_idxs)
+                if not template_idxs:
+                    return
+                self.pending_results.append(tb_c_worker.apply_templates_by_idx.apply_async(
+                    args=(_id, self.Chemicals[chem_id].smiles, template_idxs),
                     kwargs={'template_count': self.template_count,
                             'max_cum_prob': self.max_cum_template_prob,
                             'apply_fast_filter': self.apply_fast_filter,
-                            'filter_threshold': self.filter_threshold},
+                            'filter_threshold': self.filter_threshold,
+                            'chunk_size': self.stream_chunk_size},
                     # queue=self.private_worker_queue, ## CWC TEST: don't reserve
                 ))
-                self.status[(smiles, template_idx)] = WAITING
+                for template_idx in template_idxs:
+                    self.status[(chem_id, template_idx)] = WAITING
                 self.active_pathways_pending[_id] += 1
         else:
-            def expand(_id, smiles, template_idx):
-                self.expansion_queue.put((_id, smiles, template_idx))
-                self.status[(smiles, template_idx)] = WAITING
+            def expand(_id, chem_id, template_idxs):
+                template_idxs = self.expand_from_warm_start(_id, chem_id, template_idxs)
+                if not template_idxs:
+                    return
+                self.expansion_queue.put((_id, self.Chemicals[chem_id].smiles, template_idxs, self.stream_chunk_size))
+                for template_idx in template_idxs:
+                    self.status[(chem_id, template_idx)] = WAITING
                 self.active_pathways_pending[_id] += 1
         self.expand = expand
 
@@ -213,28 +285,70 @@ class MCTS:
                     p.start()
         self.prepare = prepare
 
-        # Define method to get a processed result.
+        # Define method to wait for processed results. Blocks until at least
+        # one expansion has finished (or timeout seconds have passed), then
+        # yields everything that is ready.
         if self.celery:
-            def get_ready_result():
-                # Update which processes are ready
-                self.is_ready = [i for (i, res) in enumerate(self.pending_results) if res.ready()]
-                for i in self.is_ready:
-                    yield self.pending_results[i].get(timeout=0.1)
-                    self.pending_results[i].forget()
-                self.pending_results = [res for (i, res) in enumerate(self.pending_results) if i not in self.is_ready]
+            def wait_for_results(timeout):
+                # The result backend does not notify us, so back off
+                # exponentially instead of spinning on res.ready()
+                deadline = time.time() + timeout
+                interval = CELERY_POLL_MIN
+                while True:
+                    is_ready = [i for (i, res) in enumerate(self.pending_results) if res.ready()]
+                    streamed = []
+                    if self.stream_chunk_size:
+                        # Each update holds the groups since the previous one,
+                        # so only the one continuing what was streamed can be
+                        # used; after a missed update the rest of the groups
+                        # come with the result
+                        for (i, res) in enumerate(self.pending_results):
+                            if i not in is_ready and res.state == 'PROGRESS':
+                                meta = res.info
+                                if meta['start'] == self.streamed_counts.get(res.id, 0):
+                                    streamed.append((res.id, meta))
+                    remaining = deadline - time.time()
+                    if is_ready or streamed or not self.pending_results or remaining <= 0:
+                        break
+                    time.sleep(min(interval, remaining))
+                    interval = min(2 * interval, CELERY_POLL_MAX)
+                for (res_id, meta) in streamed:
+                    self.streamed_counts[res_id] = meta['start'] + len(meta['groups'])
+                    yield (meta['_id'], meta['groups'], False)
+                ready = [self.pending_results[i] for i in is_ready]
+                is_ready = set(is_ready)
+                self.pending_results = [res for (i, res) in enumerate(self.pending_results) if i not in is_ready]
+                for res in ready:
+                    (_id, groups, phases) = res.get(timeout=0.1)
+                    self.worker_timer.merge(phases)
+                    yield (_id, groups[self.streamed_counts.pop(res.id, 0):], True)
+                    res.forget()
         else:
-            def get_ready_result():
-                while not self.results_queue.empty():
-                    yield self.results_queue.get(timeout=0.5)
-        self.get_ready_result = get_ready_result
+            def wait_for_results(timeout):
+                try:
+                    yield self.results_queue.get(timeout=max(timeout, 0.01))
+                except VanillaQueue.Empty:
+                    return
+                while True:
+                    try:
+                        yield self.results_queue.get_nowait()
+                    except VanillaQueue.Empty:
+                        return
+        self.wait_for_results = wait_for_results
 
         # Define how first target is set.
         def set_initial_target(_id, leaves): # i = index of active pathway
+            # All templates selected for the same chemical go out as one expansion
+            template_idxs_by_chem = {}
             for leaf in leaves:
                 if leaf in self.status: # already being worked on
                     continue
-                chem_smi, template_idx = leaf
-                self.expand(_id, chem_smi, template_idx)     
+                chem_id, template_idx = leaf
+                if chem_id not in template_idxs_by_chem:
+                    template_idxs_by_chem[chem_id] = []
+                template_idxs_by_chem[chem_id].append(template_idx)
+            for (chem_id, template_idxs) in template_idxs_by_chem.items():
+                self.expand(_id, chem_id, template_idxs)
         self.set_initial_target = set_initial_target
 
         # Define method to stop working.
@@ -267,30 +381,108 @@ class MCTS:
         #   return None
 
     def ResetVisitCount(self):
-        for chem_key in self.Chemicals: 
-            self.Chemicals[chem_key].visit_count = 0
+        for C in self.Chemicals: 
+            C.visit_count = 0
         for rxn_key in self.Reactions: 
             self.Reactions[rxn_key].visit_count = 0
             self.Reactions[rxn_key].successes = []
             self.Reactions[rxn_key].rewards = []
 
 
-    def coordinate(self, soft_stop=False, known_bad_reactions=[], forbidden_molecules=[], return_first=False):
+    def coordinate(self, targets, concurrent_targets=1, max_graph_chemicals=None, soft_stop=False,
+                   known_bad_reactions=[], forbidden_molecules=[], return_first=False):
+        '''Searches targets, an iterator of (smiles, expansion_time) pairs, up
+        to concurrent_targets of them at a time in one loop over the workers,
+        and yields the TargetSearch of each target once it has stopped. The
+        active pathways are split between the concurrent targets, and the
+        next target starts on the pathways of one that stopped. All targets
+        share the graph, and the expansions still in flight when a target
+        stops are added to it as they come in. Once the graph holds more than
+        max_graph_chemicals chemicals, the next target waits until the
+        running ones have stopped and the graph has been cleared'''
 
         if not self.celery:
             while not all(self.initialized):
                 MyLogger.print_and_log('Waiting for workers to initialize...', treebuilder_loc)
                 time.sleep(2)
         start_time = time.time()
-        elapsed_time = time.time() - start_time
-        next = 1
+        last_sample = start_time - QUEUE_SAMPLE_INTERVAL
+        next_report = 1
+        concurrent_targets = max(1, min(concurrent_targets, self.num_active_pathways))
+        slot_ids = [list(range(slot, self.num_active_pathways, concurrent_targets)) for slot in range(concurrent_targets)]
+        searches = [None for slot in range(concurrent_targets)]
+        next_target = next(targets, None)
+        stopped = []
+        # Active pathways with no expansions in flight; only these need a new selection
+        free_ids = set(_id for _id in range(self.num_active_pathways) if self.active_pathways_pending[_id] == 0)
+        # Leaf-parallel mode: free pathways whose last selection found nothing
+        # new to expand, tried after the others until more results land
+        stalled = set()
+
+        def stop_search(slot, reason):
+            '''Releases the virtual losses of the pathways of the target in
+            slot and frees the slot for the next target'''
+            search = searches[slot]
+            search.termination_reason = reason
+            MyLogger.print_and_log('Stopped expansion of {} after {:.2f} seconds ({})'.format(
+                search.smiles, search.elapsed(), reason), treebuilder_loc)
+            for _id in search.ids:
+                self.update(search.target_id, self.active_pathways[_id])
+                self.active_pathways[_id] = {}
+                self.pathway_targets[_id] = None
+            if self.checkpoint is not None:
+                self.write_checkpoint(search)
+                MyLogger.print_and_log('Saved checkpoint to {}'.format(self.checkpoint.file_path), treebuilder_loc)
+            searches[slot] = None
+            stopped.append(search)
+
         MyLogger.print_and_log('Starting cooridnation loop', treebuilder_loc)
-        while (elapsed_time < self.expansion_time): # and self.waiting_for_results():
+        while True:
 
-            if (int(elapsed_time)//5 == next):
-                next += 1
-                print(("Worked for {}/{} s".format(int(elapsed_time*10)/10.0, self.expansion_time)))
-                print(("... current min-price {}".format(self.Chemicals[self.smiles].price)))
+            # Start the next targets in the free slots
+            while next_target is not None and None in searches:
+                if max_graph_chemicals is not None and len(self.Chemicals) > max_graph_chemicals:
+                    if any(search is not None for search in searches):
+                        break # wait for the running targets before clearing the graph
+                    self.clear_graph()
+                    free_ids = set(range(self.num_active_pathways))
+                    stalled = set()
+                slot = searches.index(None)
+                (smiles, expansion_time) = next_target
+                search = self.start_search(smiles, expansion_time, slot_ids[slot])
+                next_target = next(targets, None)
+                searches[slot] = search
+                for _id in search.ids:
+                    self.pathway_targets[_id] = search.target_id
+                    if self.active_pathways_pending[_id] > 0:
+                        free_ids.discard(_id)
+                if self.Chemicals[search.target_id].price != -1 and search.time_for_first_path == -1:
+                    # Solved while searching another target of a batch
+                    search.time_for_first_path = search.elapsed_offset
+                    MyLogger.print_and_log('Target is already solved', treebuilder_loc)
+            if all(search is None for search in searches):
+                break
+
+            for (slot, search) in enumerate(searches):
+                if search is None:
+                    continue
+                if return_first and search.time_for_first_path != -1:
+                    stop_search(slot, 'first_path')
+                elif search.elapsed() >= search.expansion_time:
+                    stop_search(slot, 'time')
+            for search in stopped:
+                yield search
+            stopped = []
+            if all(search is None for search in searches):
+                continue
+
+            elapsed_time = time.time() - start_time
+            if (int(elapsed_time)//5 == next_report):
+                next_report += 1
+                for search in searches:
+                    if search is not None:
+                        print(("Worked for {}/{} s on {}".format(int(search.elapsed()*10)/10.0, search.expansion_time, search.smiles)))
+                        print(("... current min-price {}".format(self.Chemicals[search.target_id].price)))
                 print(("... |C| = {} |R| = {}".format(len(self.Chemicals), len(self.status))))
                 for _id in range(self.num_active_pathways):
                     print(('Active pathway {}: {}'.format(_id, self.active_pathways[_id])))
@@ -303,148 +495,313 @@ class MCTS:
                     print(('results_queue empty? {}'.format(self.results_queue.empty())))    
                     print(('All idle? {}'.format(self.idle)))
 
-                # print(self.expansion_queue.qsize()) # TODO: make this Celery compatible
-                # print(self.results_queue.qsize())
+            # Record finished expansion steps and select new targets for their pathways
+            active_ids = set(_id for search in searches if search is not None for _id in search.ids)
+            previous_pathways = list(self.active_pathways)
+            filling = False
+            if self.leaf_batch_size is None:
+                selected = sorted(free_ids & active_ids)
+                for _id in selected:
+                    self.select_pathways([_id], free_ids)
+            else:
+                # Select a batch of leaves at a time until every active pathway
+                # is in flight, without waiting for results in between
+                selected = sorted(free_ids & active_ids, key=lambda _id: (_id in stalled, _id))[:self.leaf_batch_size]
+                batch_stalled = self.select_pathways(selected, free_ids)
+                stalled.update(batch_stalled)
+                filling = len(batch_stalled) < len(selected) and bool((free_ids & active_ids) - stalled)
+
+            if time.time() - last_sample >= QUEUE_SAMPLE_INTERVAL:
+                last_sample = time.time()
+                self.sample_queues(last_sample - start_time)
+
+            if self.checkpoint is not None and time.time() - self.last_checkpoint >= self.checkpoint_interval:
+                self.write_checkpoint(searches[0])
+
+            for (slot, search) in enumerate(searches):
+                if search is None:
+                    continue
+                if self.convergence_window is not None and search.time_for_first_path != -1:
+                    prices = self.top_root_prices(search.target_id)
+                    if prices != search.top_prices:
+                        (search.top_prices, search.last_improvement) = (prices, time.time())
+                    elif time.time() - search.last_improvement >= self.convergence_window:
+                        MyLogger.print_and_log('No better route for {:.2f} seconds, stopping expansion'.format(
+                            time.time() - search.last_improvement), treebuilder_loc)
+                        stop_search(slot, 'converged')
+                        continue
 
-                # for _id in range(self.nproc):
-                #   print(_id, self.expansion_queues[_id].qsize(), self.results_queues[_id].qsize())
-                # time.sleep(2)
+                if self.visit_concentration is not None and self.root_visit_share(search.target_id) >= self.visit_concentration:
+                    MyLogger.print_and_log('Root visits concentrated on one reaction, stopping expansion', treebuilder_loc)
+                    stop_search(slot, 'concentrated')
+
+            # A target with nothing in flight has nothing to wait for. Selecting
+            # again may still find new leaves once the virtual losses of this
+            # round are released, unless the selection did not change and no
+            # expansion of another target can still change the graph under it.
+            spinning = False
+            if not self.cached_results:
+                for (slot, search) in enumerate(searches):
+                    if search is None or any(self.active_pathways_pending[_id] for _id in search.ids) or \
+                            not any(_id in selected for _id in search.ids):
+                        continue
+                    if all(self.active_pathways[_id] == {} for _id in search.ids) or \
+                            all(self.active_pathways[_id] == previous_pathways[_id] for _id in search.ids):
+                        if sum(self.active_pathways_pending) == 0 or not self.expanding_under(search.target_id):
+                            MyLogger.print_and_log('Cannot expand any further! Stuck?', treebuilder_loc)
+                            stop_search(slot, 'exhausted')
+                    else:
+                        spinning = True
+            for search in stopped:
+                yield search
+            stopped = []
+            if all(search is None for search in searches) or \
+                    (sum(self.active_pathways_pending) == 0 and not self.cached_results):
+                continue
 
-            for all_outcomes in self.get_ready_result():
+            # Sleep until a worker finishes an expansion, unless some were
+            # served from the warm start store or there are still pathways
+            # to fill
+            timeout = min([COORDINATOR_TIMEOUT] + [search.expansion_time - search.elapsed() for search in searches if search is not None])
+            (cached_results, self.cached_results) = (self.cached_results, [])
+            t = time.perf_counter()
+            for (_id, groups, final) in itertools.chain(cached_results, self.wait_for_results(0 if cached_results or filling or spinning else timeout)):
+                t = self.timer.add('wait_for_results', t)
+                if self.value_estimator is not None:
+                    t = self.timer.add('value_estimation', t, count=self.estimate_leaf_values(groups))
                 # Record that we've gotten a result for the _id of the active pathway
-                _id = all_outcomes[0][0]
                 # print('coord got outcomes for pathway ID {}'.format(_id))
-                self.active_pathways_pending[_id] -= 1
+                if final:
+                    self.active_pathways_pending[_id] -= 1
+                    if self.active_pathways_pending[_id] == 0: # this expansion step is done
+                        free_ids.add(_id)
 
                 # Result of applying one template_idx to one chem_smi can be multiple eoutcomes
-                for (_id, chem_smi, template_idx, reactants, filter_score) in all_outcomes:                        
-                    # print('coord pulled {} result from result queue'.format(chem_smi))
-                    self.status[(chem_smi, template_idx)] = DONE
-                    # R = self.Chemicals[chem_smi].reactions[template_idx]
-                    C = self.Chemicals[chem_smi]
-                    CTA = C.template_idx_results[template_idx] # TODO: make sure CTA created
-                    CTA.waiting = False
-
-                    # Any proposed reactants?
-                    if len(reactants) == 0: 
-                        CTA.valid = False # no precursors, reaction failed
-                        # print('No reactants found for {} {}'.format(_id, chem_smi))
-                        continue
-
-                    # Get reactants SMILES
-                    reactant_smiles = '.'.join([smi for (smi, _, _, _) in reactants])
-
-                    # Banned reaction?
-                    if '{}>>{}'.format(reactant_smiles, chem_smi) in known_bad_reactions:
-                        CTA.valid = False
-                        continue
+                for (_id, chem_smi, template_idx, reactants, filter_score) in itertools.chain.from_iterable(groups):                        
+                    self.add_outcome(_id, chem_smi, template_idx, reactants, filter_score,
+                                     known_bad_reactions=known_bad_reactions, forbidden_molecules=forbidden_molecules)
+                t = self.timer.add('add_outcomes', t, count=len(groups))
+
+                if self.leaf_batch_size is not None and final and self.active_pathways_pending[_id] == 0 and \
+                        self.pathway_targets[_id] is not None:
+                    # Backfill: the freed pathway goes straight back to work
+                    # instead of waiting for the rest of the results
+                    stalled.clear()
+                    stalled.update(self.select_pathways([_id], free_ids))
+                    t = time.perf_counter()
+            self.timer.add('wait_for_results', t, count=0)
+
+            for (slot, search) in enumerate(searches):
+                if search is not None and self.Chemicals[search.target_id].price != -1 and search.time_for_first_path == -1:
+                    search.time_for_first_path = search.elapsed_offset + search.elapsed()
+                    MyLogger.print_and_log('Found the first pathway for {} after {:.2f} seconds'.format(
+                        search.smiles, search.time_for_first_path), treebuilder_loc)
+                    if return_first:
+                        MyLogger.print_and_log('Stoping expansion to return first pathway as requested', treebuilder_loc)
+                        stop_search(slot, 'first_path')
+            for search in stopped:
+                yield search
+            stopped = []
+
+        if not self.batch_search: # a batch keeps its workers running until all of its targets are done
+            self.stop(soft_stop=soft_stop)
+
+    def select_pathways(self, ids, free_ids):
+        '''Backs up the finished expansion step of each of the active pathways
+        ids and selects a new one for it, under the target the pathway
+        belongs to. All selections are made under the virtual loss of the
+        previous ones, so they lead to distinct leaves, and the leaves are
+        dispatched together once all are selected. Pathways that got
+        expansions are removed from free_ids; returns the ones that found
+        nothing new to expand'''
+        t = time.perf_counter()
+        selected = []
+        for _id in ids:
+            self.target_id = self.pathway_targets[_id]
+            self.update(self.target_id, self.active_pathways[_id])
+            t = self.timer.add('update', t)
+            leaves, pathway = self.select_leaf()
+            t = self.timer.add('selection', t)
+            self.active_pathways[_id] = pathway
+            selected.append((_id, leaves))
+        stalled = []
+        for (_id, leaves) in selected:
+            self.set_initial_target(_id, leaves)
+            if self.active_pathways_pending[_id] > 0:
+                free_ids.discard(_id)
+            else:
+                stalled.append(_id)
+        self.timer.add('dispatch', t, count=sum(len(leaves) for (_id, leaves) in selected))
+        return stalled
+
+    def top_root_prices(self, target_id):
+        '''Sorted prices of the convergence_top_k cheapest solved reactions
+        of a target'''
+        prices = [R.price for CTA in self.Chemicals[target_id].template_idx_results.values()
+                  for R in CTA.reactions.values() if R.valid and R.price != -1]
+        return sorted(prices)[:self.convergence_top_k]
+
+    def root_visit_share(self, target_id):
+        '''Fraction of the visits of a target that went to its most visited
+        reaction, not counting the virtual losses of pathways in flight. 0
+        until the target has min_root_visits visits'''
+        C = self.Chemicals[target_id]
+        if C.children is None:
+            return 0.
+        rxn = np.unique(self.child_stats.child_rxn[C.children])
+        visits = self.child_stats.rxn_visits[rxn]
+        total = visits.sum()
+        if total < self.min_root_visits:
+            return 0.
+        return visits.max() / float(total)
+
+    def expanding_under(self, target_id):
+        '''Whether an expansion in flight, or a pathway waiting for one, can
+        still change a chemical that selection from target_id reaches'''
+        busy = set()
+        for (_id, pathway) in enumerate(self.active_pathways):
+            if self.active_pathways_pending[_id] > 0:
+                busy.update(pathway)
+        seen = set([target_id])
+        frontier = [target_id]
+        for depth in range(self.max_depth):
+            next_frontier = []
+            for chem_id in frontier:
+                if chem_id in busy:
+                    return True
+                for CTA in self.Chemicals[chem_id].template_idx_results.values():
+                    if CTA.waiting:
+                        return True
+                    for R in CTA.reactions.values():
+                        for reactant_id in R.reactant_ids:
+                            if reactant_id not in seen:
+                                seen.add(reactant_id)
+                                next_frontier.append(reactant_id)
+            frontier = next_frontier
+        return False
+
+    def add_outcome(self, _id, chem_smi, template_idx, reactants, filter_score,
+                    known_bad_reactions=[], forbidden_molecules=[]):
+        '''Adds one outcome of applying template_idx to chem_smi (as part of
+        the expansion of pathway _id) to the tree'''
+        # print('coord pulled {} result from result queue'.format(chem_smi))
+        if self.checkpoint is not None:
+            self.checkpoint_events.append(('outcome', chem_smi, template_idx, reactants, filter_score))
+        chem_id = self.chem_ids[chem_smi]
+        self.status[(chem_id, template_idx)] = DONE
+        if self.warm_start is not None:
+            self.expansion_results.setdefault(chem_id, {}).setdefault(template_idx, []).append((reactants, filter_score))
+        # R = self.Chemicals[chem_id].reactions[template_idx]
+        C = self.Chemicals[chem_id]
+        CTA = C.template_idx_results[template_idx] # TODO: make sure CTA created
+        CTA.waiting = False
+
+        # Any proposed reactants?
+        if len(reactants) == 0: 
+            C.invalidate(CTA, self.child_stats) # no precursors, reaction failed
+            # print('No reactants found for {} {}'.format(_id, chem_smi))
+            return
 
-                    # Banned molecule?
-                    if any(smi in forbidden_molecules for (smi, _, _, _) in reactants):
-                        CTA.valid = False 
-                        continue
+        # Get reactants SMILES
+        reactant_smiles = '.'.join([smi for (smi, _, _, _) in reactants])
 
-                    # TODO: check if banned reaction
-                    matched_prev = False
-                    for prev_tid, prev_cta in list(C.template_idx_results.items()):
-                        if reactant_smiles in prev_cta.reactions: 
-                            prev_R = prev_cta.reactions[reactant_smiles]
-                            matched_prev = True
-                            # Now merge the two...
-                            prev_R.tforms.append(template_idx)
-                            prev_R.template_score = max(C.prob[template_idx], prev_R.template_score)
-                            CTA.reactions[reactant_smiles] = prev_R
-                            break
-                    if matched_prev:
-                        continue # don't make a new reaction
-
-                    # Define reaction using product SMILES, template_idx, and reactants SMILES
-                    R = Reaction(chem_smi, template_idx)
-                    R.plausibility = filter_score # fast filter score
-                    R.template_score = C.prob[template_idx] # template relevance
-                    #for smi, prob, value in reactants:
-                    for (smi, top_probs, top_indeces, value) in reactants: # all precursors
-                        R.reactant_smiles.append(smi)
-                        if smi not in self.Chemicals:
-                            self.Chemicals[smi] = Chemical(smi)
-                            self.Chemicals[smi].set_template_relevance_probs(top_probs, top_indeces, value)
-                            
-                            ppg = self.pricer.lookup_smiles(smi, alreadyCanonical=True)
-                            self.Chemicals[smi].purchase_price = ppg
-                            # if ppg is not None and ppg > 0:
-                            #     self.Chemicals[smi].set_price(ppg)
-
-                            hist = self.chemhistorian.lookup_smiles(smi, alreadyCanonical=True)
-                            self.Chemicals[smi].as_reactant = hist['as_reactant']
-                            self.Chemicals[smi].as_product = hist['as_product']
-
-                            if self.is_a_terminal_node(smi, ppg, hist):
-                                self.Chemicals[smi].set_price(1) # all nodes treated the same for now
-                                self.Chemicals[smi].terminal = True
-                                self.Chemicals[smi].done = True 
-                                # print('TERMINAL: {}'.format(self.Chemicals[smi]))# DEBUG
-
-                    R.estimate_price = sum([self.Chemicals[smi].estimate_price for smi in R.reactant_smiles])
-
-                    # Add this reaction result to CTA (key = reactant smiles)
-                    CTA.reactions[reactant_smiles] = R
-                       
-            # See if this rollout is done (TODO: make this Celery compatible)
-            for _id in range(self.num_active_pathways):
-                if self.active_pathways_pending[_id] == 0: # this expansion step is done
-                    # This expansion step is done = record!
-                    self.update(self.smiles, self.active_pathways[_id])
-
-                    # Set new target
-                    leaves, pathway = self.select_leaf()
-                    self.active_pathways[_id] = pathway 
-                    self.set_initial_target(_id, leaves)
-
-
-            # if self.expansion_queue.empty() and self.results_queue.empty() and all(self.idle):
-            #     # print('All idle and queues empty')
-            #     self.update(self.smiles, self.active_pathway)
-            #     self.active_pathway = {}
-
-            # Set new target (THIS IS OLD)
-            # if len(self.active_pathway) == 0:
-            #     # print('Finding a new active pathway')
-            #     leaves, pathway = self.select_leaf()
-            #     self.active_pathway = pathway
-            #     self.set_initial_target(leaves)
-
-            # for _id in range(self.nproc):
-            #     if self.expansion_queues[_id].empty() and self.results_queues[_id].empty() and self.idle[_id]:
-            #         self.update(self.smiles, self.pathways[_id])
-            #         self.pathways[_id] = {}
-
-            # for _id in range(self.nproc):
-            #     if len(self.pathways[_id]) == 0:
-            #         leaves, pathway = self.select_leaf()
-            #         # if len(self.Chemicals) > 30:
-            #         # print('###############', _id, leaves, pathway)
-            #         self.pathways[_id] = pathway
-            #         self.set_initial_target(_id, leaves)
+        # Banned reaction?
+        if '{}>>{}'.format(reactant_smiles, chem_smi) in known_bad_reactions:
+            C.invalidate(CTA, self.child_stats)
+            return
 
-            elapsed_time = time.time() - start_time
+        # Banned molecule?
+        if any(smi in forbidden_molecules for (smi, _, _, _) in reactants):
+            C.invalidate(CTA, self.child_stats)
+            return
 
-            if self.Chemicals[self.smiles].price != -1 and self.time_for_first_path == -1:
-                self.time_for_first_path = elapsed_time
-                MyLogger.print_and_log('Found the first pathway after {:.2f} seconds'.format(elapsed_time), treebuilder_loc)
-                if return_first:
-                    MyLogger.print_and_log('Stoping expansion to return first pathway as requested', treebuilder_loc)
+        # TODO: check if banned reaction
+        # Reactions are keyed by their reactant IDs, so a match is only
+        # possible if all reactants are already in the tree
+        reactant_ids = tuple(self.chem_ids.get(smi) for (smi, _, _, _) in reactants)
+        matched_prev = False
+        if None not in reactant_ids:
+            for prev_tid, prev_cta in list(C.template_idx_results.items()):
+                if reactant_ids in prev_cta.reactions: 
+                    prev_R = prev_cta.reactions[reactant_ids]
+                    matched_prev = True
+                    # Now merge the two...
+                    prev_R.tforms.append(template_idx)
+                    prev_R.template_score = max(C.prob[template_idx], prev_R.template_score)
+                    if reactant_ids not in CTA.reactions:
+                        CTA.reactions[reactant_ids] = prev_R
+                        C.add_child(CTA, prev_R, self.child_stats)
                     break
-
-            if  all(pathway == {} for pathway in self.active_pathways) and len(self.pending_results) == 0:
-                MyLogger.print_and_log('Cannot expand any further! Stuck?', treebuilder_loc)
-                break
-
-        self.stop(soft_stop=soft_stop)
-
-        for _id in range(self.num_active_pathways):
-            self.update(self.smiles, self.active_pathways[_id])
-        self.active_pathways = [{} for _id in range(self.num_active_pathways)]
-        # print(self.active_pathway)
+        if matched_prev:
+            return # don't make a new reaction
+
+        # Define reaction using product ID, template_idx, and reactant IDs
+        R = Reaction(chem_id, template_idx)
+        R.plausibility = filter_score # fast filter score
+        R.template_score = C.prob[template_idx] # template relevance
+        # Price / look up all new precursors at once
+        new_smis = [smi for (smi, _, _, _) in reactants if smi not in self.chem_ids]
+        warm_entries = dict((smi, self.warm_start_entry(smi)) for smi in new_smis)
+        new_smis = [smi for smi in new_smis if warm_entries[smi] is None]
+        new_info = self.lookup_chemicals(new_smis)
+        #for smi, prob, value in reactants:
+        for (smi, top_probs, top_indeces, value) in reactants: # all precursors
+            if smi not in self.chem_ids:
+                new_id = self.add_chemical(smi)
+                new_C = self.Chemicals[new_id]
+                new_C.set_template_relevance_probs(top_probs, top_indeces, self.leaf_values.get(smi, value))
+
+                if warm_entries[smi] is not None:
+                    self.seed_chemical(new_id, warm_entries[smi])
+                    self.replay_solved(_id, new_id)
+                else:
+                    ppg, hist, terminal = new_info[smi]
+                    new_C.purchase_price = ppg
+                    # if ppg is not None and ppg > 0:
+                    #     new_C.set_price(ppg)
+
+                    new_C.as_reactant = hist['as_reactant']
+                    new_C.as_product = hist['as_product']
+
+                    if terminal:
+                        new_C.set_price(1) # all nodes treated the same for now
+                        new_C.terminal = True
+                        new_C.done = True 
+                        # print('TERMINAL: {}'.format(new_C))# DEBUG
+            R.reactant_ids.append(self.chem_ids[smi])
+
+        R.estimate_price = sum([self.Chemicals[i].estimate_price for i in R.reactant_ids])
+        for reactant_id in set(R.reactant_ids):
+            self.Chemicals[reactant_id].parents.append(R)
+
+        # Add this reaction result to CTA (key = reactant IDs) and
+        # to the child statistics UCB scores
+        C.add_reaction(R, self.child_stats)
+        CTA.reactions[tuple(R.reactant_ids)] = R
+        C.add_child(CTA, R, self.child_stats)
+        self.reaction_log.append(R)
+
+        # The reactants may already be solved elsewhere in the graph, known
+        # to be solved from an earlier search or solved for an earlier target
+        if (self.dag or self.warm_start is not None or self.batch_search) and self.refresh_reaction(R):
+            self.propagate(chem_id)
+
+    def estimate_leaf_values(self, groups):
+        '''Scores the chemicals that are new in one expansion result with the
+        leaf value estimator, all in one call. add_outcome starts the
+        estimated prices of the chemicals it creates from these values.
+        Returns the number of chemicals scored'''
+        new_smiles = {} # insertion-ordered set
+        for (_id, chem_smi, template_idx, reactants, filter_score) in itertools.chain.from_iterable(groups):
+            for (smi, _, _, _) in reactants:
+                if smi not in self.chem_ids:
+                    new_smiles[smi] = None
+        smiles_list = list(new_smiles)
+        if smiles_list:
+            self.leaf_values = dict(zip(smiles_list, map(float, self.value_estimator.estimate(smiles_list))))
+        else:
+            self.leaf_values = {}
+        return len(smiles_list)
 
     def work(self, i):
         # with tf.device('/gpu:%d' % (i % self.ngpus)):
@@ -455,90 +812,94 @@ class MCTS:
         self.retroTransformer.get_template_prioritizers(gc.relevance)
         self.initialized[i] = True
 
-        while True:
-            # If done, stop
-            if self.done.value:
-                # print 'Worker {} saw done signal, terminating'.format(i)
-                break
-            
-            # Grab something off the queue
-            if not self.expansion_queue.empty():
-                try:
-                    self.idle[i] = False
-                    (_id, smiles, template_idx) = self.expansion_queue.get(timeout=0.1)  # short timeout
-                
-                    # print('{} grabbed {} and {} from queue'.format(_id, smiles, template_idx))
-                    try:
-                        all_outcomes = self.retroTransformer.apply_one_template_by_idx(_id, smiles, template_idx) # TODO: add settings
-                    except Exception as e:
-                        print(e)
-                        all_outcomes = [(_id, smiles, template_idx, [], 0.0)]
-                    # print('{} applied one template and got {}'.format(i, all_outcomes))
-                    # all_outcomes = list of (_id, smiles, template_idx, reactants, filter_score)
-               
-                    
-                    self.results_queue.put(all_outcomes)
-                    # print('{} put {} outcomes on queue'.format(i, len(all_outcomes)))
-
-                except VanillaQueue.Empty:
-                    self.idle[i] = True
-                    pass # looks like someone got there first...
-
-            
-            # time.sleep(0.01)
+        timer = PhaseTimer()
+        idle_start = time.perf_counter()
+        while not self.done.value:
+            # Block until something is put on the queue; the timeout only
+            # serves to notice the done signal
+            try:
+                (_id, smiles, template_idxs, chunk_size) = self.expansion_queue.get(timeout=WORKER_TIMEOUT)
+            except VanillaQueue.Empty:
+                continue
+            self.idle[i] = False
+            start = timer.add('idle', idle_start)
+
+            # print('{} grabbed {} and {} from queue'.format(_id, smiles, template_idxs))
+            groups = []
+            returned = set()
+            try:
+                for all_outcomes in self.retroTransformer.iter_templates_by_idx(_id, smiles, template_idxs, chunk_size=chunk_size, stats=timer): # TODO: add settings
+                    groups.append(all_outcomes)
+                    returned.add(all_outcomes[0][2])
+                    if chunk_size and len(groups) == chunk_size:
+                        put_start = time.perf_counter()
+                        self.results_queue.put((_id, groups, False))
+                        timer.add('result_transfer', put_start)
+                        groups = []
+            except Exception as e:
+                print(e)
+                groups += [[(_id, smiles, template_idx, [], 0.0)] for template_idx in template_idxs if template_idx not in returned]
+            # all_outcomes = list of (_id, smiles, template_idx, reactants, filter_score)
+
+            put_start = time.perf_counter()
+            self.results_queue.put((_id, groups, True))
+            timer.add('result_transfer', put_start)
+            timer.add('expansion', start)
+            self.worker_phases[i] = timer.as_dict()
             self.idle[i] = True
+            idle_start = time.perf_counter()
 
-    def UCB(self, chem_smi, c_exploration=0.2, path=[]):
+    def UCB(self, chem_id, c_exploration=0.2, path=[]):
         '''
         Can either select an unapplied template to apply, or select a specific reactant to expand further (?)
-        TODO: check these changes...
-        '''
-        rxn_scores = []
 
-        C = self.Chemicals[chem_smi]
-        product_visits = C.visit_count
+        Scores every (template, reactants) child of the chemical at once from
+        its rows of the ChildStats arrays. Ties go to the child that comes
+        first in template application order, then to the unapplied template.
+        '''
+        C = self.Chemicals[chem_id]
+        product_visits = C.visit_count + C.virtual_loss
         max_estimate_price = 0
-
-        for template_idx in C.template_idx_results:
-            CTA = C.template_idx_results[template_idx] 
-            if CTA.waiting or not CTA.valid:
-                continue
-
-            for reactants_smi in CTA.reactions:
-                R = CTA.reactions[reactants_smi]
-
-                if len(set(R.reactant_smiles) & set(path)) > 0: # avoid cycles
-                    continue
-                if R.done:
-                    continue
-                max_estimate_price = max(max_estimate_price, R.estimate_price)
-                Q_sa = - R.estimate_price
-                try:
-                    U_sa = c_exploration * C.prob[template_idx] * np.sqrt(product_visits) / (1 + R.visit_count)
-                except:
-                    print((chem_smi, product_visits))
-                score = Q_sa + U_sa
-                rxn_scores.append((score, template_idx, reactants_smi))
+        best_score, selected_template_idx, selected_reactants_key = None, None, None
+
+        num_branches = 0
+        stats = self.child_stats
+        if C.children:
+            rows = np.array(C.children, dtype=np.int64)
+            rxn = stats.child_rxn[rows]
+            eligible = stats.child_valid[rows] & ~stats.rxn_done[rxn]
+            if path: # avoid cycles
+                eligible &= ~np.isin(stats.rxn_reactants[rxn], path).any(axis=1)
+            idx = np.flatnonzero(eligible)
+            num_branches = len(idx)
+
+            if num_branches:
+                rows = rows[idx]
+                rxn = rxn[idx]
+                estimates = stats.rxn_estimate[rxn]
+                max_estimate_price = max(max_estimate_price, float(estimates.max()))
+                Q_sa = - estimates
+                U_sa = stats.get_scaled_probs(c_exploration)[rows] * np.sqrt(product_visits) / (1 + stats.rxn_visits[rxn] + stats.rxn_virtual_loss[rxn])
+                scores = Q_sa + U_sa
+                scored = ~np.isnan(scores)
+                best = np.flatnonzero(scored)[scores[scored] == scores[scored].max()] if scored.any() else np.arange(1)
+                best = best[np.lexsort((best, stats.child_rank[rows[best]]))[0]]
+                best_score = float(scores[best])
+                (selected_template_idx, selected_reactants_key) = stats.child_keys[rows[best]]
 
         # unexpanded template - find most relevant template that hasn't been tried
-        num_branches = len(rxn_scores)
-        if num_branches < self.max_branching or chem_smi == self.smiles:
+        if num_branches < self.max_branching or chem_id == self.target_id:
             for template_idx in C.top_indeces: 
                 if template_idx not in C.template_idx_results:
                     Q_sa = - (max_estimate_price + 0.1)
                     U_sa = c_exploration * C.prob[template_idx] * np.sqrt(product_visits) / 1
                     score = Q_sa + U_sa
-                    rxn_scores.append((score, template_idx, None)) # record estimated score if we were to actually apply that template
-                    # TODO: figure out if this "None" makes sense for the reactants smiles 
+                    # record estimated score if we were to actually apply that template
+                    if best_score is None or score > best_score:
+                        best_score, selected_template_idx, selected_reactants_key = score, template_idx, None
                     break
 
-        if len(rxn_scores) > 0:
-            sorted_rxn_scores = sorted(rxn_scores, key=lambda x: x[0], reverse=True)
-            best_rxn_score, selected_template_idx, selected_reactants_smi = sorted_rxn_scores[0] # get next best template to apply
-        else:
-            selected_template_idx, selected_reactants_smi = None, None
-
-        return selected_template_idx, selected_reactants_smi
+        return selected_template_idx, selected_reactants_key
 
 
     def select_leaf(self, c_exploration=1.):
@@ -546,162 +907,322 @@ class MCTS:
         pathway = {}
         leaves = []
         queue = VanillaQueue.Queue()
-        queue.put((self.smiles, 0, [self.smiles]))
+        queue.put((self.target_id, 0, [self.target_id]))
 
         while not queue.empty():
-            chem_smi, depth, path = queue.get()
-            if depth >= self.max_depth or chem_smi in pathway: # don't go too deep or recursively
+            chem_id, depth, path = queue.get()
+            if depth >= self.max_depth or chem_id in pathway: # don't go too deep or recursively
                 continue
-            template_idx, reactants_smi = self.UCB(chem_smi, c_exploration=c_exploration, path=path)
+            template_idx, reactants_key = self.UCB(chem_id, c_exploration=c_exploration, path=path)
             if template_idx is None:
                 continue
+            template_idx = int(template_idx) # plain int, so pathways compare cleanly
             
-            # Only grow pathway when we have picked a specific reactants_smi (?)
-            if reactants_smi is not None:
-                pathway[chem_smi] = (template_idx, reactants_smi) # TODO: figure out if reactants_smi==None case is an issue
+            # Only grow pathway when we have picked a specific reactants_key (?)
+            if reactants_key is not None:
+                pathway[chem_id] = (template_idx, reactants_key) # TODO: figure out if reactants_key==None case is an issue
             else:
-                pathway[chem_smi] = template_idx # still record template selection
+                pathway[chem_id] = template_idx # still record template selection
             
-            C = self.Chemicals[chem_smi]
-            C.visit_count += VIRTUAL_LOSS
+            C = self.Chemicals[chem_id]
+            C.virtual_loss += VIRTUAL_LOSS
 
             # print('Looking at chemical C: {}'.format(C))
             if template_idx not in C.template_idx_results:
-                # print('Creating CTA for {} and {}'.format(chem_smi, template_idx))
-                C.template_idx_results[template_idx] = ChemicalTemplateApplication(chem_smi, template_idx)
-                CTA = C.template_idx_results[template_idx]
+                # print('Creating CTA for {} and {}'.format(chem_id, template_idx))
+                CTA = self.add_template_application(chem_id, template_idx)
 
                 # TODO: figure out VIRTUAL_LOSS for R.visit_count change?
-                # C.reactions[template_idx] = Reaction(chem_smi, template_idx)
+                # C.reactions[template_idx] = Reaction(chem_id, template_idx)
                 # R = C.reactions[template_idx]
                 # R.visit_count += VIRTUAL_LOSS
-                leaves.append((chem_smi, template_idx))
+                leaves.append((chem_id, template_idx))
+
+                # Claim the next most relevant untried templates as well, so
+                # they are applied in the same expansion of this chemical
+                num_claimed = 1
+                for next_template_idx in C.top_indeces:
+                    if num_claimed >= self.expansion_batch_size:
+                        break
+                    if next_template_idx not in C.template_idx_results:
+                        self.add_template_application(chem_id, next_template_idx)
+                        leaves.append((chem_id, next_template_idx))
+                        num_claimed += 1
 
             else:
-                # Can we assume that the reactants_smi exists in this CTA? I guess so...
+                # Can we assume that the reactants_key exists in this CTA? I guess so...
                 CTA = C.template_idx_results[template_idx]
 
-                if reactants_smi: # if we choose a specific reaction, not just a template...
-                    if reactants_smi in CTA.reactions:
+                if reactants_key: # if we choose a specific reaction, not just a template...
+                    if reactants_key in CTA.reactions:
 
-                        R = CTA.reactions[reactants_smi]
-                        R.visit_count += VIRTUAL_LOSS
+                        R = CTA.reactions[reactants_key]
+                        R.virtual_loss += VIRTUAL_LOSS
 
-                        for smi in R.reactant_smiles:
-                            assert smi in self.Chemicals
-                            # if self.Chemicals[smi].purchase_price == -1:
-                            if not self.Chemicals[smi].done:
-                                queue.put((smi, depth+1, path+[smi]))
+                        for reactant_id in R.reactant_ids:
+                            assert reactant_id < len(self.Chemicals)
+                            # if self.Chemicals[reactant_id].purchase_price == -1:
+                            if not self.Chemicals[reactant_id].done:
+                                queue.put((reactant_id, depth+1, path+[reactant_id]))
                         if R.done:
-                            C.visit_count += R.visit_count
-                            R.visit_count += R.visit_count
+                            visits = R.visit_count + R.virtual_loss
+                            C.visit_count += visits
+                            R.visit_count += visits
 
         return leaves, pathway
 
 
-    def update(self, chem_smi, pathway, depth=0):
+    def update(self, chem_id, pathway, depth=0):
+        '''Backs up an expansion step along pathway, starting from chem_id.
+        Chemicals are visited depth-first with an explicit stack: on the way
+        down the selected reaction's done flag is taken from its reactants,
+        and once all of its reactants have been updated its value estimate,
+        price and done flag are updated from theirs'''
         
         if depth == 0:
-            for smi in pathway:
-                if type(pathway[smi]) == tuple:
-                    (template_idx, reactants_smi) = pathway[smi]
+            for node_id in pathway:
+                if type(pathway[node_id]) == tuple:
+                    (template_idx, reactants_key) = pathway[node_id]
                 else:
-                    (template_idx, reactants_smi) = (pathway[smi], None)
-                C = self.Chemicals[smi]
+                    (template_idx, reactants_key) = (pathway[node_id], None)
+                C = self.Chemicals[node_id]
                 CTA = C.template_idx_results[template_idx]
-                C.visit_count -= (VIRTUAL_LOSS - 1)
-                if reactants_smi:
-                    R = CTA.reactions[reactants_smi]
-                    R.visit_count -= (VIRTUAL_LOSS - 1)
+                C.virtual_loss -= VIRTUAL_LOSS
+                C.visit_count += 1
+                self.dirty_chemicals.add(node_id)
+                if reactants_key:
+                    R = CTA.reactions[reactants_key]
+                    R.virtual_loss -= VIRTUAL_LOSS
+                    R.visit_count += 1
+                    self.dirty_reactions.add(R.index)
+
+        stack = [(chem_id, depth, None, None)] # R is None on the way down
+        while stack:
+            (chem_id, depth, CTA, R) = stack.pop()
+            C = self.Chemicals[chem_id]
+
+            if R is None:
+                if (chem_id not in pathway) or (depth >= self.max_depth):
+                    continue
 
-        if (chem_smi not in pathway) or (depth >= self.max_depth):
-            return
+                if type(pathway[chem_id]) == tuple:
+                    (template_idx, reactants_key) = pathway[chem_id]
+                else:
+                    (template_idx, reactants_key) = (pathway[chem_id], None)
 
-        if type(pathway[chem_smi]) == tuple:
-            (template_idx, reactants_smi) = pathway[chem_smi]
-        else:
-            (template_idx, reactants_smi) = (pathway[chem_smi], None)
-
-        C = self.Chemicals[chem_smi]
-        CTA = C.template_idx_results[template_idx]
-        if CTA.waiting: # haven't actually expanded
-            return 
-
-        if reactants_smi:
-            R = CTA.reactions[reactants_smi]
-            if R.valid and (not R.done):
-                R.done = all([self.Chemicals[smi].done for smi in R.reactant_smiles])
-
-                for smi in R.reactant_smiles:
-                    self.update(smi, pathway, depth+1)
-                
-                estimate_price = sum([self.Chemicals[smi].estimate_price for smi in R.reactant_smiles])
+                CTA = C.template_idx_results[template_idx]
+                if CTA.waiting: # haven't actually expanded
+                    continue
+
+                if reactants_key:
+                    R = CTA.reactions[reactants_key]
+                    if R.valid and (not R.done):
+                        R.done = all([self.Chemicals[reactant_id].done for reactant_id in R.reactant_ids])
+                        stack.append((chem_id, depth, CTA, R))
+                        for reactant_id in reversed(R.reactant_ids):
+                            stack.append((reactant_id, depth+1, None, None))
+                        continue
+
+            else:
+                estimate_price = sum([self.Chemicals[reactant_id].estimate_price for reactant_id in R.reactant_ids])
                 R.update_estimate_price(estimate_price)
                 C.update_estimate_price(estimate_price)
 
-                price_list = [self.Chemicals[smi].price for smi in R.reactant_smiles]
+                if self.dag: # share what was learned with the other routes to the reactants
+                    for reactant_id in set(R.reactant_ids):
+                        if reactant_id in pathway:
+                            self.propagate(reactant_id, skip=R)
+
+                price_list = [self.Chemicals[reactant_id].price for reactant_id in R.reactant_ids]
                 if all([price != -1 for price in price_list]):
                     price = sum(price_list)
                     R.price = price
                     if R.price < C.price or C.price == -1:
                         C.price = R.price
 
-        if sum(len(CTA.reactions) for tid,CTA in list(C.template_idx_results.items())) >= self.max_branching:
-            # print('{} hit max branching, checking if "done"'.format(chem_smi))
-            C.done = all([(R.done or (not R.valid)) for rsmi,R in list(CTA.reactions.items()) for tid,CTA in list(C.template_idx_results.items())])
+            if sum(len(CTA2.reactions) for CTA2 in C.template_idx_results.values()) >= self.max_branching:
+                # print('{} hit max branching, checking if "done"'.format(chem_id))
+                C.done = all([(R.done or (not R.valid)) for rsmi,R in list(CTA.reactions.items()) for tid,CTA2 in list(C.template_idx_results.items())])
 
         # if C.price != -1 and C.price < C.estimate_price:
         #   C.estimate_price = C.price
 
 
-    def full_update(self, chem_smi, depth=0, path=[]):
-
-        C = self.Chemicals[chem_smi]
-        C.pathway_count = 0
-
-        if C.terminal:
-            C.pathway_count = 1
-            return
-
-        if depth > self.max_depth:
-            return
-
-        prefix = '    '* depth
-
-        for template_idx in C.template_idx_results:
-            CTA = C.template_idx_results[template_idx]
-            for reactants_smi in CTA.reactions:
-                R = CTA.reactions[reactants_smi]
-                R.pathway_count = 0
-                if (not R.valid) or len(set(R.reactant_smiles) & set(path)) > 0:
+    def refresh_reaction(self, R):
+        '''Recomputes the solved state of reaction R from its reactants and
+        passes an improved price or a completed branch on to its product.
+        Returns True if the product changed'''
+        if not R.valid:
+            return False
+        C = self.Chemicals[R.chem_id]
+        self.dirty_chemicals.add(R.chem_id)
+        self.dirty_reactions.add(R.index)
+        changed = False
+        if not R.done and all(self.Chemicals[reactant_id].done for reactant_id in R.reactant_ids):
+            R.done = True
+            if not C.done and sum(len(CTA.reactions) for CTA in C.template_idx_results.values()) >= self.max_branching:
+                C.done = all((R2.done or (not R2.valid)) for CTA in C.template_idx_results.values() for R2 in CTA.reactions.values())
+                changed = C.done
+
+        price_list = [self.Chemicals[reactant_id].price for reactant_id in R.reactant_ids]
+        if all([price != -1 for price in price_list]):
+            R.price = sum(price_list)
+            if R.price < C.price or C.price == -1:
+                C.price = R.price
+                changed = True
+        return changed
+
+    def propagate(self, chem_id, skip=None):
+        '''DAG mode: a chemical is a single node shared by every reaction that
+        uses it, so after it is updated all of its parents are updated, not
+        just the one on the selected pathway (skip). Their value estimates
+        take the new reactant estimates as a sample, and solved state (done,
+        price) keeps propagating up through the ancestors for as long as it
+        changes. Each chemical is visited at most once, so cycles in the
+        graph terminate.'''
+        visited = set([chem_id])
+        queue = [chem_id]
+        while queue:
+            node_id = queue.pop()
+            for R in self.Chemicals[node_id].parents:
+                if R is skip or not R.valid:
                     continue
-                for smi in R.reactant_smiles:
-                    self.full_update(smi, depth+1, path+[chem_smi])
-                price_list = [self.Chemicals[smi].price for smi in R.reactant_smiles]
-                if all([price != -1 for price in price_list]):
-                    price = sum(price_list)
-                    R.price = price
-                    if R.price < C.price or C.price == -1:
-                        C.price = R.price
-                        C.best_template = template_idx
-                    R.pathway_count = np.prod([self.Chemicals[smi].pathway_count for smi in R.reactant_smiles])
-                    # if R.pathway_count != 0:
-                    #   print(prefix + '  Reac %d: '%template_idx + str(R.reactant_smiles) + ' %d paths'%R.pathway_count)
-                else:
-                    R.pathway_count = 0
-
-                # print(prefix + str(R.reactant_smiles) + ' - %d' % R.pathway_count)
-
-        C.pathway_count = 0
-        for tid,CTA in list(C.template_idx_results.items()):
-            for rct_smi,R in list(CTA.reactions.items()):
-                C.pathway_count += R.pathway_count
-
-        # if C.pathway_count != 0:
-        #   print(prefix + chem_smi + ' %d paths, price: %.1f' % (C.pathway_count, C.price))
-
+                if node_id == chem_id and not R.done:
+                    self.dirty_reactions.add(R.index)
+                    R.update_estimate_price(sum([self.Chemicals[reactant_id].estimate_price for reactant_id in R.reactant_ids]))
+                if self.refresh_reaction(R) and R.chem_id not in visited:
+                    visited.add(R.chem_id)
+                    queue.append(R.chem_id)
+
+    def strong_components(self, chem_id):
+        '''Strongly connected component of every chemical reachable from
+        chem_id through valid reactions of non-terminal chemicals, as
+        chem_id -> ID of a chemical of its component (Tarjan's algorithm
+        with an explicit stack)'''
+        def successors(chem_id):
+            C = self.Chemicals[chem_id]
+            if C.terminal:
+                return
+            for CTA in C.template_idx_results.values():
+                for R in CTA.reactions.values():
+                    if R.valid:
+                        for reactant_id in R.reactant_ids:
+                            yield reactant_id
+
+        counter = itertools.count()
+        index = {chem_id: next(counter)}
+        lowlink = {chem_id: index[chem_id]}
+        component = {}
+        stack = [chem_id]
+        work = [(chem_id, successors(chem_id))]
+        while work:
+            (node_id, children) = work[-1]
+            for child_id in children:
+                if child_id not in index:
+                    index[child_id] = lowlink[child_id] = next(counter)
+                    stack.append(child_id)
+                    work.append((child_id, successors(child_id)))
+                    break
+                elif child_id not in component: # still on the stack
+                    lowlink[node_id] = min(lowlink[node_id], index[child_id])
+            else:
+                work.pop()
+                if work:
+                    parent_id = work[-1][0]
+                    lowlink[parent_id] = min(lowlink[parent_id], lowlink[node_id])
+                if lowlink[node_id] == index[node_id]:
+                    while True:
+                        member_id = stack.pop()
+                        component[member_id] = node_id
+                        if member_id == node_id:
+                            break
+        return component
+
+    def full_update(self, chem_id, depth=0, path=[]):
+        '''Recomputes prices, best templates and pathway counts below chem_id,
+        reached at depth with the chemicals of path above it. Reactions back
+        to a chemical on the route are skipped, so what is below a chemical
+        depends on its depth and on those of its ancestors it can reach
+        again, which are the ancestors in its strongly connected component.
+        Each such state is computed once, after the states of its reactants,
+        using an explicit stack. In an acyclic graph the state is just
+        (chemical, depth), so shared subtrees are not walked again for every
+        route leading to them'''
+        component = self.strong_components(chem_id)
+        # Components of more than one chemical; a chemical alone in its
+        # component is never below itself
+        cyclic = set(component[member_id] for member_id in component if component[member_id] != member_id)
+        def state(chem_id, depth, path):
+            if component[chem_id] not in cyclic:
+                return (chem_id, depth, frozenset())
+            return (chem_id, depth, frozenset(ancestor_id for ancestor_id in path
+                                              if component.get(ancestor_id) == component[chem_id]))
+
+        counts = {} # state -> pathway count
+        stack = [(chem_id, depth, tuple(path), False)]
+        while stack:
+            (chem_id, depth, path, expanded) = stack.pop()
+            C = self.Chemicals[chem_id]
+            key = state(chem_id, depth, path)
+
+            if not expanded:
+                if key in counts:
+                    continue
+                self.dirty_chemicals.add(chem_id)
+                if C.terminal:
+                    C.pathway_count = 1
+                    counts[key] = 1
+                    continue
+                if depth > self.max_depth:
+                    C.pathway_count = 0
+                    counts[key] = 0
+                    continue
+                # Reactants first, in the order the reactions are visited
+                stack.append((chem_id, depth, path, True))
+                ancestors = set(path)
+                children = []
+                for CTA in C.template_idx_results.values():
+                    for R in CTA.reactions.values():
+                        if R.valid and ancestors.isdisjoint(R.reactant_ids):
+                            children.extend(R.reactant_ids)
+                for reactant_id in reversed(children):
+                    if state(reactant_id, depth+1, path + (chem_id,)) not in counts:
+                        stack.append((reactant_id, depth+1, path + (chem_id,), False))
+                continue
 
-    def build_tree(self, soft_stop=False, known_bad_reactions=[], forbidden_molecules=[], return_first=False):
+            if key in counts:
+                continue
+            C.pathway_count = 0
+            ancestors = set(path)
+            for template_idx in C.template_idx_results:
+                CTA = C.template_idx_results[template_idx]
+                for reactants_key in CTA.reactions:
+                    R = CTA.reactions[reactants_key]
+                    R.pathway_count = 0
+                    self.dirty_reactions.add(R.index)
+                    if (not R.valid) or not ancestors.isdisjoint(R.reactant_ids):
+                        continue
+                    price_list = [self.Chemicals[reactant_id].price for reactant_id in R.reactant_ids]
+                    if all([price != -1 for price in price_list]):
+                        price = sum(price_list)
+                        R.price = price
+                        if R.price < C.price or C.price == -1:
+                            C.price = R.price
+                            C.best_template = template_idx
+                        R.pathway_count = 1
+                        for reactant_id in R.reactant_ids:
+                            R.pathway_count *= counts[state(reactant_id, depth+1, path + (chem_id,))]
+                    C.pathway_count += R.pathway_count
+            counts[key] = C.pathway_count
+
+
+    def build_tree(self, targets, concurrent_targets=1, max_graph_chemicals=None, soft_stop=False,
+                   known_bad_reactions=[], forbidden_molecules=[], return_first=False):
+        '''Searches targets, an iterable of (smiles, expansion_time) pairs, up
+        to concurrent_targets of them at a time (see coordinate). Yields the
+        TargetSearch of each target once it has stopped and its pathway counts
+        and prices have had their final update; it is then the current target
+        of return_trees and search_report'''
 
         self.running = True
 
@@ -714,47 +1235,316 @@ class MCTS:
 
             MyLogger.print_and_log('Preparing workers...', treebuilder_loc)
             self.prepare()
-            
-            # Define first chemical node (target)
-            probs, indeces = self.template_prioritizer.get_topk_from_smi(self.smiles, k=self.template_count)
+            if not self.celery:
+                self.worker_baseline = self.worker_phases[:]
+
+            # Coordinate workers.
+            for search in self.coordinate(iter(targets), concurrent_targets=concurrent_targets,
+                                          max_graph_chemicals=max_graph_chemicals, soft_stop=soft_stop,
+                                          known_bad_reactions=known_bad_reactions,
+                                          forbidden_molecules=forbidden_molecules, return_first=return_first):
+
+                # Do a final pass to get counts
+                MyLogger.print_and_log('Doing final update of pathway counts / prices', treebuilder_loc)
+                start = time.perf_counter()
+                self.full_update(search.target_id)
+                self.timer.add('final_update', start)
+                self.set_current_target(search)
+                C = self.Chemicals[search.target_id]
+
+                print("Finished working.")
+                print(("=== found %d pathways (overcounting duplicate templates)" % C.pathway_count))
+                print(("=== time for fist pathway: %.2fs" % search.time_for_first_path))
+                print(("=== min price: %.1f" % C.price))
+                print("---------------------------")
+                yield search
+
+    def start_search(self, smiles, expansion_time, ids):
+        '''Starts the search for a target on the active pathways ids: its root
+        is restored from a checkpoint, found in the graph or added to it, and
+        the first of the pathways makes its first selection. Returns its
+        TargetSearch'''
+        if self.restored is not None:
+            self.restore_checkpoint(*self.restored)
+            self.restart_pending()
+            MyLogger.print_and_log('Set initial leaves for active pathways', treebuilder_loc)
+            return TargetSearch(smiles, self.target_id, ids, expansion_time,
+                                elapsed_offset=self.elapsed_offset, time_for_first_path=self.time_for_first_path)
+
+        MyLogger.print_and_log('Starting search for {}'.format(smiles), treebuilder_loc)
+        if smiles in self.chem_ids:
+            # Already reached while searching another target of a batch
+            self.target_id = self.chem_ids[smiles]
+        else:
+            self.add_target(smiles)
+        C = self.Chemicals[self.target_id]
+
+        if self.checkpoint is not None:
+            self.checkpoint.start({
+                'settings': self.search_settings,
+                'target': (smiles, C.top_probs, C.top_indeces, C.value, C.purchase_price,
+                           {'as_reactant': C.as_reactant, 'as_product': C.as_product}),
+            })
+
+        # First selection. Its virtual loss is only added once, so only
+        # one pathway may hold it; the others select their own leaves
+        # in the coordination loop
+        leaves, pathway = self.select_leaf()
+        self.active_pathways[ids[0]] = pathway
+        self.set_initial_target(ids[0], leaves)
+        self.replay_solved(ids[0], self.target_id)
+        MyLogger.print_and_log('Set initial leaves for active pathways', treebuilder_loc)
+        return TargetSearch(smiles, self.target_id, ids, expansion_time)
+
+    def set_current_target(self, search):
+        '''Makes the target of a TargetSearch the one return_trees and
+        search_report are about'''
+        self.smiles = search.smiles
+        self.target_id = search.target_id
+        self.expansion_time = search.expansion_time
+        self.time_for_first_path = search.time_for_first_path
+        self.termination_reason = search.termination_reason
+
+    def add_target(self, smiles):
+        '''Creates the chemical node of the target, using the template
+        prioritizer, pricer and historian on it directly'''
+        self.target_id = self.add_chemical(smiles)
+        C = self.Chemicals[self.target_id]
+        entry = self.warm_start_entry(smiles)
+        if entry is not None:
+            MyLogger.print_and_log('Seeding target from warm start store', treebuilder_loc)
+            C.set_template_relevance_probs(entry['top_probs'], entry['top_indeces'], entry['value'])
+            self.seed_chemical(self.target_id, entry)
+        else:
+            start = time.perf_counter()
+            probs, indeces = self.template_prioritizer.get_topk_from_smi(smiles, k=self.template_count)
             truncate_to = np.argwhere(np.cumsum(probs) >= self.max_cum_template_prob)
             if len(truncate_to):
                 truncate_to = truncate_to[0][0] + 1 # Truncate based on max_cum_prob?
             else:
                 truncate_to = self.template_count
             value = 1 # current value assigned to precursor (note: may replace with real value function)
-            self.Chemicals[self.smiles] = Chemical(self.smiles)
-            self.Chemicals[self.smiles].set_template_relevance_probs(probs[:truncate_to], indeces[:truncate_to], value)
+            C.set_template_relevance_probs(probs[:truncate_to], indeces[:truncate_to], value)
             MyLogger.print_and_log('Calculating initial probs for target', treebuilder_loc)
-            hist = self.chemhistorian.lookup_smiles(self.smiles, alreadyCanonical=False)
-            self.Chemicals[self.smiles].as_reactant = hist['as_reactant']
-            self.Chemicals[self.smiles].as_product = hist['as_product']
-            ppg = self.pricer.lookup_smiles(self.smiles, alreadyCanonical=False)
-            self.Chemicals[self.smiles].purchase_price = ppg
-
-            # First selection is all the same
-            leaves, pathway = self.select_leaf()
-            for _id in range(self.num_active_pathways):
-                self.active_pathways[_id] = pathway
-                self.set_initial_target(_id, leaves)
-            MyLogger.print_and_log('Set initial leaves for active pathways', treebuilder_loc)
-            
-            # Coordinate workers.
-            self.coordinate(soft_stop=soft_stop, known_bad_reactions=known_bad_reactions,
-                forbidden_molecules=forbidden_molecules, return_first=return_first)
-
-            # Do a final pass to get counts
-            MyLogger.print_and_log('Doing final update of pathway counts / prices', treebuilder_loc)
-            self.full_update(self.smiles)
-            C = self.Chemicals[self.smiles]
-
-        print("Finished working.")
-        print(("=== found %d pathways (overcounting duplicate templates)" % C.pathway_count))
-        print(("=== time for fist pathway: %.2fs" % self.time_for_first_path))
-        print(("=== min price: %.1f" % C.price))
-        print("---------------------------")
-        return # self.Chemicals, C.pathway_count, self.time_for_first_path
-
+            start = self.timer.add('template_prioritization', start)
+            hist = self.chemhistorian.lookup_smiles(smiles, alreadyCanonical=False)
+            C.as_reactant = hist['as_reactant']
+            C.as_product = hist['as_product']
+            ppg = self.pricer.lookup_smiles(smiles, alreadyCanonical=False)
+            C.purchase_price = ppg
+            self.timer.add('chemical_lookup', start)
+
+    def warm_start_entry(self, smiles):
+        '''Warm start store entry for a chemical under the current settings,
+        or None'''
+        if self.warm_start is None:
+            return None
+        return self.warm_start.get(self.warm_start_key, smiles)
+
+    def seed_chemical(self, chem_id, entry):
+        '''Initializes a new chemical from its warm start entry instead of the
+        pricer and historian. Its stored expansions will be served without
+        going to the workers, and a chemical known to be a dead end (fully
+        expanded without a price) is marked done right away'''
+        C = self.Chemicals[chem_id]
+        self.dirty_chemicals.add(chem_id)
+        if self.checkpoint is not None:
+            self.checkpoint_events.append(('chemical', C.smiles, (entry['purchase_price'],
+                {'as_reactant': entry['as_reactant'], 'as_product': entry['as_product']}, entry['terminal'])))
+        C.purchase_price = entry['purchase_price']
+        C.as_reactant = entry['as_reactant']
+        C.as_product = entry['as_product']
+        if entry['estimate_price'] != -1:
+            C.update_estimate_price(entry['estimate_price'])
+        if entry['terminal']:
+            C.set_price(1) # all nodes treated the same for now
+            C.terminal = True
+            C.done = True
+        elif entry['done'] and entry['price'] == -1 and chem_id != self.target_id:
+            C.done = True
+        self.warm_entries[chem_id] = entry
+
+    def replay_solved(self, _id, chem_id):
+        '''Applies the templates that solved a chemical in an earlier search
+        (as pathway _id), so known routes are rebuilt without waiting for
+        selection to find them again'''
+        entry = self.warm_entries.get(chem_id)
+        if entry is None or entry['terminal'] or entry['price'] == -1:
+            return
+        C = self.Chemicals[chem_id]
+        template_idxs = [template_idx for template_idx in entry['solved_templates']
+                         if template_idx not in C.template_idx_results and template_idx in entry['expansions']]
+        for template_idx in template_idxs:
+            self.add_template_application(chem_id, template_idx)
+        # Not part of the expansion step of pathway _id, so it does not wait for these
+        self.expand_from_warm_start(_id, chem_id, template_idxs, final=False)
+
+    def expand_from_warm_start(self, _id, chem_id, template_idxs, final=True):
+        '''Queues the stored outcomes of any of the templates that were already
+        applied to this chemical in an earlier search; returns the templates
+        that still need a worker. Only final results count towards the
+        expansions pathway _id is waiting for'''
+        entry = self.warm_entries.get(chem_id)
+        if entry is None:
+            return template_idxs
+        expansions = entry['expansions']
+        smiles = self.Chemicals[chem_id].smiles
+        groups = [[(_id, smiles, template_idx, reactants, filter_score) for (reactants, filter_score) in expansions[template_idx]]
+                  for template_idx in template_idxs if template_idx in expansions]
+        if groups:
+            self.cached_results.append((_id, groups, final))
+            for template_idx in template_idxs:
+                if template_idx in expansions:
+                    self.status[(chem_id, template_idx)] = WAITING
+            if final:
+                self.active_pathways_pending[_id] += 1
+        return [template_idx for template_idx in template_idxs if template_idx not in expansions]
+
+    def record_warm_start(self):
+        '''Adds what this search learned about each of its chemicals to the
+        warm start store'''
+        for (chem_id, C) in enumerate(self.Chemicals):
+            solved_templates = [template_idx for (template_idx, CTA) in C.template_idx_results.items()
+                                if CTA.valid and any(R.price != -1 for R in CTA.reactions.values())]
+            self.warm_start.put(self.warm_start_key, C.smiles, {
+                'top_probs': C.top_probs,
+                'top_indeces': C.top_indeces,
+                'value': C.value,
+                'purchase_price': C.purchase_price,
+                'as_reactant': C.as_reactant,
+                'as_product': C.as_product,
+                'terminal': C.terminal,
+                'price': C.price,
+                'done': C.done,
+                'estimate_price': C.estimate_price,
+                'visit_count': C.visit_count,
+                'expansions': self.expansion_results.get(chem_id, {}),
+                'solved_templates': solved_templates,
+            })
+
+    def write_checkpoint(self, search):
+        '''Appends the events since the last checkpoint and the statistics of
+        the nodes added or updated since then, with the expansion time and
+        time to the first path of the TargetSearch. The virtual losses of the
+        pathways that are still being expanded are not saved, as those
+        expansions restart on resume'''
+        start = time.perf_counter()
+        # The nodes of the active pathways were changed by their selection
+        for pathway in self.active_pathways:
+            for (chem_id, selection) in pathway.items():
+                self.dirty_chemicals.add(chem_id)
+                if type(selection) == tuple:
+                    (template_idx, reactants_key) = selection
+                    R = self.Chemicals[chem_id].template_idx_results[template_idx].reactions.get(reactants_key)
+                    if R is not None:
+                        self.dirty_reactions.add(R.index)
+        chemical_rows = dirty_rows(self.dirty_chemicals, self.checkpoint.num_chemicals, len(self.Chemicals))
+        reaction_rows = dirty_rows(self.dirty_reactions, self.checkpoint.num_reactions, len(self.reaction_log))
+        chemical_stats = stats_columns(self.Chemicals, CHEMICAL_STATS, chemical_rows)
+        reaction_stats = stats_columns(self.reaction_log, REACTION_STATS, reaction_rows)
+        self.checkpoint.write(self.checkpoint_events, chemical_rows, chemical_stats, reaction_rows, reaction_stats,
+                              elapsed=search.elapsed_offset + search.elapsed(), time_for_first_path=search.time_for_first_path)
+        self.checkpoint_events = []
+        self.dirty_chemicals = set()
+        self.dirty_reactions = set()
+        self.last_checkpoint = time.time()
+        self.timer.add('checkpoint', start)
+
+    def restore_checkpoint(self, header, records):
+        '''Rebuilds the tree saved in a checkpoint: the recorded events are
+        replayed through the code that built it, using the recorded lookups,
+        then the last saved statistics of every node are applied'''
+        settings = header['settings']
+        (smiles, top_probs, top_indeces, value, ppg, hist) = header['target']
+        self.target_id = self.add_chemical(smiles)
+        C = self.Chemicals[self.target_id]
+        C.set_template_relevance_probs(top_probs, top_indeces, value)
+        C.purchase_price = ppg
+        C.as_reactant = hist['as_reactant']
+        C.as_product = hist['as_product']
+
+        # Replay without the warm start store, the recorded events already
+        # include what was taken from it
+        (checkpoint, self.checkpoint) = (self.checkpoint, None)
+        (warm_start, self.warm_start) = (self.warm_start, None)
+        for record in records:
+            for event in record['events']:
+                if event[0] == 'chemical':
+                    self.restored_chemicals[event[1]] = event[2]
+        for record in records:
+            for event in record['events']:
+                if event[0] == 'template':
+                    self.add_template_application(event[1], event[2])
+                elif event[0] == 'outcome':
+                    self.add_outcome(0, *event[1:], known_bad_reactions=settings['known_bad_reactions'],
+                                     forbidden_molecules=settings['forbidden_molecules'])
+        self.checkpoint = checkpoint
+        self.warm_start = warm_start
+        self.restored_chemicals = {}
+
+        (num_chemicals, chemical_stats) = final_stats(records, 'chemical', CHEMICAL_STATS)
+        (num_reactions, reaction_stats) = final_stats(records, 'reaction', REACTION_STATS)
+        apply_stats(self.Chemicals, CHEMICAL_STATS, range(num_chemicals), chemical_stats)
+        apply_stats(self.reaction_log, REACTION_STATS, range(num_reactions), reaction_stats)
+        self.dirty_chemicals = set()
+        self.dirty_reactions = set()
+        if records:
+            self.elapsed_offset = records[-1]['elapsed']
+            self.time_for_first_path = records[-1]['time_for_first_path']
+        if self.checkpoint is not None:
+            self.checkpoint.resume(num_chemicals, num_reactions)
+        MyLogger.print_and_log('Restored {} chemicals and {} reactions from checkpoint'.format(
+            len(self.Chemicals), len(self.reaction_log)), treebuilder_loc)
+
+    def restart_pending(self):
+        '''Sends the template applications that were still being expanded when
+        the checkpoint was written back to the workers'''
+        pending = {}
+        for (chem_id, C) in enumerate(self.Chemicals):
+            template_idxs = [template_idx for (template_idx, CTA) in C.template_idx_results.items() if CTA.waiting]
+            if template_idxs:
+                pending[chem_id] = template_idxs
+        for (i, (chem_id, template_idxs)) in enumerate(pending.items()):
+            self.expand(i % self.num_active_pathways, chem_id, template_idxs)
+        MyLogger.print_and_log('Restarted {} pending expansions'.format(len(pending)), treebuilder_loc)
+
+    def add_template_application(self, chem_id, template_idx):
+        '''Creates the node for applying template_idx to a chemical'''
+        C = self.Chemicals[chem_id]
+        CTA = ChemicalTemplateApplication(chem_id, template_idx, rank=len(C.template_idx_results))
+        C.template_idx_results[template_idx] = CTA
+        if self.checkpoint is not None:
+            self.checkpoint_events.append(('template', chem_id, template_idx))
+        return CTA
+
+    def lookup_chemicals(self, smiles_list):
+        '''Price, history and terminal status of new chemicals, as a dict of
+        smiles -> (ppg, hist, terminal). Chemicals restored from a checkpoint
+        reuse the recorded values instead of being looked up again'''
+        start = time.perf_counter()
+        new_smis = [smi for smi in smiles_list if smi not in self.restored_chemicals]
+        info = {}
+        for (smi, ppg, hist) in zip(new_smis,
+                                    self.pricer.lookup_many(new_smis, alreadyCanonical=True),
+                                    self.chemhistorian.lookup_many(new_smis, alreadyCanonical=True)):
+            info[smi] = (ppg, hist, self.is_a_terminal_node(smi, ppg, hist))
+        for smi in smiles_list:
+            if smi in self.restored_chemicals:
+                info[smi] = self.restored_chemicals[smi]
+        if self.checkpoint is not None:
+            for smi in smiles_list:
+                (ppg, hist, terminal) = info[smi]
+                self.checkpoint_events.append(('chemical', smi, (ppg, {'as_reactant': hist['as_reactant'], 'as_product': hist['as_product']}, terminal)))
+        self.timer.add('chemical_lookup', start, count=len(new_smis))
+        return info
+
+    def add_chemical(self, smiles):
+        '''Interns a SMILES string, creating its Chemical node. Returns the
+        integer ID used to refer to it everywhere else in the tree'''
+        chem_id = len(self.Chemicals)
+        self.chem_ids[smiles] = chem_id
+        self.Chemicals.append(Chemical(smiles))
+        return chem_id
 
     def tree_status(self):
         """Summarize size of tree after expansion
@@ -777,6 +1567,7 @@ class MCTS:
             # general parameters in celery format
             # TODO: anything goes here?
             self.pending_results = []
+            self.streamed_counts = {} # task id -> number of groups already streamed
         else:
             
             if not soft_reset:
@@ -786,9 +1577,11 @@ class MCTS:
                 self.done = self.manager.Value('i', 0)
                 self.idle = self.manager.list()
                 self.initialized = self.manager.list()
+                self.worker_phases = self.manager.list() # PhaseTimer totals of each worker since it started
                 for i in range(self.nproc):
                     self.idle.append(True)
                     self.initialized.append(False)
+                    self.worker_phases.append({})
                 self.expansion_queue = Queue()
                 self.results_queue = Queue()
             else:
@@ -807,26 +1600,125 @@ class MCTS:
                 except VanillaQueue.Empty:
                     pass
 
+        self.reset_tree()
+
+    def reset_tree(self):
+        '''Clears the search tree and pathway bookkeeping'''
         self.running = False  
         self.status = {}
         self.active_pathways = [{} for _id in range(self.num_active_pathways)]
         self.active_pathways_pending = [0 for _id in range(self.num_active_pathways)]
+        self.pathway_targets = [None for _id in range(self.num_active_pathways)] # target chemical ID each active pathway selects under
         self.pathway_count = 0 
         self.mincost = 10000.0        
-        self.Chemicals = {} # new
+        self.Chemicals = [] # indexed by chemical ID
+        self.chem_ids = {} # SMILES -> chemical ID
+        self.target_id = 0
         self.Reactions = {} # new
+        self.warm_entries = {} # chemical ID -> warm start entry it was seeded from
+        self.cached_results = [] # expansion results served from the warm start store
+        self.expansion_results = {} # chemical ID -> template_idx -> outcomes, recorded for the warm start store
+        self.reaction_log = [] # Reactions in creation order
+        self.child_stats = ChildStats() # UCB statistics of every reaction in the tree
+        self.restored_chemicals = {} # SMILES -> (ppg, hist, terminal) recorded in a checkpoint
+        self.leaf_values = {} # SMILES -> leaf value estimate of the chemicals of the expansion result being added
+        self.checkpoint_events = [] # events since the last checkpoint
+        self.dirty_chemicals = set() # IDs of the chemicals updated since the last checkpoint
+        self.dirty_reactions = set() # reaction_log indices of the reactions updated since then
+        self.last_checkpoint = time.time()
+        self.elapsed_offset = 0. # expansion time spent before the search was resumed
         self.time_for_first_path = -1
+        self.reset_report()
+
+    def reset_report(self):
+        '''Clears the timers and queue samples of the search report'''
+        self.timer = PhaseTimer() # coordinator phases
+        self.worker_timer = PhaseTimer() # phases of the Celery tasks of this search
+        self.worker_baseline = [] # worker_phases at the start of this search
+        self.queue_samples = []
+        self.search_start = time.time()
+
+    def sample_queues(self, elapsed_time):
+        '''Records the number of expansions in flight and, with local workers,
+        the expansions still queued and the number of idle workers'''
+        (queued, idle_workers) = (None, None)
+        if not self.celery:
+            try:
+                queued = self.expansion_queue.qsize()
+            except NotImplementedError: # not available on macOS
+                pass
+            idle_workers = sum(self.idle[:])
+        self.queue_samples.append({
+            'elapsed': elapsed_time,
+            'in_flight': sum(self.active_pathways_pending),
+            'queued': queued,
+            'idle_workers': idle_workers,
+        })
+
+    def search_report(self):
+        '''Counters and timers of the last search, as a dict of JSON types
+        (see instrumentation.export_report). Phases map to {'count': items
+        processed, 'seconds': wall time}. Coordinator phases do not overlap,
+        except chemical_lookup, which is part of add_outcomes once the
+        search runs. Worker phases are summed over all workers; template
+        application, fast filter and template prioritization are part of
+        expansion, and idle is the time spent waiting for work'''
+        if self.celery:
+            per_worker = None
+            workers = self.worker_timer.as_dict()
+        else:
+            per_worker = [subtract_phases(after, before) for (after, before) in
+                          itertools.zip_longest(self.worker_phases[:], self.worker_baseline, fillvalue={})]
+            combined = PhaseTimer()
+            for phases in per_worker:
+                combined.merge(phases)
+            workers = combined.as_dict()
+        return {
+            'target': self.smiles,
+            'expansion_time': self.expansion_time,
+            'wall_time': time.time() - self.search_start,
+            'time_for_first_path': self.time_for_first_path,
+            'termination_reason': self.termination_reason,
+            'num_chemicals': len(self.Chemicals),
+            'num_reactions': len(self.reaction_log),
+            'num_template_applications': len(self.status),
+            'coordinator': self.timer.as_dict(),
+            'workers': workers,
+            'per_worker': per_worker,
+            'queue_samples': self.queue_samples,
+            'queue_summary': dict((field, summarize_samples(self.queue_samples, field))
+                                  for field in ('in_flight', 'queued', 'idle_workers')),
+        }
+
+    def clear_graph(self):
+        '''Starts a batch over with an empty graph, once the expansions still
+        in flight are done. What the graph learned goes to the warm start
+        store first'''
+        MyLogger.print_and_log('Clearing graph of {} chemicals'.format(len(self.Chemicals)), treebuilder_loc)
+        self.drain()
+        if self.warm_start is not None:
+            self.record_warm_start()
+        self.reset_tree()
+
+    def drain(self):
+        '''Waits for the expansions still in flight and discards their results'''
+        self.cached_results = []
+        while sum(self.active_pathways_pending) > 0:
+            for (_id, groups, final) in self.wait_for_results(COORDINATOR_TIMEOUT):
+                if final:
+                    self.active_pathways_pending[_id] -= 1
 
 
     def return_trees(self):
 
-        def cheminfodict(smi):
+        def cheminfodict(chem_id):
             '''Prepares extra info'''
+            C = self.Chemicals[chem_id]
             return {
-                'smiles': smi,
-                'ppg': self.Chemicals[smi].purchase_price,
-                'as_reactant': self.Chemicals[smi].as_reactant,
-                'as_product': self.Chemicals[smi].as_product,
+                'smiles': C.smiles,
+                'ppg': C.purchase_price,
+                'as_reactant': C.as_reactant,
+                'as_product': C.as_product,
             }
 
         def tidlisttoinfodict(tids):
@@ -843,163 +1735,158 @@ class MCTS:
                 seen_rxnsmiles[smi] = self.current_index
                 self.current_index += 1
             return seen_rxnsmiles[smi]
-        seen_chemsmiles = {}
-        def chemsmiles_to_id(smi):
-            if smi not in seen_chemsmiles:
-                seen_chemsmiles[smi] = self.current_index
+        seen_chem_ids = {}
+        def chem_id_to_id(chem_id):
+            if chem_id not in seen_chem_ids:
+                seen_chem_ids[chem_id] = self.current_index
                 self.current_index += 1
-            return seen_chemsmiles[smi]
-
-        def IDDFS():
-            """Perform an iterative deepening depth-first search to find buyable
-            pathways.
-                        
-            Yields:
-                nested dictionaries defining synthesis trees
-            """
-            for path in DLS_chem(self.smiles, depth=0, headNode=True):
-                yield chem_dict(chemsmiles_to_id(self.smiles), children=path, **cheminfodict(self.smiles))
-
-        def DLS_chem(chem_smi, depth, headNode=False):
-            """Expand at a fixed depth for the current node chem_id."""
-            C = self.Chemicals[chem_smi]
-            if C.terminal:
-                yield []
-
-            if depth > self.max_depth:
-                return
-
-            done_children_of_this_chemical = []
-            for tid, CTA in list(C.template_idx_results.items()):
-                if CTA.waiting:
-                    continue
-                for rct_smi, R in list(CTA.reactions.items()):
-                    if (not R.valid) or R.price == -1:
-                        continue
-                    rxn_smiles = '.'.join(sorted(R.reactant_smiles)) + '>>' + chem_smi
-                    if rxn_smiles not in done_children_of_this_chemical: # necessary to avoid duplicates
-                        for path in DLS_rxn(chem_smi, tid, rct_smi, depth):
-                            yield [rxn_dict(rxnsmiles_to_id(rxn_smiles), rxn_smiles, children=path, 
-                                plausibility=R.plausibility,
-                                template_score=R.template_score, **tidlisttoinfodict(R.tforms))]
-                            # TODO: figure out when to include num_examples
-                        done_children_of_this_chemical.append(rxn_smiles)
-
-
-        def DLS_rxn(chem_smi, template_idx, rct_smi, depth):
-            """Return children paths starting from a specific rxn_id"""
-            # TODO: add in auxiliary information about templates, etc.
-            R = self.Chemicals[chem_smi].template_idx_results[template_idx].reactions[rct_smi]
-
-            # rxn_list = []
-            # for smi in R.reactant_smiles:
-            #     rxn_list.append([chem_dict(smi, children=path, **{}) for path in DLS_chem(smi, depth+1)])
-                
-            # return [rxns[0] for rxns in itertools.product(rxn_list)]
-
-            ###################
-            # To get recursion working properly with generators, need to hard-code these cases? Unclear
-            # whether itertools.product can actually work with generators. Seems like it can't work
-            # well...
-
-            # Only one reactant? easy!
-            if len(R.reactant_smiles) == 1:
-                chem_smi0 = R.reactant_smiles[0]
-                for path in DLS_chem(chem_smi0, depth+1):
-                    yield [
-                        chem_dict(chemsmiles_to_id(chem_smi0), children=path, **cheminfodict(chem_smi0))
-                    ]
-
-            # Two reactants? want to capture all combinations of each node's
-            # options
-            elif len(R.reactant_smiles) == 2:
-                chem_smi0 = R.reactant_smiles[0]
-                chem_smi1 = R.reactant_smiles[1]
-                for path0 in DLS_chem(chem_smi0, depth+1):
-                    for path1 in DLS_chem(chem_smi1, depth+1):
-                        yield [
-                            chem_dict(chemsmiles_to_id(chem_smi0), children=path0, **cheminfodict(chem_smi0)),
-                            chem_dict(chemsmiles_to_id(chem_smi1), children=path1, **cheminfodict(chem_smi1)),
-                        ]
-
-            # Three reactants? This is not elegant...
-            elif len(R.reactant_smiles) == 3:
-                chem_smi0 = R.reactant_smiles[0]
-                chem_smi1 = R.reactant_smiles[1]
-                chem_smi2 = R.reactant_smiles[2]
-                for path0 in DLS_chem(chem_smi0, depth+1):
-                    for path1 in DLS_chem(chem_smi1, depth+1):
-                        for path2 in DLS_chem(chem_smi2, depth+1):
-                            yield [
-                                chem_dict(chemsmiles_to_id(chem_smi0), children=path0, **cheminfodict(chem_smi0)),
-                                chem_dict(chemsmiles_to_id(chem_smi1), children=path1, **cheminfodict(chem_smi1)),
-                                chem_dict(chemsmiles_to_id(chem_smi2), children=path2, **cheminfodict(chem_smi2)),
-                            ]
-
-            # I am ashamed
-            elif len(R.reactant_smiles) == 4:
-                chem_smi0 = R.reactant_smiles[0]
-                chem_smi1 = R.reactant_smiles[1]
-                chem_smi2 = R.reactant_smiles[2]
-                chem_smi3 = R.reactant_smiles[3]
-                for path0 in DLS_chem(chem_smi0, depth+1):
-                    for path1 in DLS_chem(chem_smi1, depth+1):
-                        for path2 in DLS_chem(chem_smi2, depth+1):
-                            for path3 in DLS_chem(chem_smi3, depth+1):
-                                yield [
-                                    chem_dict(chemsmiles_to_id(chem_smi0), children=path0, **cheminfodict(chem_smi0)),
-                                    chem_dict(chemsmiles_to_id(chem_smi1), children=path1, **cheminfodict(chem_smi1)),
-                                    chem_dict(chemsmiles_to_id(chem_smi2), children=path2, **cheminfodict(chem_smi2)),
-                                    chem_dict(chemsmiles_to_id(chem_smi3), children=path3, **cheminfodict(chem_smi3)),
-                                ]
-
-            else:
-                print('Too many reactants! Only have cases 1-4 programmed')
-                print('There probably are not any real 5 component reactions')
-                print((R.reactant_smiles))
-
-
-        MyLogger.print_and_log('Retrieving trees...', treebuilder_loc)
-        trees = []
-        for tree in IDDFS():
-            trees.append(tree)
-            if len(trees) >= self.max_trees:
-                break
-
-        # Sort by some metric
-        def number_of_starting_materials(tree):
-            if tree != []:
-                if tree['children']:
-                    return sum(number_of_starting_materials(tree_child) for tree_child in tree['children'][0]['children'])
-            return 1.0
-        def number_of_reactions(tree):
-            if tree != []:
-                if tree['children']:
-                    return 1.0 + max(number_of_reactions(tree_child) for tree_child in tree['children'][0]['children'])
-            return 0.0
-        def overall_plausibility(tree):
-            if tree != []:
-                if tree['children']:
-                    producing_reaction = tree['children'][0]
-                    return producing_reaction['plausibility'] * np.prod([overall_plausibility(tree_child) for tree_child in producing_reaction['children']])
-            return 1.0
-
-        MyLogger.print_and_log('Sorting {} trees...'.format(len(trees)), treebuilder_loc)
+            return seen_chem_ids[chem_id]
+
+        # Routes are extracted bottom-up: best_routes(chem_id, depth) holds the
+        # routes to make a chemical reached at that depth that can still be
+        # among the best max_trees, built from the routes kept for its
+        # reactants, so shared subtrees are only scored once. A route is kept
+        # as an option tuple (sort key, order, score, reaction, dominated,
+        # position), where reaction is None for a starting material or
+        # (rxn_smiles, R, options of R's reactants). order places the route
+        # where a depth-first enumeration of all routes would reach it, and
+        # breaks ties between equal scores: it is the rank of the reaction
+        # followed by the positions of the reactants' options, where position
+        # is the index of an option in its list sorted by order. Reactant
+        # scores are combined one at a time, starting from unit; increasing
+        # is whether combining a worse score always gives a worse score.
         if self.sort_trees_by == 'plausibility':
-            trees = sorted(trees, key=lambda x: overall_plausibility(x), reverse=True)
+            leaf_score = 1.0
+            unit = 1.0
+            combine = lambda a, b: a * b
+            score_reaction = lambda R, score: R.plausibility * score
+            sort_key = lambda score: -score
+            increasing = all(R.plausibility > 0 for C in self.Chemicals
+                             for CTA in C.template_idx_results.values() for R in CTA.reactions.values())
         elif self.sort_trees_by == 'number_of_starting_materials':
-            trees = sorted(trees, key=lambda x: number_of_starting_materials(x))
+            leaf_score = 1.0
+            unit = 0.0
+            combine = lambda a, b: a + b
+            score_reaction = lambda R, score: score
+            sort_key = lambda score: score
+            increasing = True
         elif self.sort_trees_by == 'number_of_reactions':
-            trees = sorted(trees, key=lambda x: number_of_reactions(x))
+            leaf_score = 0.0
+            unit = 0.0
+            combine = max
+            score_reaction = lambda R, score: 1.0 + score
+            sort_key = lambda score: score
+            increasing = False
         else:
             raise ValueError('Need something to sort by! Invalid option provided {}'.format(self.sort_trees_by))
 
+        def option_key(option):
+            return option[:2]
+
+        def best(options):
+            """Sorts options best first and drops those that cannot make the
+            cut. An option is dominated by the options that sort before it
+            and, unless combine is increasing, also have an earlier order:
+            whatever it is combined with, they give a route that sorts before
+            it, also when combine is max and the scores tie. Options dominated
+            by max_trees others are dropped; the rest are kept with their
+            number of dominating options and their position. The options
+            dominating a kept option are all kept, so they are found among
+            the earlier kept options"""
+            options.sort(key=option_key)
+            if increasing:
+                kept = [option[:4] + (dominated,) for (dominated, option) in enumerate(options[:self.max_trees])]
+                kept_orders = sorted(option[1] for option in kept)
+            else:
+                kept = []
+                kept_orders = []
+                for option in options:
+                    dominated = bisect.bisect_left(kept_orders, option[1])
+                    if dominated < self.max_trees:
+                        kept.append(option[:4] + (dominated,))
+                        kept_orders.insert(dominated, option[1])
+            positions = dict((order, position) for (position, order) in enumerate(kept_orders))
+            return [option + (positions[option[1]],) for option in kept]
+
+        def merge(partials, options):
+            """Combinations of partial reactant combinations with the routes of
+            the next reactant. A pair is dominated by the other pairs of
+            options dominating or equal to each of its two options, so only
+            pairs where the product of their numbers of dominating options
+            plus one is at most max_trees can make the cut."""
+            options = sorted(options, key=lambda option: option[4])
+            dominated = [option[4] for option in options]
+            merged = []
+            for (_, partial_order, partial_score, partial_options, partial_dominated, _) in partials:
+                limit = bisect.bisect_right(dominated, self.max_trees // (partial_dominated + 1) - 1)
+                for option in options[:limit]:
+                    score = combine(partial_score, option[2])
+                    merged.append((sort_key(score), partial_order + (option[5],), score, partial_options + (option,)))
+            return best(merged)
+
+        memo = {}
+        def best_routes(chem_id, depth):
+            """Routes to make chem_id when it is reached at the given depth
+            that can still make the cut, sorted best first"""
+            if (chem_id, depth) in memo:
+                return memo[(chem_id, depth)]
+            C = self.Chemicals[chem_id]
+            options = []
+            if C.terminal:
+                options.append((sort_key(leaf_score), (0,), leaf_score, None))
+
+            if depth <= self.max_depth:
+                done_children_of_this_chemical = set()
+                for tid, CTA in C.template_idx_results.items():
+                    if CTA.waiting:
+                        continue
+                    for R in CTA.reactions.values():
+                        if (not R.valid) or R.price == -1:
+                            continue
+                        rxn_smiles = '.'.join(sorted(self.Chemicals[i].smiles for i in R.reactant_ids)) + '>>' + C.smiles
+                        if rxn_smiles in done_children_of_this_chemical: # necessary to avoid duplicates
+                            continue
+                        done_children_of_this_chemical.add(rxn_smiles)
+                        rank = len(done_children_of_this_chemical)
+
+                        partials = [(sort_key(unit), (), unit, (), 0, 0)]
+                        for reactant_id in R.reactant_ids:
+                            partials = merge(partials, best_routes(reactant_id, depth+1))
+                            if not partials:
+                                break
+                        for (_, order, partial_score, reactant_options, _, _) in partials:
+                            score = score_reaction(R, partial_score)
+                            options.append((sort_key(score), (rank,) + order, score, (rxn_smiles, R, reactant_options)))
+
+            memo[(chem_id, depth)] = best(options)
+            return memo[(chem_id, depth)]
+
+        built = {}
+        def build_tree(chem_id, option):
+            """Nested dictionary defining the synthesis tree of an option. Trees
+            sharing a subroute share its dictionary"""
+            key = (chem_id, id(option))
+            if key in built:
+                return built[key]
+            children = []
+            if option[3] is not None:
+                (rxn_smiles, R, reactant_options) = option[3]
+                reactants = [build_tree(reactant_id, reactant_option) for (reactant_id, reactant_option) in zip(R.reactant_ids, reactant_options)]
+                children = [rxn_dict(rxnsmiles_to_id(rxn_smiles), rxn_smiles, children=reactants,
+                    plausibility=R.plausibility,
+                    template_score=R.template_score, **tidlisttoinfodict(R.tforms))]
+            built[key] = chem_dict(chem_id_to_id(chem_id), children=children, **cheminfodict(chem_id))
+            return built[key]
+
+        MyLogger.print_and_log('Retrieving trees...', treebuilder_loc)
+        trees = [build_tree(self.target_id, option) for option in best_routes(self.target_id, 0)[:self.max_trees]]
+        MyLogger.print_and_log('Retrieved {} trees'.format(len(trees)), treebuilder_loc)
+
         return self.tree_status(), trees 
 
 
     # TODO: use these settings...
-    def get_buyable_paths(self, 
-                            smiles, 
+    def configure(self,
                             max_depth=10,
                             max_branching=25,
                             expansion_time=30,
@@ -1016,19 +1903,29 @@ class MCTS:
                             min_chemical_history_dict={'as_reactant':1e9, 'as_product':1e9,'logic':None},
                             apply_fast_filter=True, 
                             filter_threshold=0.75,
-                            soft_reset=False,
                             return_first=False,
                             sort_trees_by='plausibility',
+                            expansion_batch_size=1,
+                            leaf_batch_size=None,
+                            stream_chunk_size=None,
+                            dag=False,
+                            value_estimator=None,
+                            warm_start=None,
+                            checkpoint_path=None,
+                            checkpoint_interval=CHECKPOINT_INTERVAL,
+                            convergence_window=None,
+                            convergence_top_k=CONVERGENCE_TOP_K,
+                            visit_concentration=None,
+                            min_root_visits=MIN_ROOT_VISITS,
                             **kwargs):
+        '''Sets the settings of the next search. Other keyword arguments are
+        ignored'''
 
-        
-
-        self.smiles = smiles 
         self.max_depth = max_depth
         self.expansion_time = expansion_time
         self.nproc = nproc
         if num_active_pathways is None:
-            num_active_pathways = nproc
+            num_active_pathways = nproc if leaf_batch_size is None else PATHWAYS_PER_PROC * nproc
         self.num_active_pathways = num_active_pathways
         self.max_trees = max_trees
         self.max_cum_template_prob = max_cum_template_prob
@@ -1039,13 +1936,46 @@ class MCTS:
         self.max_natom_dict = max_natom_dict
         self.max_ppg = max_ppg
         self.sort_trees_by = sort_trees_by
+        self.expansion_batch_size = expansion_batch_size
+        self.leaf_batch_size = leaf_batch_size
+        self.stream_chunk_size = stream_chunk_size
+        self.dag = dag
+        self.value_estimator = get_value_estimator(value_estimator)
+        if self.value_estimator is not None:
+            self.value_estimator.load()
+        self.warm_start = warm_start
+        self.warm_start_key = settings_key(
+            template_count=template_count, max_cum_template_prob=max_cum_template_prob,
+            apply_fast_filter=apply_fast_filter, filter_threshold=filter_threshold,
+            max_branching=self.max_branching, max_ppg=max_ppg, max_natom_dict=max_natom_dict,
+            min_chemical_history_dict=min_chemical_history_dict,
+            mincount=self.mincount, mincount_chiral=self.mincount_chiral, chiral=self.chiral,
+        )
+        self.convergence_window = convergence_window
+        self.convergence_top_k = convergence_top_k
+        self.visit_concentration = visit_concentration
+        self.min_root_visits = min_root_visits
+        self.checkpoint = CheckpointWriter(checkpoint_path) if checkpoint_path else None
+        self.checkpoint_interval = checkpoint_interval
+        self.search_settings = dict(
+            max_depth=max_depth, max_branching=max_branching, expansion_time=expansion_time,
+            nproc=nproc, num_active_pathways=num_active_pathways, chiral=chiral, max_trees=max_trees,
+            max_ppg=max_ppg, known_bad_reactions=known_bad_reactions, forbidden_molecules=forbidden_molecules,
+            template_count=template_count, max_cum_template_prob=max_cum_template_prob,
+            max_natom_dict=dict(max_natom_dict), min_chemical_history_dict=min_chemical_history_dict,
+            apply_fast_filter=apply_fast_filter, filter_threshold=filter_threshold, return_first=return_first,
+            sort_trees_by=sort_trees_by, expansion_batch_size=expansion_batch_size,
+            leaf_batch_size=leaf_batch_size, stream_chunk_size=stream_chunk_size, dag=dag,
+            convergence_window=convergence_window, convergence_top_k=convergence_top_k,
+            visit_concentration=visit_concentration, min_root_visits=min_root_visits,
+            # estimator objects are not saved; pass them to resume again
+            value_estimator=value_estimator if isinstance(value_estimator, str) else None,
+        )
 
 
         if min_chemical_history_dict['logic'] not in [None, 'none'] and \
                 self.chemhistorian is None:
-            from makeit.utilities.historian.chemicals import ChemHistorian 
-            self.chemhistorian = ChemHistorian()
-            self.chemhistorian.load_from_file(refs=False, compressed=True)
+            self.chemhistorian = get_shared_chemhistorian(refs=False, compressed=True)
             MyLogger.print_and_log('Loaded compressed chemhistorian from file', treebuilder_loc, level=1)
 
         # Define stop criterion
@@ -1090,21 +2020,112 @@ class MCTS:
             
         self.is_a_terminal_node = is_a_terminal_node
 
-
-
-
-
-
-
+    def get_buyable_paths(self, smiles, soft_reset=False, soft_stop=False, return_report=False, **kwargs):
+        '''Searches for routes to one target, with the settings given as
+        keyword arguments to configure. Returns (tree_status, trees), plus
+        the search_report if return_report'''
+        self.configure(**kwargs)
         self.reset(soft_reset=soft_reset)
-        
-        MyLogger.print_and_log('Starting search for {}'.format(smiles), treebuilder_loc)
-        self.build_tree(soft_stop=kwargs.pop('soft_stop', False), 
-            known_bad_reactions=known_bad_reactions,
-            forbidden_molecules=forbidden_molecules,
-            return_first=return_first,
-        )
-
+        for search in self.build_tree([(smiles, self.expansion_time)], soft_stop=soft_stop,
+                                      known_bad_reactions=self.search_settings['known_bad_reactions'],
+                                      forbidden_molecules=self.search_settings['forbidden_molecules'],
+                                      return_first=self.search_settings['return_first']):
+            pass
+
+        if self.warm_start is not None:
+            self.record_warm_start()
+            if self.warm_start.file_path:
+                self.warm_start.save()
+
+        return self.search_result(return_report)
+
+    def search_result(self, return_report=False):
+        '''(tree_status, trees) of the current target, plus its search_report
+        if return_report'''
+        start = time.perf_counter()
+        (status, trees) = self.return_trees()
+        self.timer.add('tree_extraction', start)
+        self.report = self.search_report()
+        if return_report:
+            return (status, trees, self.report)
+        return (status, trees)
+
+    def get_buyable_paths_batch(self, targets, concurrent_targets=None, max_graph_chemicals=MAX_GRAPH_CHEMICALS,
+                                soft_reset=False, soft_stop=False, return_report=False, **kwargs):
+        '''Searches a list of targets over one pool of workers that stays up
+        for the whole batch, yielding (smiles, get_buyable_paths result) as
+        each target finishes.
+
+        Targets are SMILES strings or (smiles, expansion_time) pairs for
+        targets with their own time budget; expansion_time and the other
+        settings are keyword arguments of configure. Up to concurrent_targets
+        targets (by default one per PATHWAYS_PER_TARGET active pathways) are
+        searched at once in one coordination loop, each with its own root,
+        share of the active pathways and time budget, counted from when the
+        target starts; the next target starts as soon as one stops.
+        All targets share one graph, so intermediates expanded or solved for
+        one target are reused by the others, and expansions still in flight
+        when a target stops are added to it. Once the graph holds more than
+        max_graph_chemicals chemicals it is cleared before the next target
+        starts. The timers and queue samples of the reports cover the batch
+        since it started or its graph was last cleared.'''
+        if kwargs.get('checkpoint_path'):
+            raise ValueError('Checkpoints are not supported for batch searches')
+        self.configure(**kwargs)
+        if concurrent_targets is None:
+            concurrent_targets = max(1, self.num_active_pathways // PATHWAYS_PER_TARGET)
+        targets = ((target, self.expansion_time) if isinstance(target, str) else tuple(target) for target in targets)
+        self.reset(soft_reset=soft_reset)
+        self.batch_search = True
+        try:
+            for search in self.build_tree(targets, concurrent_targets=concurrent_targets,
+                                          max_graph_chemicals=max_graph_chemicals, soft_stop=soft_stop,
+                                          known_bad_reactions=self.search_settings['known_bad_reactions'],
+                                          forbidden_molecules=self.search_settings['forbidden_molecules'],
+                                          return_first=self.search_settings['return_first']):
+                yield (search.smiles, self.search_result(return_report))
+        finally:
+            self.batch_search = False
+            self.running = True # workers were kept running between targets
+            self.stop(soft_stop=soft_stop)
+            if self.warm_start is not None:
+                self.record_warm_start()
+                if self.warm_start.file_path:
+                    self.warm_start.save()
+
+    def resume(self, checkpoint_path, **kwargs):
+        '''Continues the search saved in a checkpoint file, with the settings
+        it was started with unless overridden. By default the search runs for
+        what is left of its original expansion time. The checkpoint file keeps
+        being appended to'''
+        (header, records) = read_checkpoint(checkpoint_path)
+        settings = dict(header['settings'])
+        elapsed = records[-1]['elapsed'] if records else 0.
+        settings['expansion_time'] = max(settings['expansion_time'] - elapsed, 0)
+        settings.update(kwargs)
+        MyLogger.print_and_log('Resuming search from {} after {:.2f} seconds'.format(checkpoint_path, elapsed), treebuilder_loc)
+        self.restored = (header, records)
+        try:
+            return self.get_buyable_paths(header['target'][0], checkpoint_path=checkpoint_path, **settings)
+        finally:
+            self.restored = None
+
+    def routes_from_checkpoint(self, checkpoint_path):
+        '''Routes of the tree saved in a checkpoint file, without running the
+        search or touching the workers'''
+        (header, records) = read_checkpoint(checkpoint_path)
+        settings = header['settings']
+        self.smiles = header['target'][0]
+        self.max_depth = settings['max_depth']
+        self.max_trees = settings['max_trees']
+        self.sort_trees_by = settings['sort_trees_by']
+        self.dag = settings['dag']
+        self.num_active_pathways = settings['num_active_pathways']
+        self.warm_start = None
+        self.checkpoint = None
+        self.reset_tree()
+        self.restore_checkpoint(header, records)
+        self.full_update(self.target_id)
         return self.return_trees()
 
 
@@ -1206,11 +2227,11 @@ if __name__ == '__main__':
             (Chemicals, ftime, paths) = pickle.load(fid)
 
             total += 1
-            if Chemicals[smiles].price != -1:
+            if Chemicals[0].price != -1: # target is always chemical ID 0
                 success += 1
                 first_time.append(ftime)
                 pathway_count.append(len(paths))
-                min_price.append(Chemicals[smiles].price)
+                min_price.append(Chemicals[0].price)
 
         print(('After looking at chemical index {}'.format(_id)))
         print(('Success ratio: %f (%d/%d)' % (float(success)/total, success, total)  ))      
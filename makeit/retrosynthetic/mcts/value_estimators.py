@@ -0,0 +1,88 @@
+'''
+Value estimates for the chemicals MCTS adds to its tree.
+
+A new chemical starts with the value its expansion gave it (a constant 1)
+as the first sample of its estimated price, which is what UCB compares
+reactions by. A leaf value estimator replaces that value with a learned
+one. The coordinator scores all chemicals that are new in one expansion
+result with a single estimate call, before the outcomes are added to the
+tree, so the cost of a model is paid once per expansion and not once
+per chemical.
+
+Estimators are given to MCTS.get_buyable_paths as value_estimator, either
+as an object with load() and estimate(smiles_list) methods or by name
+(see VALUE_ESTIMATORS).
+'''
+
+import threading
+import numpy as np
+from makeit.utilities.io.logger import MyLogger
+value_estimators_loc = 'mcts_value_estimators'
+
+
+class LeafValueEstimator(object):
+    '''Interface of leaf value estimators'''
+
+    def load(self):
+        '''Loads the model, if not loaded yet. Called by the coordinator
+        before a search, so the model is never loaded in worker processes'''
+        return
+
+    def estimate(self, smiles_list):
+        '''Estimated price of each chemical in smiles_list (canonical SMILES),
+        as an array of floats on the scale of Chemical.estimate_price, where
+        every buyable chemical costs 1. Lower is better'''
+        raise NotImplementedError
+
+
+class SCScoreValueEstimator(LeafValueEstimator):
+    '''Estimates the price of a chemical from its synthetic complexity
+    score, which ranges from 1 (simple) to 5 (complex). The estimate is
+    1 + weight * (SCScore - 1), so simple precursors cost about as much as
+    buyable ones and complex ones up to 1 + 4 * weight. Chemicals the model
+    cannot score get the default value of 1'''
+
+    def __init__(self, weight=1.0, model_tag='1024bool', FP_len=1024, scorer=None):
+        self.weight = weight
+        self.model_tag = model_tag
+        self.FP_len = FP_len
+        self.scorer = scorer # SCScorePrecursorPrioritizer, loaded if not given
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.scorer is not None:
+                return
+            from makeit.prioritization.precursors.scscore import SCScorePrecursorPrioritizer
+            scorer = SCScorePrecursorPrioritizer()
+            scorer.load_model(FP_len=self.FP_len, model_tag=self.model_tag)
+            self.scorer = scorer
+            MyLogger.print_and_log('Loaded SCScore model {} for leaf values'.format(self.model_tag), value_estimators_loc)
+
+    def estimate(self, smiles_list):
+        scores = np.asarray(self.scorer.get_scores_from_smiles_list(smiles_list), dtype=np.float64)
+        return np.where(scores > 0, 1 + self.weight * (scores - 1), 1.)
+
+
+VALUE_ESTIMATORS = {
+    'scscore': SCScoreValueEstimator,
+}
+
+_lock = threading.Lock()
+_shared = {} # name -> estimator
+
+
+def get_value_estimator(value_estimator):
+    '''Estimator object for value_estimator, which is None, the name of an
+    estimator in VALUE_ESTIMATORS or already an estimator. Estimators given
+    by name are created once per process and shared by every search, so
+    their models are only loaded once'''
+    if value_estimator is None or not isinstance(value_estimator, str):
+        return value_estimator
+    if value_estimator not in VALUE_ESTIMATORS:
+        raise ValueError('Unknown leaf value estimator {}, use one of {}'.format(
+            value_estimator, sorted(VALUE_ESTIMATORS)))
+    with _lock:
+        if value_estimator not in _shared:
+            _shared[value_estimator] = VALUE_ESTIMATORS[value_estimator]()
+        return _shared[value_estimator]
@@ -0,0 +1,81 @@
+'''
+Persistent store of per-chemical MCTS results, used to warm-start searches.
+
+Related targets (e.g. an analog series) share most of their intermediates,
+but every MCTS search starts from an empty tree. After a search the tree
+builder records, for each chemical it saw, its template relevance, price and
+history lookups, the raw outcomes of every template it applied and whether
+it ended up solved. A later search with the same settings seeds new nodes
+from these entries: lookups are skipped, stored expansions are served
+without going to the workers, known dead ends are marked done and the
+solving templates of known solved chemicals are replayed right away.
+
+Entries are keyed by (settings key, canonical SMILES) and evicted least
+recently used first once the store holds max_entries chemicals.
+'''
+
+import os
+from collections import OrderedDict
+import makeit.utilities.io.pickle as pickle
+from makeit.utilities.io.logger import MyLogger
+warm_start_loc = 'mcts_warm_start'
+
+
+def settings_key(**settings):
+    '''Hashable key for the settings that affect expansion results and
+    solved status; searches only share entries if their keys match'''
+    return repr(sorted((name, sorted(value.items()) if isinstance(value, dict) else value)
+                       for (name, value) in settings.items()))
+
+
+class WarmStartStore(object):
+
+    def __init__(self, file_path=None, max_entries=100000):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # (settings key, smiles) -> entry, least recently used first
+
+    def get(self, key, smiles):
+        '''Entry for a chemical, or None if it has not been stored'''
+        entry = self.entries.get((key, smiles))
+        if entry is not None:
+            self.entries.move_to_end((key, smiles))
+        return entry
+
+    def put(self, key, smiles, entry):
+        '''Stores the entry of a chemical, merged into what is already known
+        about it: expansions are added to the stored ones, visit counts
+        summed and the best price kept'''
+        old = self.entries.pop((key, smiles), None)
+        if old is not None:
+            expansions = dict(old['expansions'])
+            expansions.update(entry['expansions'])
+            entry['expansions'] = expansions
+            entry['visit_count'] += old['visit_count']
+            if entry['price'] == -1 or (old['price'] != -1 and old['price'] < entry['price']):
+                entry['price'] = old['price']
+                entry['solved_templates'] = old['solved_templates']
+            entry['done'] = entry['done'] or old['done']
+        self.entries[(key, smiles)] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def load(self, file_path=None):
+        file_path = file_path or self.file_path
+        if not os.path.isfile(file_path):
+            MyLogger.print_and_log('No warm start store at {}, starting empty'.format(file_path), warm_start_loc)
+            return
+        with open(file_path, 'rb') as file:
+            self.entries = OrderedDict(pickle.load(file))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        MyLogger.print_and_log('Loaded {} warm start entries from {}'.format(len(self.entries), file_path), warm_start_loc)
+
+    def save(self, file_path=None):
+        file_path = file_path or self.file_path
+        with open(file_path, 'wb') as file:
+            pickle.dump(list(self.entries.items()), file)
+        MyLogger.print_and_log('Saved {} warm start entries to {}'.format(len(self.entries), file_path), warm_start_loc)
+
+    def __len__(self):
+        return len(self.entries)
@@ -1,7 +1,7 @@
 
 
 import makeit.global_config as gc
-import os, sys
+import os, sys, time
 import json
 import makeit.utilities.io.pickle as pickle
 from pymongo import MongoClient
@@ -121,10 +121,11 @@ class RetroTransformer(TemplateTransformer):
             self.num_templates), retro_transformer_loc)
 
     def load_fast_filter(self):
-        # NOTE: Keras backend must be Theano for fast filter to work
+        # NOTE: uses the numpy export when available, otherwise Keras
+        # (backend must be Theano for the Keras fast filter to work)
         self.fast_filter = FastFilterScorer()
         # self.fast_filter.set_keras_backend('theano')
-        self.fast_filter.load(model_path=gc.FAST_FILTER_MODEL['trained_model_path'])
+        self.fast_filter.load()
         
     def load_banned_chemicals(self):
         with open(gc.BAN_LIST_PATH) as f:
@@ -184,18 +185,21 @@ class RetroTransformer(TemplateTransformer):
         if use_ban_list and smiles in self.banned_smiles:
             return result
 
-        for template in self.top_templates(smiles, **kwargs):
-            for precursor in self.apply_one_template(mol, smiles, template):
+        precursors = [precursor for template in self.top_templates(smiles, **kwargs)
+                      for precursor in self.apply_one_template(mol, smiles, template)]
 
-                # Should we add this to the results?
-                if apply_fast_filter:
-                    reactant_smiles = '.'.join(precursor.smiles_list)
-                    filter_flag, filter_score = self.fast_filter.filter_with_threshold(reactant_smiles, smiles, filter_threshold)
-                    if filter_flag:
-                        precursor.plausibility = filter_score
-                        result.add_precursor(precursor, self.precursor_prioritizer, **kwargs)
-                else:
-                    result.add_precursor(precursor, self.precursor_prioritizer, **kwargs)
+        # Should we add these to the results? All precursors share the same
+        # product, so they are scored together in one fast filter call
+        if apply_fast_filter:
+            filter_scores = self.fast_filter.score_for_product(
+                ['.'.join(precursor.smiles_list) for precursor in precursors], smiles)
+        for (i, precursor) in enumerate(precursors):
+            if apply_fast_filter:
+                filter_score = filter_scores[i]
+                if filter_score is None or filter_score <= filter_threshold:
+                    continue
+                precursor.plausibility = filter_score
+            result.add_precursor(precursor, self.precursor_prioritizer, **kwargs)
         return result
 
     def apply_one_template_by_idx(self, _id, smiles, template_idx, calculate_next_probs=True, **kwargs):
@@ -207,6 +211,35 @@ class RetroTransformer(TemplateTransformer):
 
         This is useful in the MCTS code.'''
 
+        use_ban_list = kwargs.get('use_ban_list', True)
+        all_outcomes = self.apply_templates_by_idx(_id, smiles, [template_idx],
+            calculate_next_probs=calculate_next_probs, **kwargs)[0]
+        if use_ban_list and all_outcomes[0][1] in self.banned_smiles:
+            return []
+        return all_outcomes
+
+    def apply_templates_by_idx(self, _id, smiles, template_idxs, calculate_next_probs=True, **kwargs):
+        '''Applies several templates to one SMILES. Returns one list of outcomes
+        per template, in the order of template_idxs, each in the format of
+        apply_one_template_by_idx. Banned SMILES get the dummy (no reactants)
+        outcome for every template.'''
+        return list(self.iter_templates_by_idx(_id, smiles, template_idxs,
+            calculate_next_probs=calculate_next_probs, **kwargs))
+
+    def iter_templates_by_idx(self, _id, smiles, template_idxs, calculate_next_probs=True, chunk_size=None, stats=None, **kwargs):
+        '''Generator version of apply_templates_by_idx, yielding the outcomes
+        of each template in order.
+
+        The product is parsed once for all templates and the template relevance
+        of precursors is only calculated once per precursor. Templates are
+        applied chunk_size at a time (all at once by default), and the fast
+        filter scores every outcome of a chunk in one batch, so a smaller
+        chunk_size gets the first outcomes back sooner.
+
+        If stats (a PhaseTimer) is given, the time spent applying templates,
+        scoring outcomes with the fast filter and prioritizing templates for
+        the precursors is added to it.'''
+
         apply_fast_filter = kwargs.pop('apply_fast_filter', True)
         filter_threshold = kwargs.pop('filter_threshold', 0.75)
         use_ban_list = kwargs.pop('use_ban_list', True)
@@ -222,51 +255,84 @@ class RetroTransformer(TemplateTransformer):
         if self.chiral:
             mol = rdchiralReactants(smiles)
 
-        all_outcomes = []; seen_reactants = {}; seen_reactant_combos = [];
-        
         if use_ban_list and smiles in self.banned_smiles:
-            return all_outcomes
-        
-        for smiles_list in self.apply_one_template_smilesonly(mol, smiles, self.templates[template_idx]):
-            # Avoid duplicate outcomes (e.g., by symmetry)
-            reactant_smiles = '.'.join(smiles_list)
-            if reactant_smiles in seen_reactant_combos:
-                continue
-            seen_reactant_combos.append(reactant_smiles)
-
-            # Should we add this to the results?
-            filter_score = 1.0
-            if apply_fast_filter:
-                filter_flag, filter_score = self.fast_filter.filter_with_threshold(reactant_smiles, smiles, filter_threshold)
-                if not filter_flag:
-                    continue
-
-            # Should we calculate template relevance scores for each precursor?
-            reactants = []
-            if calculate_next_probs:
-                for reactant_smi in smiles_list:
-                    if reactant_smi not in seen_reactants:
-                        probs, indeces = self.template_prioritizer.get_topk_from_smi(reactant_smi, k=template_count)
-                        # Truncate based on max_cum_prob?
-                        truncate_to = np.argwhere(np.cumsum(probs) >= max_cum_prob)
-                        if len(truncate_to):
-                            truncate_to = truncate_to[0][0] + 1 # Truncate based on max_cum_prob?
-                        else:
-                            truncate_to = template_count
-                        value = 1 # current value assigned to precursor (note: may replace with real value function)
-                        # Save to dict
-                        seen_reactants[reactant_smi] = (reactant_smi, probs[:truncate_to], indeces[:truncate_to], value)
-                    reactants.append(seen_reactants[reactant_smi])
-                
-                all_outcomes.append((_id, smiles, template_idx, reactants, filter_score))
-            
-            else:
-                all_outcomes.append((_id, smiles, template_idx, smiles_list, filter_score))
-
-        if not all_outcomes:
-            all_outcomes.append((_id, smiles, template_idx, [], 0.0)) # dummy outcome
-
-        return all_outcomes
+            for template_idx in template_idxs:
+                yield [(_id, smiles, template_idx, [], 0.0)] # dummy outcome
+            return
+
+        seen_reactants = {}
+        chunk_size = chunk_size or len(template_idxs)
+        for chunk_start in range(0, len(template_idxs), chunk_size):
+            chunk = template_idxs[chunk_start:chunk_start + chunk_size]
+
+            if stats is not None:
+                start = time.perf_counter()
+            smiles_lists_by_template = []
+            reactant_combos = []
+            for template_idx in chunk:
+                seen_reactant_combos = []
+                smiles_lists = []
+                for smiles_list in self.apply_one_template_smilesonly(mol, smiles, self.templates[template_idx]):
+                    # Avoid duplicate outcomes (e.g., by symmetry)
+                    reactant_smiles = '.'.join(smiles_list)
+                    if reactant_smiles in seen_reactant_combos:
+                        continue
+                    seen_reactant_combos.append(reactant_smiles)
+                    smiles_lists.append(smiles_list)
+                smiles_lists_by_template.append(smiles_lists)
+                reactant_combos.extend(seen_reactant_combos)
+
+            if stats is not None:
+                start = stats.add('template_application', start, count=len(chunk))
+
+            # Score all outcomes of this chunk against the product at once
+            if apply_fast_filter and reactant_combos:
+                filter_scores = self.fast_filter.score_for_product(reactant_combos, smiles)
+                if stats is not None:
+                    stats.add('fast_filter', start, count=len(reactant_combos))
+            offset = 0
+
+            for (template_idx, smiles_lists) in zip(chunk, smiles_lists_by_template):
+                all_outcomes = []
+                for (i, smiles_list) in enumerate(smiles_lists):
+                    # Should we add this to the results?
+                    filter_score = 1.0
+                    if apply_fast_filter:
+                        filter_score = filter_scores[offset + i]
+                        if filter_score is None or filter_score <= filter_threshold:
+                            continue
+
+                    # Should we calculate template relevance scores for each precursor?
+                    reactants = []
+                    if calculate_next_probs:
+                        for reactant_smi in smiles_list:
+                            if reactant_smi not in seen_reactants:
+                                if stats is not None:
+                                    start = time.perf_counter()
+                                probs, indeces = self.template_prioritizer.get_topk_from_smi(reactant_smi, k=template_count)
+                                # Truncate based on max_cum_prob?
+                                truncate_to = np.argwhere(np.cumsum(probs) >= max_cum_prob)
+                                if len(truncate_to):
+                                    truncate_to = truncate_to[0][0] + 1 # Truncate based on max_cum_prob?
+                                else:
+                                    truncate_to = template_count
+                                value = 1 # current value assigned to precursor (note: may replace with real value function)
+                                # Save to dict
+                                seen_reactants[reactant_smi] = (reactant_smi, probs[:truncate_to], indeces[:truncate_to], value)
+                                if stats is not None:
+                                    stats.add('template_prioritization', start)
+                            reactants.append(seen_reactants[reactant_smi])
+
+                        all_outcomes.append((_id, smiles, template_idx, reactants, filter_score))
+
+                    else:
+                        all_outcomes.append((_id, smiles, template_idx, smiles_list, filter_score))
+                offset += len(smiles_lists)
+
+                if not all_outcomes:
+                    all_outcomes.append((_id, smiles, template_idx, [], 0.0)) # dummy outcome
+
+                yield all_outcomes
 
     def apply_one_template_smilesonly(self, react_mol, smiles, template, **kwargs):
         """Takes a mol object and applies a single template
@@ -11,7 +11,7 @@ import sys
 from collections import defaultdict
 import rdkit.Chem as Chem
 from makeit.retrosynthetic.transformer import RetroTransformer
-from makeit.utilities.buyable.pricer import Pricer
+from makeit.utilities.registry import get_shared_pricer, get_shared_chemhistorian
 from makeit.utilities.io.logger import MyLogger
 from makeit.utilities.io import model_loader
 from makeit.utilities.formats import chem_dict, rxn_dict
@@ -87,14 +87,11 @@ class TreeBuilder:
         if pricer:
             self.pricer = pricer
         else:
-            self.pricer = Pricer()
-            self.pricer.load()
+            self.pricer = get_shared_pricer()
 
         self.chemhistorian = chemhistorian
         if chemhistorian is None:
-            from makeit.utilities.historian.chemicals import ChemHistorian 
-            self.chemhistorian = ChemHistorian()
-            self.chemhistorian.load_from_file(refs=False, compressed=True)
+            self.chemhistorian = get_shared_chemhistorian(refs=False, compressed=True)
 
         self.reset()
 
@@ -379,6 +376,11 @@ class TreeBuilder:
 
             # For the reaction, keep track of children IDs
             chem_ids = []
+            new_mols = [mol for mol in mols if mol not in self.chem_to_id]
+            new_info = dict(zip(new_mols, zip(
+                self.pricer.lookup_many(new_mols, alreadyCanonical=True),
+                self.chemhistorian.lookup_many(new_mols, alreadyCanonical=True),
+            )))
             for mol in mols:
 
                 # New chemical?
@@ -394,8 +396,7 @@ class TreeBuilder:
                         self.current_id += 1
 
                     # Check if buyable
-                    ppg = self.pricer.lookup_smiles(mol, alreadyCanonical=True)
-                    hist = self.chemhistorian.lookup_smiles(mol, alreadyCanonical=True)
+                    ppg, hist = new_info[mol]
 
                     self.tree_dict[chem_id] = {
                         'smiles': mol,
@@ -678,9 +679,7 @@ class TreeBuilder:
 
         if min_chemical_history_dict['logic'] not in [None, 'none'] and \
                 self.chemhistorian is None:
-            from makeit.utilities.historian.chemicals import ChemHistorian 
-            self.chemhistorian = ChemHistorian()
-            self.chemhistorian.load_from_file(refs=False, compressed=True)
+            self.chemhistorian = get_shared_chemhistorian(refs=False, compressed=True)
             MyLogger.print_and_log('Loaded compressed chemhistorian from file', treebuilder_loc, level=1)
 
         # Define stop criterion
@@ -1,53 +1,196 @@
-from makeit.utilities.fastfilter_utilities import Highway_self, pos_ct, true_pos, real_pos, set_keras_backend
-from makeit.utilities.fingerprinting import create_rxn_Morgan2FP_separately
+from makeit.utilities.fingerprinting import create_rxn_Morgan2FP_separately, smiles_to_morgan_fp, canonical_smiles
+from makeit.synthetic.evaluation.fast_filter_numpy import NumpyModel
+from makeit.utilities.cache import LRUCache
 from rdkit import Chem
 from rdkit.Chem import AllChem, DataStructs
 from makeit.interfaces.scorer import Scorer
 import numpy as np
-import csv
-from pymongo import MongoClient
-from tqdm import tqdm
-from keras.models import load_model
-from keras import backend as K
 import makeit.global_config as gc
 from makeit.utilities.io.logger import MyLogger
+import hashlib
+import sqlite3
+import threading
+import atexit
 import os
 import imp
 fast_filter_loc = 'fast_filter'
 
 
+def file_md5(path, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class FastFilterScoreCache(object):
+    """Memoized fast filter scores
+
+    Scores are deterministic for a given model file, so they are keyed on
+    (model hash, canonical reactants, canonical product). Lookups go to a
+    bounded in-memory LRU first and then, if a path is given, to a sqlite
+    file that persists scores between runs and processes. The file is in
+    WAL mode and new scores are committed every commit_rows rows, on
+    flush() / close() and at exit; a crash loses at most the uncommitted
+    scores, which are simply computed again.
+    """
+
+    # (reactants, product) pairs per SELECT, below sqlite's default limit
+    # of 999 bound parameters
+    LOOKUP_CHUNK = 450
+
+    def __init__(self, model_hash, max_size=gc.FAST_FILTER_MODEL['score_cache_size'], path=None,
+                 commit_rows=gc.FAST_FILTER_MODEL['score_cache_commit_rows']):
+        self.model_hash = model_hash
+        self.memory = LRUCache(max_size)
+        self.path = path
+        self.db = None
+        self.disk_hits = 0
+        self.commit_rows = commit_rows
+        self.uncommitted = 0
+        self._lock = threading.Lock()
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS scores (model TEXT, reactants TEXT, product TEXT, '
+                            'score REAL, PRIMARY KEY (model, reactants, product))')
+            self.db.commit()
+            atexit.register(self.flush)
+
+    def get(self, reactants, product):
+        return self.get_many([(reactants, product)])[0]
+
+    def get_many(self, keys):
+        """Scores for a list of (reactants, product) keys, None where not
+        cached. Keys missing from memory are looked up in the sqlite tier
+        with one query per LOOKUP_CHUNK keys"""
+        scores = [self.memory.get((self.model_hash,) + tuple(key)) for key in keys]
+        if self.db is None:
+            return scores
+        missing = {}
+        for (i, key) in enumerate(keys):
+            if scores[i] is None:
+                missing.setdefault(tuple(key), []).append(i)
+        missing_keys = list(missing)
+        for start in range(0, len(missing_keys), self.LOOKUP_CHUNK):
+            chunk = missing_keys[start:start + self.LOOKUP_CHUNK]
+            query = ('SELECT reactants, product, score FROM scores WHERE model = ? AND (reactants, product) IN '
+                     '(VALUES {})'.format(', '.join(['(?, ?)'] * len(chunk))))
+            params = [self.model_hash] + [smiles for key in chunk for smiles in key]
+            with self._lock:
+                rows = self.db.execute(query, params).fetchall()
+            for (reactants, product, score) in rows:
+                self.disk_hits += 1
+                self.memory.put((self.model_hash, reactants, product), score)
+                for i in missing[(reactants, product)]:
+                    scores[i] = score
+        return scores
+
+    def put_many(self, items):
+        """Stores (reactants, product, score) tuples"""
+        rows = [(self.model_hash, reactants, product, score) for (reactants, product, score) in items]
+        for row in rows:
+            self.memory.put(row[:3], row[3])
+        if self.db is not None and rows:
+            with self._lock:
+                self.db.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)', rows)
+                self.uncommitted += len(rows)
+                if self.uncommitted >= self.commit_rows:
+                    self._commit()
+
+    def _commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def flush(self):
+        """Commits the scores not written to the sqlite tier yet"""
+        if self.db is not None:
+            with self._lock:
+                self._commit()
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+    def clear(self):
+        self.memory.clear()
+        self.disk_hits = 0
+
+    def stats(self):
+        memory = self.memory.stats()
+        hits = memory['hits'] + self.disk_hits
+        total = memory['hits'] + memory['misses']
+        return {
+            'size': memory['size'],
+            'max_size': memory['max_size'],
+            'memory_hits': memory['hits'],
+            'disk_hits': self.disk_hits,
+            'misses': total - hits,
+            'hit_rate': float(hits) / total if total else 0.,
+            'persistent': self.path,
+        }
+
+
 class FastFilterScorer(Scorer):
     def __init__(self):
         self.model = None
+        self.model_hash = None
+        self.score_cache = None
 
     def set_keras_backend(self, backend):
+        from keras import backend as K
         if K.backend() != backend:
             os.environ['KERAS_BACKEND'] = backend
             imp.reload(K)
             assert K.backend() == backend
 
-    def load(self, model_path):
+    def load(self, model_path=None, cache_path=None):
+        """Load the fast filter model
+
+        A .npz export (see fast_filter_numpy) is evaluated with numpy only;
+        anything else is loaded as a Keras model. When no path is given, the
+        numpy export is used if present and it passes the parity check
+        stored with it, falling back to the Keras .h5 file otherwise.
+
+        Scores are memoized per model file; cache_path (default
+        FAST_FILTER_MODEL['score_cache_path']) adds a persistent sqlite tier.
+        """
         MyLogger.print_and_log('Starting to load fast filter', fast_filter_loc)
-        self.model = load_model(model_path, custom_objects={
-                                'Highway_self': Highway_self, 'pos_ct': pos_ct, 'true_pos': true_pos, 'real_pos': real_pos})
-        self.model._make_predict_function()
+        self.model = None
+        if model_path is None:
+            model_path = gc.FAST_FILTER_MODEL['numpy_model_path']
+            try:
+                if os.path.isfile(model_path):
+                    self.model = NumpyModel.load(model_path)
+            except ValueError as e:
+                MyLogger.print_and_log('Not using numpy fast filter: {}'.format(e), fast_filter_loc, level=1)
+            if self.model is None:
+                model_path = gc.FAST_FILTER_MODEL['trained_model_path']
+        if self.model is None and model_path.endswith('.npz'):
+            self.model = NumpyModel.load(model_path)
+        elif self.model is None:
+            from keras.models import load_model
+            from makeit.utilities.fastfilter_utilities import Highway_self, pos_ct, true_pos, real_pos
+            self.model = load_model(model_path, custom_objects={
+                                    'Highway_self': Highway_self, 'pos_ct': pos_ct, 'true_pos': true_pos, 'real_pos': real_pos})
+            self.model._make_predict_function()
+
+        self.model_hash = file_md5(model_path)
+        if cache_path is None:
+            cache_path = gc.FAST_FILTER_MODEL['score_cache_path']
+        if self.score_cache is not None:
+            self.score_cache.close()
+        self.score_cache = FastFilterScoreCache(self.model_hash, path=cache_path)
         MyLogger.print_and_log('Done loading fast filter', fast_filter_loc)
 
     def evaluate(self, reactant_smiles, target, **kwargs):
-        # Strip chirality
-        # rmol = Chem.MolFromSmiles(reactant_smiles)
-        # pmol = Chem.MolFromSmiles(target)
-        # reactant_smiles = Chem.MolToSmiles(rmol, False)
-        # target = Chem.MolToSmiles(pmol, False)
-
-        [pfp, rfp] = create_rxn_Morgan2FP_separately(
-            reactant_smiles, target, rxnfpsize=2048, pfpsize=2048, useFeatures=False)
-        pfp = np.asarray(pfp, dtype='float32')
-        rfp = np.asarray(rfp, dtype='float32')
-        rxnfp = pfp - rfp
-
-        score = self.model.predict(
-            [pfp.reshape(1, 2048), rxnfp.reshape(1, 2048)])
+        score = self.score_batch([(reactant_smiles, target)])[0]
+        if score is None:
+            score = 0.0
         outcome = {'smiles': target,
                    'template_ids': [],
                    'num_examples': 0
@@ -55,27 +198,118 @@ class FastFilterScorer(Scorer):
         all_outcomes = []
         all_outcomes.append([{'rank': 1.0,
                               'outcome': outcome,
-                              'score': float(score[0][0]),
-                              'prob': float(score[0][0]),
+                              'score': score,
+                              'prob': score,
                               }])
         return all_outcomes
 
     def filter_with_threshold(self, reactant_smiles, target, threshold):
-        [pfp, rfp] = create_rxn_Morgan2FP_separately(
-            reactant_smiles, target, rxnfpsize=2048, pfpsize=2048, useFeatures=False)
-        pfp = np.asarray(pfp, dtype='float32')
-        rfp = np.asarray(rfp, dtype='float32')
-        rxnfp = pfp - rfp
+        score = self.score_batch([(reactant_smiles, target)])[0]
+        if score is None:
+            return False, 0.0
+        return score > threshold, score
+
+    def score_batch(self, reactions):
+        """Score many reactions with a single forward pass
+
+        Reactions are canonicalized and looked up in the score cache first;
+        only the misses are fingerprinted (once per distinct product) and
+        sent through the model.
+
+        Arguments:
+            reactions {list} -- (reactant_smiles, product_smiles) pairs
+
+        Returns:
+            list -- float scores in the same order as reactions; None for
+                reactions whose SMILES could not be parsed
+        """
+        keys = [(canonical_smiles(reactant_smiles), canonical_smiles(target))
+                for (reactant_smiles, target) in reactions]
+        (scores, pending) = self._lookup(keys, [key[0] is not None and key[1] is not None for key in keys])
+        if not pending:
+            return scores
+
+        pfps = {}
+        keys = []
+        pfp_rows = []
+        rfp_rows = []
+        for key in pending:
+            (reactant_smiles, target) = key
+            if target not in pfps:
+                pfps[target] = smiles_to_morgan_fp(target, radius=2, nBits=2048)
+            keys.append(key)
+            pfp_rows.append(pfps[target])
+            rfp_rows.append(smiles_to_morgan_fp(reactant_smiles, radius=2, nBits=2048))
+        pfp = np.vstack(pfp_rows)
+        self._predict_pending(keys, pending, pfp, np.vstack(rfp_rows), scores)
+        return scores
+
+    def score_for_product(self, reactant_smiles_list, target):
+        """Score many precursor sets for a single product
+
+        This is the retro expansion case: the product fingerprint is computed
+        once and the difference fingerprints for all reactant sets are built
+        in one vectorized step before a single predict call.
+
+        Arguments:
+            reactant_smiles_list {list} -- reactant SMILES strings (dot-joined
+                per precursor set)
+            target {string} -- product SMILES
+
+        Returns:
+            list -- float scores in the same order as reactant_smiles_list;
+                None for unparsable reactants (or all None for an
+                unparsable product)
+        """
+        target = canonical_smiles(target)
+        if target is None:
+            return [None] * len(reactant_smiles_list)
+        keys = [(canonical_smiles(reactant_smiles), target) for reactant_smiles in reactant_smiles_list]
+        (scores, pending) = self._lookup(keys, [key[0] is not None for key in keys])
+        if not pending:
+            return scores
+
+        keys = list(pending)
+        rfp = np.vstack([smiles_to_morgan_fp(key[0], radius=2, nBits=2048) for key in keys])
+        pfp = np.broadcast_to(smiles_to_morgan_fp(target, radius=2, nBits=2048), rfp.shape)
+        self._predict_pending(keys, pending, pfp, rfp, scores)
+        return scores
+
+    def _lookup(self, keys, valid):
+        """Looks up the valid keys in the score cache with one get_many
+        call. Returns the cached scores (None for keys that are invalid or
+        not cached) and a dict mapping each key that still has to be scored
+        to its indices"""
+        scores = [None] * len(keys)
+        if self.score_cache is not None:
+            valid_idx = [i for i in range(len(keys)) if valid[i]]
+            for (i, score) in zip(valid_idx, self.score_cache.get_many([keys[i] for i in valid_idx])):
+                scores[i] = score
+        pending = {}
+        for (i, key) in enumerate(keys):
+            if valid[i] and scores[i] is None:
+                pending.setdefault(key, []).append(i)
+        return (scores, pending)
 
-        score = self.model.predict([pfp.reshape(1, 2048), rxnfp.reshape(1, 2048)])
-        filter_flag = (score > threshold)
-        return filter_flag, float(score)
+    def _predict_pending(self, keys, pending, pfp, rfp, scores):
+        """Runs one forward pass for the cache misses in keys, writes the
+        results into scores (at the indices in pending) and caches them"""
+        predictions = [float(score) for score in self.model.predict([pfp, pfp - rfp])[:, 0]]
+        for (key, score) in zip(keys, predictions):
+            for i in pending[key]:
+                scores[i] = score
+        if self.score_cache is not None:
+            self.score_cache.put_many([key + (score,) for (key, score) in zip(keys, predictions)])
 
+    def cache_stats(self):
+        if self.score_cache is None:
+            return {}
+        return self.score_cache.stats()
 
 if __name__ == "__main__":
 
     ff = FastFilterScorer()
-    ff.load(model_path=gc.FAST_FILTER_MODEL['trained_model_path'])
+    ff.load()
     score = ff.evaluate('CCO.CC(=O)O', 'CCOC(=O)C')
     print(score)
     score = ff.evaluate('[CH3:1][C:2](=[O:3])[O:4][CH:5]1[CH:6]([O:7][C:8]([CH3:9])=[O:10])[CH:11]([CH2:12][O:13][C:14]([CH3:15])=[O:16])[O:17][CH:18]([O:19][CH2:20][CH2:21][CH2:22][CH2:23][CH2:24][CH2:25][CH2:26][CH2:27][CH2:28][CH3:29])[CH:30]1[O:31][C:32]([CH3:33])=[O:34].[CH3:35][O-:36].[CH3:38][OH:39].[Na+:37]', 'CCCCCCCCCCOC1OC(CO)C(O)C(O)C1O')
@@ -87,3 +321,4 @@ if __name__ == "__main__":
     flag, sco = ff.filter_with_threshold('CCO.CC(=O)O', 'CCOC(=O)C', 0.75)
     print(flag)
     print(sco)
+    print(ff.cache_stats())
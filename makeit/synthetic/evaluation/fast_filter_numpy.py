@@ -0,0 +1,304 @@
+'''
+Pure-numpy inference for the fast filter network.
+
+The Keras model (two 2048-bit inputs, Dense / Highway_self stacks, a merge
+and a sigmoid output) is exported once with export_keras_model, which stores
+the functional-model config as JSON next to every layer's weights in a .npz.
+NumpyModel then replays that graph with numpy only, so workers that only
+need to score reactions never import Keras or Theano.
+
+The export also stores a parity sample: a batch of inputs and the outputs
+Keras gave for them. NumpyModel.load replays the sample and refuses the
+export (ValueError) if its outputs do not match, so a layer that numpy
+reproduces differently is never used silently.
+'''
+
+import json
+import numpy as np
+from makeit.utilities.io.logger import MyLogger
+fast_filter_numpy_loc = 'fast_filter_numpy'
+
+PARITY_SAMPLES = 16 # rows of the parity sample stored with an export
+PARITY_RTOL = 1e-4 # tolerance of the parity check, relative to the Keras outputs
+PARITY_ATOL = 1e-5
+
+
+def _sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def _elu(x, alpha=1.0):
+    return np.where(x > 0, x, alpha * (np.exp(np.minimum(x, 0)) - 1))
+
+
+def _softmax(x):
+    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+def _selu(x):
+    alpha = 1.6732632423543772848170429916717
+    scale = 1.0507009873554804934193349852946
+    return scale * _elu(x, alpha)
+
+
+ACTIVATIONS = {
+    None: lambda x: x,
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'elu': _elu,
+    'selu': _selu,
+    'sigmoid': _sigmoid,
+    'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0., 1.),
+    'tanh': np.tanh,
+    'softmax': _softmax,
+    'softplus': lambda x: np.logaddexp(0, x),
+    'softsign': lambda x: x / (1 + np.abs(x)),
+}
+
+
+def get_activation(name):
+    if name not in ACTIVATIONS:
+        raise ValueError('Unsupported activation in fast filter model: {}'.format(name))
+    return ACTIVATIONS[name]
+
+
+def _dense(config, weights, inputs):
+    x = np.dot(inputs[0], weights[0])
+    if config.get('use_bias', True):
+        x = x + weights[1]
+    return get_activation(config.get('activation'))(x)
+
+
+def _highway(config, weights, inputs):
+    x = inputs[0]
+    kernel, bias, kernel_T, bias_T = weights
+    transform_fun = get_activation(config.get('activation', 'elu'))(np.dot(x, kernel) + bias)
+    transform_gate = _sigmoid(np.dot(x, kernel_T) + bias_T)
+    return transform_fun * transform_gate + x * (1. - transform_gate)
+
+
+def _batchnorm(config, weights, inputs):
+    weights = list(weights)
+    gamma = weights.pop(0) if config.get('scale', True) else 1.
+    beta = weights.pop(0) if config.get('center', True) else 0.
+    mean, var = weights
+    return (inputs[0] - mean) / np.sqrt(var + config.get('epsilon', 1e-3)) * gamma + beta
+
+
+def _merge(config, weights, inputs):
+    # Keras 1 style Merge layer
+    mode = config.get('mode', 'sum')
+    if mode == 'sum':
+        return _add(config, weights, inputs)
+    if mode == 'mul':
+        return _multiply(config, weights, inputs)
+    if mode == 'ave':
+        return _add(config, weights, inputs) / len(inputs)
+    if mode == 'max':
+        return _maximum(config, weights, inputs)
+    if mode == 'concat':
+        return np.concatenate(inputs, axis=config.get('concat_axis', -1))
+    raise ValueError('Unsupported merge mode in fast filter model: {}'.format(mode))
+
+
+def _add(config, weights, inputs):
+    out = inputs[0]
+    for x in inputs[1:]:
+        out = out + x
+    return out
+
+
+def _multiply(config, weights, inputs):
+    out = inputs[0]
+    for x in inputs[1:]:
+        out = out * x
+    return out
+
+
+def _maximum(config, weights, inputs):
+    out = inputs[0]
+    for x in inputs[1:]:
+        out = np.maximum(out, x)
+    return out
+
+
+LAYERS = {
+    'Dense': _dense,
+    'Highway_self': _highway,
+    'BatchNormalization': _batchnorm,
+    'Activation': lambda config, weights, inputs: get_activation(config.get('activation'))(inputs[0]),
+    'Dropout': lambda config, weights, inputs: inputs[0],
+    'Flatten': lambda config, weights, inputs: inputs[0].reshape(inputs[0].shape[0], -1),
+    'Merge': _merge,
+    'Add': _add,
+    'Subtract': lambda config, weights, inputs: inputs[0] - inputs[1],
+    'Multiply': _multiply,
+    'Average': lambda config, weights, inputs: _add(config, weights, inputs) / len(inputs),
+    'Maximum': _maximum,
+    'Concatenate': lambda config, weights, inputs: np.concatenate(inputs, axis=config.get('axis', -1)),
+}
+
+
+def _inbound_names(layer_config):
+    '''Names of the layers feeding into a (non-shared) layer'''
+    nodes = layer_config.get('inbound_nodes', [])
+    if not nodes:
+        return []
+    if len(nodes) > 1:
+        raise ValueError('Shared layers are not supported by the numpy fast filter ({})'.format(
+            layer_config['name']))
+    return [inbound[0] for inbound in nodes[0]]
+
+
+class NumpyModel(object):
+    '''
+    Replays an exported Keras functional model with numpy. predict() has the
+    same call signature as keras.models.Model.predict for our purposes and
+    holds no mutable state, so one instance can be shared between threads.
+    '''
+
+    def __init__(self, config, weights, dtype=np.float32):
+        self.dtype = dtype
+        self.input_names = [x[0] for x in config['input_layers']]
+        self.output_names = [x[0] for x in config['output_layers']]
+        self.layers = []
+        for layer_config in config['layers']:
+            class_name = layer_config['class_name']
+            name = layer_config['name']
+            if class_name == 'InputLayer':
+                continue
+            if class_name not in LAYERS:
+                raise ValueError('Unsupported layer in fast filter model: {} ({})'.format(name, class_name))
+            self.layers.append((
+                name,
+                LAYERS[class_name],
+                layer_config.get('config', {}),
+                [w.astype(dtype) for w in weights.get(name, [])],
+                _inbound_names(layer_config),
+            ))
+
+    @classmethod
+    def load(cls, npz_path, dtype=np.float32, check_parity=True):
+        '''Loads an export of export_keras_model. Unless check_parity is
+        False, raises ValueError if the export has no parity sample or the
+        numpy outputs for it differ from the stored Keras outputs'''
+        MyLogger.print_and_log('Loading numpy fast filter from {}'.format(npz_path), fast_filter_numpy_loc)
+        parity_inputs = {}
+        parity_output = None
+        with np.load(npz_path) as data:
+            config = json.loads(str(data['config']))
+            weights = {}
+            for key in data.files:
+                if key == 'config':
+                    continue
+                if key == 'parity/output':
+                    parity_output = data[key]
+                    continue
+                if key.startswith('parity/input/'):
+                    parity_inputs[int(key.rsplit('/', 1)[1])] = data[key]
+                    continue
+                name, i = key.rsplit('/', 1)
+                weights.setdefault(name, []).append((int(i), data[key]))
+        weights = {name: [w for (_, w) in sorted(ws, key=lambda x: x[0])]
+                   for (name, ws) in weights.items()}
+        model = cls(config, weights, dtype=dtype)
+        if check_parity:
+            if parity_output is None:
+                raise ValueError('{} has no parity sample, export it again with export_keras_model'.format(npz_path))
+            model.check_parity([parity_inputs[i] for i in sorted(parity_inputs)], parity_output)
+        return model
+
+    def check_parity(self, inputs, expected):
+        '''Raises ValueError if predict(inputs) does not match expected, the
+        outputs of the Keras model for the same inputs'''
+        outputs = self.predict(inputs)
+        if outputs.shape != expected.shape or \
+                not np.allclose(outputs, expected, rtol=PARITY_RTOL, atol=PARITY_ATOL):
+            diff = np.max(np.abs(outputs - expected)) if outputs.shape == expected.shape else 'shape mismatch'
+            raise ValueError('Numpy fast filter does not reproduce the Keras outputs (max abs difference {})'.format(diff))
+
+    def predict(self, inputs, batch_size=None):
+        '''
+        Evaluate the network
+
+        Arguments:
+            inputs {list of np.ndarray} -- One (N, d) array per model input,
+                in the same order as the Keras model
+
+        Returns:
+            np.ndarray -- (N, k) output of the first model output
+        '''
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        if len(inputs) != len(self.input_names):
+            raise ValueError('Fast filter expects {} inputs, got {}'.format(
+                len(self.input_names), len(inputs)))
+        tensors = {}
+        for (name, x) in zip(self.input_names, inputs):
+            x = np.asarray(x, dtype=self.dtype)
+            if x.ndim == 1:
+                x = x.reshape(1, -1)
+            tensors[name] = x
+        for (name, fn, config, weights, inbound) in self.layers:
+            tensors[name] = fn(config, weights, [tensors[i] for i in inbound])
+        return tensors[self.output_names[0]]
+
+
+def parity_sample(model, num_samples=PARITY_SAMPLES, seed=0):
+    '''Random fingerprint-like inputs for each input of a Keras model: bits
+    for the first input, differences of bits (-1, 0, 1) for the others, as
+    the fast filter takes a product and a reaction fingerprint'''
+    rng = np.random.RandomState(seed)
+    inputs = []
+    for (i, shape) in enumerate(model.input_shape if isinstance(model.input_shape, list) else [model.input_shape]):
+        bits = rng.randint(0, 2, size=(num_samples, shape[-1]))
+        if i > 0:
+            bits = bits - rng.randint(0, 2, size=(num_samples, shape[-1]))
+        inputs.append(bits.astype(np.float32))
+    return inputs
+
+
+def export_keras_model(model, npz_path, parity_inputs=None):
+    '''
+    Dump a loaded Keras fast filter model (architecture + weights) to a .npz
+    readable by NumpyModel.load, with the Keras outputs for parity_inputs
+    (default: parity_sample(model)) as its parity sample. Needs Keras, but
+    only has to be run once. Raises ValueError if the export does not
+    reproduce the Keras outputs.
+    '''
+    config = model.get_config()
+    arrays = {}
+    for (layer, layer_config) in zip(model.layers, config['layers']):
+        if layer.__class__.__name__ == 'Highway_self':
+            # Custom layer does not serialize its activation
+            layer_config.setdefault('config', {})['activation'] = layer.activation.__name__
+        for (i, w) in enumerate(layer.get_weights()):
+            arrays['{}/{}'.format(layer.name, i)] = w
+    arrays['config'] = np.array(json.dumps(config))
+    if parity_inputs is None:
+        parity_inputs = parity_sample(model)
+    for (i, x) in enumerate(parity_inputs):
+        arrays['parity/input/{}'.format(i)] = np.asarray(x, dtype=np.float32)
+    arrays['parity/output'] = np.asarray(model.predict(list(parity_inputs)), dtype=np.float32)
+    np.savez(npz_path, **arrays)
+    NumpyModel.load(npz_path) # parity check
+    MyLogger.print_and_log('Exported fast filter to {}'.format(npz_path), fast_filter_numpy_loc)
+
+
+if __name__ == '__main__':
+    import argparse
+    import makeit.global_config as gc
+    from makeit.synthetic.evaluation.fast_filter import FastFilterScorer
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default=gc.FAST_FILTER_MODEL['trained_model_path'],
+                        help='Keras .h5 fast filter model to export')
+    parser.add_argument('--out', type=str, default=gc.FAST_FILTER_MODEL['numpy_model_path'],
+                        help='Destination .npz file')
+    args = parser.parse_args()
+
+    ff = FastFilterScorer()
+    ff.load(model_path=args.model_path)
+    export_keras_model(ff.model, args.out) # raises if numpy does not match Keras
+    print('Exported {} to {}, parity check passed'.format(args.model_path, args.out))
@@ -0,0 +1,134 @@
+'''
+Parity of the numpy fast filter engine with Keras.
+
+The Keras test exports a small model with a Highway_self layer and compares
+both engines on the same inputs; it is skipped where Keras is not installed.
+The other tests replay a hand-written export against a direct numpy
+transcription of the Keras layers and check that exports whose stored
+parity sample does not match are refused.
+'''
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from makeit.synthetic.evaluation.fast_filter_numpy import NumpyModel, export_keras_model, parity_sample
+
+DIM = 16
+HIDDEN = 8
+
+
+def layer(name, class_name, config, inbound):
+    return {'name': name, 'class_name': class_name, 'config': config,
+            'inbound_nodes': [[[i, 0, 0, {}] for i in inbound]] if inbound else []}
+
+
+def reference(weights, product, reaction):
+    '''The network of small_export, written out as Keras computes it'''
+    x = np.asarray(product, dtype=np.float64)
+    y = np.asarray(reaction, dtype=np.float64)
+    (W1, b1), (W2, b2) = weights['dense_product'], weights['dense_reaction']
+    p = np.maximum(np.dot(x, W1) + b1, 0)
+    r = np.maximum(np.dot(y, W2) + b2, 0)
+    (kernel, bias, kernel_T, bias_T) = weights['highway']
+    h = np.dot(r, kernel) + bias
+    transform_fun = np.where(h > 0, h, np.exp(np.minimum(h, 0)) - 1) # elu
+    transform_gate = 1. / (1. + np.exp(-(np.dot(r, kernel_T) + bias_T)))
+    r = transform_fun * transform_gate + r * (1. - transform_gate)
+    (W3, b3) = weights['output']
+    return 1. / (1. + np.exp(-(np.dot(p * r, W3) + b3)))
+
+
+def small_export(rng):
+    '''Config and weights of a two-input Dense / Highway_self / multiply /
+    sigmoid network, in the format of export_keras_model'''
+    config = {
+        'input_layers': [['product', 0, 0], ['reaction', 0, 0]],
+        'output_layers': [['output', 0, 0]],
+        'layers': [
+            layer('product', 'InputLayer', {}, []),
+            layer('reaction', 'InputLayer', {}, []),
+            layer('dense_product', 'Dense', {'activation': 'relu'}, ['product']),
+            layer('dense_reaction', 'Dense', {'activation': 'relu'}, ['reaction']),
+            layer('highway', 'Highway_self', {'activation': 'elu'}, ['dense_reaction']),
+            layer('merged', 'Multiply', {}, ['dense_product', 'highway']),
+            layer('output', 'Dense', {'activation': 'sigmoid'}, ['merged']),
+        ],
+    }
+    weights = {
+        'dense_product': [rng.randn(DIM, HIDDEN) * 0.3, rng.randn(HIDDEN) * 0.1],
+        'dense_reaction': [rng.randn(DIM, HIDDEN) * 0.3, rng.randn(HIDDEN) * 0.1],
+        'highway': [rng.randn(HIDDEN, HIDDEN) * 0.3, rng.randn(HIDDEN) * 0.1,
+                    rng.randn(HIDDEN, HIDDEN) * 0.3, rng.randn(HIDDEN) * 0.1],
+        'output': [rng.randn(HIDDEN, 1), rng.randn(1)],
+    }
+    return (config, weights)
+
+
+def save_export(path, config, weights, parity_inputs=None, parity_output=None):
+    arrays = {'config': np.array(json.dumps(config))}
+    for (name, ws) in weights.items():
+        for (i, w) in enumerate(ws):
+            arrays['{}/{}'.format(name, i)] = w
+    if parity_output is not None:
+        for (i, x) in enumerate(parity_inputs):
+            arrays['parity/input/{}'.format(i)] = x
+        arrays['parity/output'] = parity_output
+    np.savez(path, **arrays)
+
+
+class TestNumpyFastFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'fast_filter.npz')
+        rng = np.random.RandomState(0)
+        (self.config, self.weights) = small_export(rng)
+        self.inputs = [rng.randint(0, 2, size=(32, DIM)).astype(np.float32),
+                       (rng.randint(0, 2, size=(32, DIM)) - rng.randint(0, 2, size=(32, DIM))).astype(np.float32)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_matches_reference(self):
+        expected = reference(self.weights, *self.inputs)
+        save_export(self.path, self.config, self.weights, self.inputs, expected.astype(np.float32))
+        model = NumpyModel.load(self.path)
+        np.testing.assert_allclose(model.predict(self.inputs), expected, rtol=1e-5, atol=1e-6)
+
+    def test_refuses_mismatched_export(self):
+        expected = reference(self.weights, *self.inputs)
+        save_export(self.path, self.config, self.weights, self.inputs, (expected + 0.01).astype(np.float32))
+        with self.assertRaises(ValueError):
+            NumpyModel.load(self.path)
+
+    def test_refuses_export_without_parity_sample(self):
+        save_export(self.path, self.config, self.weights)
+        with self.assertRaises(ValueError):
+            NumpyModel.load(self.path)
+        NumpyModel.load(self.path, check_parity=False)
+
+    def test_matches_keras(self):
+        try:
+            from keras.layers import Dense, Input, multiply
+            from keras.models import Model
+            from makeit.utilities.fastfilter_utilities import Highway_self
+        except ImportError:
+            self.skipTest('Keras is not installed')
+        product = Input(shape=(DIM,), name='product')
+        reaction = Input(shape=(DIM,), name='reaction')
+        p = Dense(HIDDEN, activation='relu')(product)
+        r = Highway_self(activation='elu')(Dense(HIDDEN, activation='relu')(reaction))
+        output = Dense(1, activation='sigmoid')(multiply([p, r]))
+        model = Model(inputs=[product, reaction], outputs=output)
+
+        export_keras_model(model, self.path)
+        inputs = parity_sample(model, num_samples=64, seed=1)
+        np.testing.assert_allclose(NumpyModel.load(self.path).predict(inputs), model.predict(inputs),
+                                   rtol=1e-4, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
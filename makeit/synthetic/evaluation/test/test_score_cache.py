@@ -0,0 +1,74 @@
+'''
+FastFilterScoreCache: batched lookups against the memory and sqlite tiers,
+and commits of new scores every commit_rows rows and on flush.
+'''
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from makeit.synthetic.evaluation.fast_filter import FastFilterScoreCache
+
+
+class TestScoreCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'scores.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def committed_rows(self):
+        db = sqlite3.connect(self.path)
+        try:
+            return db.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+        finally:
+            db.close()
+
+    def test_get_many(self):
+        cache = FastFilterScoreCache('model', path=self.path)
+        items = [('C' * i, 'N', i / 1000.) for i in range(1, 1001)]
+        cache.put_many(items)
+        cache.close()
+
+        cache = FastFilterScoreCache('model', path=self.path)
+        cache.put_many([('O', 'N', 0.5)]) # in memory
+        keys = [('O', 'N'), ('C', 'N'), ('unknown', 'N'), ('C', 'N')] + [item[:2] for item in items[1:]]
+        scores = cache.get_many(keys)
+        self.assertEqual(scores[:4], [0.5, 0.001, None, 0.001])
+        self.assertEqual(scores[4:], [item[2] for item in items[1:]])
+        self.assertEqual(cache.disk_hits, 1000)
+        # the disk hits are now in memory
+        self.assertEqual(cache.get('CC', 'N'), 0.002)
+        self.assertEqual(cache.disk_hits, 1000)
+        # scores of another model are not shared
+        self.assertEqual(FastFilterScoreCache('other', path=self.path).get_many(keys[:2]), [None, None])
+        cache.close()
+
+    def test_batched_commits(self):
+        cache = FastFilterScoreCache('model', path=self.path, commit_rows=10)
+        cache.put_many([('C' * i, 'N', 0.1) for i in range(1, 6)])
+        self.assertEqual(self.committed_rows(), 0)
+        self.assertEqual(cache.get('C', 'N'), 0.1)
+        cache.put_many([('O' * i, 'N', 0.2) for i in range(1, 6)])
+        self.assertEqual(self.committed_rows(), 10)
+        cache.put_many([('N' * i, 'C', 0.3) for i in range(1, 4)])
+        self.assertEqual(self.committed_rows(), 10)
+        cache.flush()
+        self.assertEqual(self.committed_rows(), 13)
+        cache.put_many([('S', 'N', 0.4)])
+        cache.close()
+        self.assertEqual(self.committed_rows(), 14)
+
+    def test_memory_only(self):
+        cache = FastFilterScoreCache('model')
+        cache.put_many([('C', 'N', 0.1)])
+        self.assertEqual(cache.get_many([('C', 'N'), ('O', 'N')]), [0.1, None])
+        cache.flush()
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+'''
+Bloom filter over 64-bit SMILES hashes (see makeit.utilities.hashing).
+
+It answers "definitely not present" for a SMILES without touching the full
+buyables / chemical history tables. Filters are built together with the
+hashed stores and saved as a small .npz, a few MB for millions of entries
+at a 1% false positive rate.
+'''
+
+import math
+import numpy as np
+from makeit.utilities.hashing import smiles_hash, smiles_hashes
+
+
+class BloomFilter(object):
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = int(num_bits)
+        self.num_hashes = int(num_hashes)
+        if bits is None:
+            bits = np.zeros(((self.num_bits + 7) // 8,), dtype=np.uint8)
+        self.bits = bits
+
+    @classmethod
+    def for_capacity(cls, n, error_rate=0.01):
+        '''Empty filter sized for n entries at the given false positive rate'''
+        n = max(int(n), 1)
+        num_bits = int(math.ceil(-n * math.log(error_rate) / math.log(2) ** 2))
+        num_hashes = max(1, int(round(float(num_bits) / n * math.log(2))))
+        return cls(num_bits, num_hashes)
+
+    @classmethod
+    def from_hashes(cls, hashes, error_rate=0.01):
+        bloom = cls.for_capacity(len(hashes), error_rate=error_rate)
+        bloom.add_hashes(hashes)
+        return bloom
+
+    def _positions(self, hashes):
+        # Double hashing: the i-th probe is h1 + i * h2 (mod num_bits)
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        i = np.arange(self.num_hashes, dtype=np.uint64)
+        return (h1[:, None] + i[None, :] * h2[:, None]) % np.uint64(self.num_bits)
+
+    def add_hashes(self, hashes):
+        positions = self._positions(hashes).ravel()
+        if not len(positions):
+            return
+        unpacked = np.unpackbits(self.bits, bitorder='little')[:self.num_bits]
+        unpacked[positions.astype(np.int64)] = 1
+        self.bits = np.packbits(unpacked, bitorder='little')
+
+    def contains_hashes(self, hashes):
+        '''Boolean array, False where the hash is definitely not present'''
+        positions = self._positions(hashes)
+        if not positions.size:
+            return np.zeros((positions.shape[0],), dtype=bool)
+        set_bits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return set_bits.all(axis=1)
+
+    def might_contain(self, smiles):
+        return bool(self.contains_hashes([smiles_hash(smiles)])[0])
+
+    def might_contain_many(self, smiles_list):
+        return self.contains_hashes(smiles_hashes(smiles_list))
+
+    def save(self, path):
+        np.savez(path, bits=self.bits, num_bits=self.num_bits, num_hashes=self.num_hashes)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(int(data['num_bits']), int(data['num_hashes']), data['bits'])
@@ -0,0 +1,147 @@
+import os
+import numpy as np
+import makeit.utilities.io.pickle as pickle
+from makeit.utilities.hashing import smiles_hash, smiles_hashes
+from makeit.utilities.io.logger import MyLogger
+from makeit.utilities.bloom import BloomFilter
+hashed_prices_loc = 'hashed_prices'
+
+
+class HashedPriceTable(object):
+    '''
+    Read-only SMILES -> price per gram mapping stored as flat numpy arrays
+    instead of a dict, so it can be memory-mapped and shared between
+    processes.
+
+    hashes are the sorted 64-bit hashes of the SMILES strings, prices the
+    matching float32 ppg values. Hash hits are verified against the original
+    strings (a utf-8 blob indexed by offsets), so lookups are exact even if
+    two SMILES collide. Behaves like the defaultdict(float) it replaces:
+    unknown SMILES have a price of 0.
+    '''
+
+    FIELDS = ('hashes', 'prices', 'offsets', 'strings')
+
+    def __init__(self, hashes, prices, offsets, strings):
+        self.hashes = hashes
+        self.prices = prices
+        self.offsets = offsets
+        self.strings = strings
+
+    @classmethod
+    def from_dict(cls, prices):
+        # 0 ppg means not buyable, so those entries do not need to be stored
+        items = [(smiles, ppg) for (smiles, ppg) in prices.items() if ppg]
+        encoded = [smiles.encode('utf-8') for (smiles, _) in items]
+        hashes = np.fromiter((smiles_hash(smiles) for smiles in encoded), dtype=np.uint64, count=len(items))
+        order = np.argsort(hashes, kind='mergesort')
+
+        encoded = [encoded[i] for i in order]
+        offsets = np.zeros((len(encoded) + 1,), dtype=np.int64)
+        np.cumsum([len(smiles) for smiles in encoded], out=offsets[1:])
+        strings = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(hashes[order], np.array([items[i][1] for i in order], dtype=np.float32), offsets, strings)
+
+    @staticmethod
+    def paths(directory, name):
+        return [os.path.join(directory, '{}_{}.npy'.format(name, field)) for field in HashedPriceTable.FIELDS]
+
+    def save(self, directory, name):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for (field, path) in zip(self.FIELDS, self.paths(directory, name)):
+            np.save(path, getattr(self, field))
+
+    @classmethod
+    def load(cls, directory, name, mmap_mode='r'):
+        return cls(*[np.load(path, mmap_mode=mmap_mode) for path in cls.paths(directory, name)])
+
+    def smiles_at(self, i):
+        return self.strings[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def index(self, smiles):
+        '''Position of smiles in the table, or -1 if it is not present'''
+        if isinstance(smiles, bytes):
+            smiles = smiles.decode('utf-8')
+        h = np.uint64(smiles_hash(smiles))
+        i = int(np.searchsorted(self.hashes, h))
+        while i < len(self.hashes) and self.hashes[i] == h:
+            if self.smiles_at(i) == smiles:
+                return i
+            i += 1
+        return -1
+
+    def get_many(self, smiles_list):
+        '''Prices for a list of SMILES as a float32 array (0 if not present),
+        resolved with one vectorized search over the hash array'''
+        smiles_list = [smiles.decode('utf-8') if isinstance(smiles, bytes) else smiles for smiles in smiles_list]
+        prices = np.zeros((len(smiles_list),), dtype=np.float32)
+        if not smiles_list or not len(self.hashes):
+            return prices
+        hashes = smiles_hashes(smiles_list)
+        idx = np.searchsorted(self.hashes, hashes)
+        found = self.hashes[np.minimum(idx, len(self.hashes) - 1)] == hashes
+        for j in np.flatnonzero(found):
+            i = int(idx[j])
+            if self.smiles_at(i) != smiles_list[j]:
+                i = self.index(smiles_list[j]) # hash collision, check the other candidates
+            if i >= 0:
+                prices[j] = self.prices[i]
+        return prices
+
+    def get(self, smiles, default=0.):
+        i = self.index(smiles)
+        if i < 0:
+            return default
+        return float(self.prices[i])
+
+    def __getitem__(self, smiles):
+        return self.get(smiles)
+
+    def __contains__(self, smiles):
+        return self.index(smiles) >= 0
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+def bloom_path(directory):
+    return os.path.join(directory, 'bloom.npz')
+
+
+def build_bloom(*tables):
+    '''Bloom filter over every SMILES with a non-zero price in any of the
+    given HashedPriceTables'''
+    return BloomFilter.from_hashes(np.unique(np.concatenate([table.hashes for table in tables])))
+
+
+def hashed_store_mtime(directory):
+    '''Time the hashed store in directory was written, or None if it is
+    missing or incomplete'''
+    paths = HashedPriceTable.paths(directory, 'chiral') + HashedPriceTable.paths(directory, 'flat')
+    if not all(os.path.isfile(path) for path in paths):
+        return None
+    return min(os.path.getmtime(path) for path in paths)
+
+
+def build_hashed_store(file_path, directory):
+    '''Converts a pickled pricer (prices, prices_flat) into the hashed,
+    memory-mappable format read by Pricer.load'''
+    MyLogger.print_and_log('Building hashed buyables store from {}'.format(file_path), hashed_prices_loc)
+    with open(file_path, 'rb') as file:
+        prices = pickle.load(file)
+        prices_flat = pickle.load(file)
+    chiral = HashedPriceTable.from_dict(prices)
+    flat = HashedPriceTable.from_dict(prices_flat)
+    chiral.save(directory, 'chiral')
+    flat.save(directory, 'flat')
+    build_bloom(chiral, flat).save(bloom_path(directory))
+    MyLogger.print_and_log('Saved hashed buyables store to {}'.format(directory), hashed_prices_loc)
+
+
+if __name__ == '__main__':
+    import makeit.global_config as gc
+    from makeit.utilities.io.files import get_pricer_path, get_pricer_hashed_path
+    args = (gc.CHEMICALS['database'], gc.CHEMICALS['collection'],
+            gc.BUYABLES['database'], gc.BUYABLES['collection'])
+    build_hashed_store(get_pricer_path(*args), get_pricer_hashed_path(*args))
@@ -1,13 +1,19 @@
 import makeit.global_config as gc
+import numpy as np
 import rdkit.Chem as Chem
 from collections import defaultdict
 from tqdm import tqdm
 from makeit.utilities.io.logger import MyLogger
+from makeit.utilities.buyable.hashed_prices import HashedPriceTable, hashed_store_mtime, bloom_path, build_bloom
+from makeit.utilities.bloom import BloomFilter
+from makeit.utilities.fingerprinting import canonical_smiles
 import makeit.utilities.io.pickle as pickle
 from pymongo import MongoClient
 from multiprocessing import Manager
+import threading
 import os
 pricer_loc = 'pricer'
+_deferred_lock = threading.Lock()
 
 
 class Pricer:
@@ -24,6 +30,9 @@ class Pricer:
         self.prices = defaultdict(float)  # default 0 ppg means not buyable
         # default 0 ppg means not buyable
         self.prices_flat = defaultdict(float)
+        # optional prescreen; a negative answer means "definitely not buyable"
+        self.bloom = None
+        self._deferred_path = None
 
     def load_databases(self):
         '''
@@ -44,18 +53,33 @@ class Pricer:
             pickle.dump(self.prices, file)
             pickle.dump(self.prices_flat, file)
 
-    def load(self):
+    def load(self, lazy=False):
         '''
         Load the data for the pricer from a locally stored file instead of from the online database.
+
+        If a hashed, memory-mapped copy of the file exists (see
+        makeit.utilities.buyable.hashed_prices) and is up to date, it is used
+        instead of unpickling the full catalog into dicts. With lazy=True
+        only its Bloom filter is loaded up front; the price tables are mapped
+        the first time a lookup gets past the filter.
         '''
-        from makeit.utilities.io.files import get_pricer_path
+        from makeit.utilities.io.files import get_pricer_path, get_pricer_hashed_path
         file_path = get_pricer_path(
             gc.CHEMICALS['database'], 
             gc.CHEMICALS['collection'], 
             gc.BUYABLES['database'], 
             gc.BUYABLES['collection'],
         )
-        if os.path.isfile(file_path):
+        hashed_path = get_pricer_hashed_path(
+            gc.CHEMICALS['database'], 
+            gc.CHEMICALS['collection'], 
+            gc.BUYABLES['database'], 
+            gc.BUYABLES['collection'],
+        )
+        hashed_mtime = hashed_store_mtime(hashed_path)
+        if hashed_mtime is not None and (not os.path.isfile(file_path) or hashed_mtime >= os.path.getmtime(file_path)):
+            self.load_hashed(hashed_path, lazy=lazy)
+        elif os.path.isfile(file_path):
             with open(file_path, 'rb') as file:
                 self.prices = defaultdict(float, pickle.load(file))
                 self.prices_flat = defaultdict(float, pickle.load(file))
@@ -64,6 +88,54 @@ class Pricer:
             self.load_from_database()
             self.dump_to_file(file_path)
 
+    def load_hashed(self, directory, mmap_mode='r', lazy=False):
+        '''
+        Load prices from a hashed store, memory-mapped by default so the
+        arrays are shared between processes through the page cache. The
+        store's Bloom filter, if present, is used to skip negative lookups.
+        '''
+        if os.path.isfile(bloom_path(directory)):
+            self.bloom = BloomFilter.load(bloom_path(directory))
+            if lazy:
+                self._deferred_path = directory
+                return
+        MyLogger.print_and_log('Loading hashed buyables store from {}'.format(directory), pricer_loc)
+        self.prices = HashedPriceTable.load(directory, 'chiral', mmap_mode=mmap_mode)
+        self.prices_flat = HashedPriceTable.load(directory, 'flat', mmap_mode=mmap_mode)
+
+    def dump_to_hashed(self, directory):
+        '''
+        Write the loaded prices to a hashed store readable by load_hashed
+        '''
+        chiral = HashedPriceTable.from_dict(self.prices)
+        flat = HashedPriceTable.from_dict(self.prices_flat)
+        chiral.save(directory, 'chiral')
+        flat.save(directory, 'flat')
+        build_bloom(chiral, flat).save(bloom_path(directory))
+
+    def might_be_buyable(self, smiles):
+        '''
+        False if the Bloom filter says smiles (as entered) is definitely not
+        in the catalog; True otherwise, in which case the full tables are
+        loaded if they were deferred
+        '''
+        if self.bloom is not None and not self.bloom.might_contain(smiles):
+            return False
+        self.load_deferred()
+        return True
+
+    def load_deferred(self):
+        '''
+        Maps the price tables of a store loaded with lazy=True, if that has
+        not happened yet. Threads looking up prices at the same time wait
+        for the tables instead of reading the empty ones
+        '''
+        if self._deferred_path is not None:
+            with _deferred_lock:
+                if self._deferred_path is not None:
+                    self.load_hashed(self._deferred_path)
+                    self._deferred_path = None
+
     def load_from_database(self, max_ppg=1e10):
         '''
         Loads the object from a MongoDB collection containing transform
@@ -117,13 +189,14 @@ class Pricer:
         re-canonicalizes it in RDKit unl ess the user specifies that
         the string is definitely already canonical.
         '''
-        ppg = self.prices_flat[smiles]
-        if ppg:
-            return ppg
+        if self.might_be_buyable(smiles):
+            ppg = self.prices_flat.get(smiles, 0.)
+            if ppg:
+                return ppg
 
-        ppg = self.prices[smiles]
-        if ppg:
-            return ppg
+            ppg = self.prices.get(smiles, 0.)
+            if ppg:
+                return ppg
 
         if not alreadyCanonical:
             mol = Chem.MolFromSmiles(smiles)
@@ -131,15 +204,58 @@ class Pricer:
                 return 0.
             smiles = Chem.MolToSmiles(mol, isomericSmiles=isomericSmiles)
 
-            ppg = self.prices_flat[smiles]
-            if ppg:
-                return ppg
+            if self.might_be_buyable(smiles):
+                ppg = self.prices_flat.get(smiles, 0.)
+                if ppg:
+                    return ppg
+
+                ppg = self.prices.get(smiles, 0.)
+                if ppg:
+                    return ppg
+
+        return 0.
+
+    def lookup_many(self, smiles_list, alreadyCanonical=False, isomericSmiles=True):
+        '''
+        Looks up prices for a list of SMILES, with the same semantics as
+        calling lookup_smiles on each of them. The whole batch is resolved
+        against the store at once and only misses are re-canonicalized
+        (through the shared featurizer cache).
+        '''
+        smiles_list = list(smiles_list)
+        ppgs = self._lookup_exact(smiles_list)
+        if alreadyCanonical:
+            return ppgs
+
+        missing = [i for (i, ppg) in enumerate(ppgs) if not ppg]
+        canonical = [(i, canonical_smiles(smiles_list[i], isomericSmiles=isomericSmiles)) for i in missing]
+        canonical = [(i, smiles) for (i, smiles) in canonical if smiles is not None]
+        for ((i, _), ppg) in zip(canonical, self._lookup_exact([smiles for (_, smiles) in canonical])):
+            ppgs[i] = ppg
+        return ppgs
+
+    def _lookup_exact(self, smiles_list):
+        '''Flat price, falling back to the chiral price, for each SMILES as entered'''
+        ppgs = [0.] * len(smiles_list)
+        if self.bloom is not None and smiles_list:
+            candidates = np.flatnonzero(self.bloom.might_contain_many(smiles_list)).tolist()
+        else:
+            candidates = list(range(len(smiles_list)))
+        if not candidates:
+            return ppgs
+        self.load_deferred()
+        for (i, ppg) in zip(candidates, _get_prices(self.prices_flat, [smiles_list[i] for i in candidates])):
+            ppgs[i] = ppg
+        missing = [i for i in candidates if not ppgs[i]]
+        for (i, ppg) in zip(missing, _get_prices(self.prices, [smiles_list[i] for i in missing])):
+            ppgs[i] = ppg
+        return ppgs
 
-            ppg = self.prices[smiles]
-            if ppg:
-                return ppg
 
-        return ppg
+def _get_prices(prices, smiles_list):
+    if isinstance(prices, HashedPriceTable):
+        return [float(ppg) for ppg in prices.get_many(smiles_list)]
+    return [prices.get(smiles, 0.) for smiles in smiles_list]
 
 
 if __name__ == '__main__':
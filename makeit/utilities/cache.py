@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Bounded, thread-safe least-recently-used cache
+
+    Used to memoize expensive per-molecule work (parsing, fingerprinting,
+    scoring) within a single process. Keys must be hashable; values are
+    stored as-is, so callers should not mutate what they get back.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value # move to most-recently-used position
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._data.pop(key)
+            elif self.max_size and len(self._data) >= self.max_size:
+                self._data.popitem(last=False)
+            self._data[key] = value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            (size, hits, misses) = (len(self._data), self.hits, self.misses)
+        total = hits + misses
+        return {
+            'size': size,
+            'max_size': self.max_size,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': float(hits) / total if total else 0.,
+        }
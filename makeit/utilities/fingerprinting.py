@@ -4,7 +4,108 @@ from rdkit.Chem import AllChem, DataStructs
 import numpy as np
 from makeit.utilities.io.logger import MyLogger
 from makeit.utilities.parsing import check_smiles
+from makeit.utilities.cache import LRUCache
 fingerprinting_loc = 'fingerprinting'
+_missing = object()
+
+
+class MolFeaturizer(object):
+    """Process-wide cache of parsed molecules and Morgan fingerprints
+
+    The same molecule is typically fingerprinted several times per expansion
+    (template relevance, SCScore, fast filter), so parsed mols are cached per
+    SMILES and fingerprints per (SMILES, radius, nBits, chirality, features,
+    count/bit). Both caches are bounded LRUs. Returned fingerprints are
+    read-only numpy arrays - copy them before modifying in place.
+    """
+
+    def __init__(self, max_size=gc.featurization_cache_size):
+        self.mols = LRUCache(max_size)
+        self.fps = LRUCache(max_size)
+        self.canonical = LRUCache(max_size)
+
+    def smiles_to_mol(self, smiles):
+        '''Returns the (cached) RDKit mol for a SMILES string, or None if
+        it cannot be parsed. The mol is shared and must not be modified.'''
+        if isinstance(smiles, bytes):
+            smiles = smiles.decode('utf-8')
+        mol = self.mols.get(smiles, _missing)
+        if mol is _missing:
+            mol = Chem.MolFromSmiles(smiles)
+            self.mols.put(smiles, mol)
+        return mol
+
+    def canonical_smiles(self, smiles, isomericSmiles=True):
+        '''Returns the canonical (by default isomeric) SMILES, or None if
+        the SMILES cannot be parsed'''
+        if isinstance(smiles, bytes):
+            smiles = smiles.decode('utf-8')
+        key = (smiles, isomericSmiles)
+        canonical = self.canonical.get(key, _missing)
+        if canonical is _missing:
+            mol = self.smiles_to_mol(smiles)
+            canonical = Chem.MolToSmiles(mol, isomericSmiles=isomericSmiles) if mol is not None else None
+            self.canonical.put(key, canonical)
+        return canonical
+
+    def morgan_fp(self, smiles, radius=2, nBits=2048, useChirality=False, useFeatures=False, counts=False):
+        '''Returns the Morgan fingerprint of a SMILES string as a read-only
+        numpy array, or None if the SMILES cannot be parsed.
+
+        Bit fingerprints are float32 0/1 vectors. Count fingerprints
+        (counts=True) are folded into nBits as uint8, matching the
+        SCScore 1024uint8 featurization.'''
+        if isinstance(smiles, bytes):
+            smiles = smiles.decode('utf-8')
+        key = (smiles, radius, nBits, useChirality, useFeatures, counts)
+        fp = self.fps.get(key, _missing)
+        if fp is not _missing:
+            return fp
+
+        mol = self.smiles_to_mol(smiles)
+        if mol is None:
+            fp = None
+        elif counts:
+            nonzero = AllChem.GetMorganFingerprint(mol, radius, useChirality=useChirality,
+                useFeatures=useFeatures).GetNonzeroElements()
+            folded = np.zeros((nBits,), dtype=np.int64)
+            np.add.at(folded, np.array(list(nonzero.keys()), dtype=np.int64) % nBits,
+                np.array(list(nonzero.values()), dtype=np.int64))
+            fp = folded.astype(np.uint8)
+        else:
+            fp_bit = AllChem.GetMorganFingerprintAsBitVect(mol=mol, radius=radius, nBits=nBits,
+                useFeatures=useFeatures, useChirality=useChirality)
+            fp = np.empty(nBits, dtype='float32')
+            DataStructs.ConvertToNumpyArray(fp_bit, fp)
+        if fp is not None:
+            fp.flags.writeable = False
+        self.fps.put(key, fp)
+        return fp
+
+    def clear(self):
+        self.mols.clear()
+        self.fps.clear()
+        self.canonical.clear()
+
+    def stats(self):
+        return {'mols': self.mols.stats(), 'fps': self.fps.stats(), 'canonical': self.canonical.stats()}
+
+
+# Shared by all prioritizers and scorers in this process
+featurizer = MolFeaturizer()
+
+
+def smiles_to_mol(smiles):
+    return featurizer.smiles_to_mol(smiles)
+
+
+def canonical_smiles(smiles, isomericSmiles=True):
+    return featurizer.canonical_smiles(smiles, isomericSmiles=isomericSmiles)
+
+
+def smiles_to_morgan_fp(smiles, radius=2, nBits=2048, useChirality=False, useFeatures=False, counts=False):
+    return featurizer.morgan_fp(smiles, radius=radius, nBits=nBits, useChirality=useChirality,
+        useFeatures=useFeatures, counts=counts)
 
 
 def create_rxn_Morgan2FP(rxn_smiles, fpsize=gc.fingerprint_bits, useFeatures=True, useChirality=False):
@@ -18,17 +119,15 @@ def create_rxn_Morgan2FP(rxn_smiles, fpsize=gc.fingerprint_bits, useFeatures=Tru
     rfp = None
     pfp = None
     for react in rsmi:
-        mol = Chem.MolFromSmiles(react)
-        fp = np.array(
-            AllChem.GetMorganFingerprintAsBitVect(mol=mol, radius=2, nBits=fpsize, useFeatures=useFeatures, useChirality=useChirality))
+        fp = smiles_to_morgan_fp(react, radius=2, nBits=fpsize, useFeatures=useFeatures,
+            useChirality=useChirality).astype(int)
         if rfp is None:
             rfp = fp
         else:
             rfp += fp
     for product in psmi:
-        mol = Chem.MolFromSmiles(product)
-        fp = np.array(
-            AllChem.GetMorganFingerprintAsBitVect(mol=mol, radius=2, nBits=fpsize, useFeatures=useFeatures, useChirality=useChirality))
+        fp = smiles_to_morgan_fp(product, radius=2, nBits=fpsize, useFeatures=useFeatures,
+            useChirality=useChirality).astype(int)
         if pfp is None:
             pfp = fp
         else:
@@ -41,37 +140,24 @@ def create_rxn_Morgan2FP(rxn_smiles, fpsize=gc.fingerprint_bits, useFeatures=Tru
 
 def create_rxn_Morgan2FP_separately(rsmi, psmi, rxnfpsize=gc.fingerprint_bits, pfpsize=gc.fingerprint_bits, useFeatures=False, calculate_rfp=True, useChirality=False):
     # Similar as the above function but takes smiles separately and returns pfp and rfp separately
-
-    rsmi = rsmi.encode('utf-8')
-    psmi = psmi.encode('utf-8')
+    # Both come from the shared featurizer cache, so they are read-only arrays
     try:
-        mol = Chem.MolFromSmiles(rsmi)
-    except Exception as e:
-        print(e)
-        return
-    try:
-        fp_bit = AllChem.GetMorganFingerprintAsBitVect(
-            mol=mol, radius=2, nBits=rxnfpsize, useFeatures=useFeatures, useChirality=useChirality)
-        fp = np.empty(rxnfpsize, dtype='float32')
-        DataStructs.ConvertToNumpyArray(fp_bit, fp)
+        rfp = smiles_to_morgan_fp(rsmi, radius=2, nBits=rxnfpsize,
+            useFeatures=useFeatures, useChirality=useChirality)
     except Exception as e:
         print(("Cannot build reactant fp due to {}".format(e)))
         return
-    rfp = fp
-
-    try:
-        mol = Chem.MolFromSmiles(psmi)
-    except Exception as e:
+    if rfp is None:
         return
+
     try:
-        fp_bit = AllChem.GetMorganFingerprintAsBitVect(
-            mol=mol, radius=2, nBits=pfpsize, useFeatures=useFeatures, useChirality=useChirality)
-        fp = np.empty(pfpsize, dtype='float32')
-        DataStructs.ConvertToNumpyArray(fp_bit, fp)
+        pfp = smiles_to_morgan_fp(psmi, radius=2, nBits=pfpsize,
+            useFeatures=useFeatures, useChirality=useChirality)
     except Exception as e:
         print(("Cannot build product fp due to {}".format(e)))
         return
-    pfp = fp
+    if pfp is None:
+        return
     return [pfp, rfp]
 
 
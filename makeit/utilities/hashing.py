@@ -0,0 +1,30 @@
+'''
+64-bit SMILES hashes used by the memory-mapped lookup tables (buyables,
+chemical history). The hash is the low 64 bits of the md5 digest, i.e.
+int(md5, 16) & 0xFFFFFFFFFFFFFFFF, so keys of the existing compressed
+ChemHistorian pickles (int(md5, 16)) can be converted without re-hashing
+the original strings.
+'''
+
+import hashlib
+import numpy as np
+
+MASK_64 = (1 << 64) - 1
+
+
+def smiles_hash(smiles):
+    '''Returns the 64-bit hash of a SMILES string as a Python int'''
+    if not isinstance(smiles, bytes):
+        smiles = smiles.encode('utf-8')
+    return int(hashlib.md5(smiles).hexdigest()[16:], 16)
+
+
+def smiles_hashes(smiles_list):
+    '''Returns a uint64 array with the hash of every SMILES string'''
+    return np.fromiter((smiles_hash(smiles) for smiles in smiles_list),
+                       dtype=np.uint64, count=len(smiles_list))
+
+
+def truncate_hash(key):
+    '''Converts a full int(md5, 16) key to its 64-bit hash'''
+    return key & MASK_64
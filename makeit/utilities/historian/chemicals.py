@@ -6,6 +6,9 @@ import rdkit.Chem as Chem
 from collections import defaultdict
 from tqdm import tqdm
 from makeit.utilities.io.logger import MyLogger
+from makeit.utilities.historian.hashed_chemicals import HashedChemicalTable, hashed_store_mtime, bloom_path, build_bloom
+from makeit.utilities.bloom import BloomFilter
+from makeit.utilities.fingerprinting import canonical_smiles
 import makeit.utilities.io.pickle as pickle
 from pymongo import MongoClient
 from multiprocessing import Manager
@@ -39,6 +42,9 @@ class ChemHistorian:
         self.occurrences = defaultdict(lambda: [0, 0, [], []])
         self._loaded = False
         self._compressed = False
+        self._hashed = False
+        # optional prescreen; a negative answer means "never seen"
+        self.bloom = None
 
     def load_databases(self):
         '''
@@ -81,7 +87,11 @@ class ChemHistorian:
         if compressed:
             file_path += '_compressed'
 
-        if os.path.isfile(file_path):
+        # Prefer the memory-mapped copy of the same file when it is up to date
+        hashed_mtime = hashed_store_mtime(file_path + '_hashed')
+        if hashed_mtime is not None and (not os.path.isfile(file_path) or hashed_mtime >= os.path.getmtime(file_path)):
+            self.load_hashed(file_path + '_hashed')
+        elif os.path.isfile(file_path):
             with open(file_path, 'rb') as file:
                 self.occurrences = pickle.load(file)
                 self._loaded = True
@@ -90,6 +100,27 @@ class ChemHistorian:
         else:
             raise ValueError('File does not exist!')
 
+    def load_hashed(self, directory, mmap_mode='r'):
+        '''
+        Load chemical history from a hashed store (see hashed_chemicals),
+        memory-mapped by default so it is shared between processes. The
+        store's Bloom filter, if present, is used to skip negative lookups.
+        '''
+        MyLogger.print_and_log('Loading hashed chemhistorian from {}'.format(directory), historian_loc)
+        self.occurrences = HashedChemicalTable.load(directory, mmap_mode=mmap_mode)
+        if os.path.isfile(bloom_path(directory)):
+            self.bloom = BloomFilter.load(bloom_path(directory))
+        self._loaded = True
+        self._hashed = True
+
+    def dump_to_hashed(self, directory):
+        '''
+        Write the loaded occurrences to a hashed store readable by load_hashed
+        '''
+        table = HashedChemicalTable.from_dict(self.occurrences)
+        table.save(directory)
+        build_bloom(table).save(bloom_path(directory))
+
     def upload_to_db(self):
         db_client = MongoClient(gc.MONGO['path'], gc.MONGO[
                                 'id'], connect=gc.MONGO['connect'])
@@ -209,16 +240,58 @@ class ChemHistorian:
                 return 0.
             smiles = Chem.MolToSmiles(mol, isomericSmiles=isomericSmiles)
 
-        try:
-            if self._compressed:
-                info = self.occurrences[int(hashlib.md5(smiles.encode('utf-8')).hexdigest(), 16)]
-            else:
-                info = self.occurrences[smiles]
-        except KeyError:
-            info = [0, 0, [], []]
+        if self.bloom is not None and not self.bloom.might_contain(smiles):
+            return tup_to_dict([0, 0, [], []], refs=refs)
+
+        if self._hashed:
+            i = self.occurrences.index(smiles)
+            info = self.occurrences.info(i, refs=refs) if i >= 0 else [0, 0, [], []]
+            return tup_to_dict(info, refs=refs)
+
+        if self._compressed:
+            info = self.occurrences.get(int(hashlib.md5(smiles.encode('utf-8')).hexdigest(), 16), [0, 0, [], []])
+        else:
+            info = self.occurrences.get(smiles, [0, 0, [], []])
 
         return tup_to_dict(info, refs=refs)
 
+    def lookup_many(self, smiles_list, alreadyCanonical=False, isomericSmiles=True, refs=False):
+        '''
+        Looks up a list of SMILES, returning the same values as calling
+        lookup_smiles on each. Canonicalization goes through the shared
+        featurizer cache and a hashed store is searched in one vectorized pass.
+        '''
+
+        if not isomericSmiles:
+            raise ValueError('Not intended to be used for non-isomeric!')
+
+        smiles_list = list(smiles_list)
+        if not alreadyCanonical:
+            smiles_list = [canonical_smiles(smiles) for smiles in smiles_list]
+        valid = [i for (i, smiles) in enumerate(smiles_list) if smiles is not None]
+        results = [0.] * len(smiles_list)
+
+        if self.bloom is not None and valid:
+            seen = self.bloom.might_contain_many([smiles_list[i] for i in valid])
+            for i in [i for (i, s) in zip(valid, seen) if not s]:
+                results[i] = tup_to_dict([0, 0, [], []], refs=refs)
+            valid = [i for (i, s) in zip(valid, seen) if s]
+
+        if self._hashed:
+            idx = self.occurrences.index_many([smiles_list[i] for i in valid])
+            for (i, j) in zip(valid, idx):
+                info = self.occurrences.info(j, refs=refs) if j >= 0 else [0, 0, [], []]
+                results[i] = tup_to_dict(info, refs=refs)
+            return results
+
+        for i in valid:
+            if self._compressed:
+                key = int(hashlib.md5(smiles_list[i].encode('utf-8')).hexdigest(), 16)
+            else:
+                key = smiles_list[i]
+            results[i] = tup_to_dict(self.occurrences.get(key, [0, 0, [], []]), refs=refs)
+        return results
+
     def compress_keys(self):
         '''Convert keys to hashed values to save space'''
         new_occurrences = {}
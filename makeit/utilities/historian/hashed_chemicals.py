@@ -0,0 +1,145 @@
+import os
+import numpy as np
+import makeit.utilities.io.pickle as pickle
+from makeit.utilities.hashing import smiles_hash, smiles_hashes, truncate_hash
+from makeit.utilities.io.logger import MyLogger
+from makeit.utilities.bloom import BloomFilter
+hashed_chemicals_loc = 'hashed_chemicals'
+
+RECORD_DTYPE = np.dtype([('hash', '<u8'), ('as_reactant', '<i4'), ('as_product', '<i4')])
+
+
+class HashedChemicalTable(object):
+    '''
+    Read-only chemical history stored as numpy arrays that can be
+    memory-mapped, replacing the dict of per-chemical lists/tuples.
+
+    records is a structured array sorted by 64-bit SMILES hash with int32
+    as_reactant / as_product counts. Template references are kept in one
+    int64 blob: the reactant refs of record i are
+    refs[ref_offsets[2i]:ref_offsets[2i+1]] and its product refs
+    refs[ref_offsets[2i+1]:ref_offsets[2i+2]].
+
+    Only hashes of the SMILES are known (the compressed pickles do not keep
+    the strings), so lookups are exact up to 64-bit hash collisions.
+    '''
+
+    FIELDS = ('records', 'ref_offsets', 'refs')
+
+    def __init__(self, records, ref_offsets, refs):
+        self.records = records
+        self.hashes = records['hash']
+        self.ref_offsets = ref_offsets
+        self.refs = refs
+
+    @classmethod
+    def from_dict(cls, occurrences):
+        '''Builds a table from ChemHistorian.occurrences, keyed by SMILES or
+        by compressed int(md5, 16) keys'''
+        records = np.zeros((len(occurrences),), dtype=RECORD_DTYPE)
+        ref_lists = []
+        for (i, (key, info)) in enumerate(occurrences.items()):
+            if isinstance(key, str):
+                records[i]['hash'] = smiles_hash(key)
+            else:
+                records[i]['hash'] = truncate_hash(key)
+            records[i]['as_reactant'] = info[0]
+            records[i]['as_product'] = info[1]
+            ref_lists.append((info[2] if len(info) > 2 else [], info[3] if len(info) > 3 else []))
+
+        order = np.argsort(records['hash'], kind='mergesort')
+        records = records[order]
+        lengths = []
+        for i in order:
+            lengths.append(len(ref_lists[i][0]))
+            lengths.append(len(ref_lists[i][1]))
+        ref_offsets = np.zeros((2 * len(order) + 1,), dtype=np.int64)
+        np.cumsum(lengths, out=ref_offsets[1:])
+        refs = np.fromiter((ref for i in order for refs_i in ref_lists[i] for ref in refs_i),
+                           dtype=np.int64, count=int(ref_offsets[-1]))
+        return cls(records, ref_offsets, refs)
+
+    @staticmethod
+    def paths(directory):
+        return [os.path.join(directory, '{}.npy'.format(field)) for field in HashedChemicalTable.FIELDS]
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for (field, path) in zip(self.FIELDS, self.paths(directory)):
+            np.save(path, getattr(self, field))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        return cls(*[np.load(path, mmap_mode=mmap_mode) for path in cls.paths(directory)])
+
+    def index(self, smiles):
+        '''Position of smiles in the table, or -1 if it is not present'''
+        h = np.uint64(smiles_hash(smiles))
+        i = int(np.searchsorted(self.hashes, h))
+        if i < len(self.hashes) and self.hashes[i] == h:
+            return i
+        return -1
+
+    def index_many(self, smiles_list):
+        '''Positions of a list of SMILES as an int64 array (-1 if not
+        present), resolved with one vectorized search over the hash array'''
+        if not len(smiles_list) or not len(self.hashes):
+            return -np.ones((len(smiles_list),), dtype=np.int64)
+        hashes = smiles_hashes(smiles_list)
+        idx = np.searchsorted(self.hashes, hashes).astype(np.int64)
+        found = self.hashes[np.minimum(idx, len(self.hashes) - 1)] == hashes
+        idx[~found] = -1
+        return idx
+
+    def info(self, i, refs=False):
+        '''Returns record i in the [as_reactant, as_product, as_reactant_refs,
+        as_product_refs] layout used by ChemHistorian.occurrences'''
+        record = self.records[i]
+        if not refs:
+            return [int(record['as_reactant']), int(record['as_product']), [], []]
+        start, mid, end = self.ref_offsets[2 * i:2 * i + 3]
+        return [int(record['as_reactant']), int(record['as_product']),
+                self.refs[start:mid].tolist(), self.refs[mid:end].tolist()]
+
+    def __contains__(self, smiles):
+        return self.index(smiles) >= 0
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+def bloom_path(directory):
+    return os.path.join(directory, 'bloom.npz')
+
+
+def build_bloom(table):
+    '''Bloom filter over the hashes of every chemical in the table'''
+    return BloomFilter.from_hashes(table.hashes)
+
+
+def hashed_store_mtime(directory):
+    '''Time the hashed store in directory was written, or None if it is
+    missing or incomplete'''
+    paths = HashedChemicalTable.paths(directory)
+    if not all(os.path.isfile(path) for path in paths):
+        return None
+    return min(os.path.getmtime(path) for path in paths)
+
+
+def build_hashed_store(file_path, directory):
+    '''Converts a pickled ChemHistorian (compressed or not, with or without
+    refs) into the memory-mappable format read by ChemHistorian.load_hashed'''
+    MyLogger.print_and_log('Building hashed chemical history from {}'.format(file_path), hashed_chemicals_loc)
+    with open(file_path, 'rb') as file:
+        occurrences = pickle.load(file)
+    table = HashedChemicalTable.from_dict(occurrences)
+    table.save(directory)
+    build_bloom(table).save(bloom_path(directory))
+    MyLogger.print_and_log('Saved hashed chemical history to {}'.format(directory), hashed_chemicals_loc)
+
+
+if __name__ == '__main__':
+    import makeit.global_config as gc
+    file_path = gc.historian_data + '_no_refs_compressed'
+    build_hashed_store(file_path, file_path + '_hashed')
@@ -0,0 +1,120 @@
+import os
+import numpy as np
+import makeit.utilities.io.pickle as pickle
+from makeit.utilities.hashing import smiles_hash
+from makeit.utilities.io.logger import MyLogger
+reaction_refs_loc = 'reaction_refs'
+
+
+class SplitReactionTable(object):
+    '''
+    Read-only reaction history stored as numpy arrays that are
+    memory-mapped, so neither the reaction SMILES nor the reference lists
+    are unpickled into a dict in every process.
+
+    hashes are the sorted 64-bit hashes of the reaction SMILES and counts
+    the matching int32 occurrence counts. Hash hits are verified against
+    the original strings (a utf-8 blob indexed by offsets), so lookups are
+    exact even if two SMILES collide. The references of row i are the
+    newline-separated utf-8 strings in refs[ref_offsets[i]:ref_offsets[i+1]],
+    only paged in when they are looked up.
+    '''
+
+    FIELDS = ('hashes', 'counts', 'offsets', 'strings', 'ref_offsets', 'refs')
+
+    def __init__(self, hashes, counts, offsets, strings, ref_offsets, refs):
+        self.hashes = hashes
+        self.counts = counts
+        self.offsets = offsets
+        self.strings = strings
+        self.ref_offsets = ref_offsets
+        self.refs = refs
+
+    @classmethod
+    def from_dict(cls, occurrences):
+        '''Builds a table from a ReactionHistorian occurrences dict of
+        [count, refs] entries'''
+        smiles_list = list(occurrences.keys())
+        encoded = [smiles.encode('utf-8') for smiles in smiles_list]
+        hashes = np.fromiter((smiles_hash(smiles) for smiles in encoded), dtype=np.uint64, count=len(encoded))
+        order = np.argsort(hashes, kind='mergesort')
+
+        offsets = np.zeros((len(encoded) + 1,), dtype=np.int64)
+        np.cumsum([len(encoded[i]) for i in order], out=offsets[1:])
+        strings = np.frombuffer(b''.join(encoded[i] for i in order), dtype=np.uint8)
+        counts = np.array([occurrences[smiles_list[i]][0] for i in order], dtype=np.int32)
+        encoded_refs = ['\n'.join(occurrences[smiles_list[i]][1]).encode('utf-8') for i in order]
+        ref_offsets = np.zeros((len(encoded_refs) + 1,), dtype=np.int64)
+        np.cumsum([len(refs) for refs in encoded_refs], out=ref_offsets[1:])
+        refs = np.frombuffer(b''.join(encoded_refs), dtype=np.uint8)
+        return cls(hashes[order], counts, offsets, strings, ref_offsets, refs)
+
+    @staticmethod
+    def paths(directory, name):
+        return [os.path.join(directory, '{}_{}.npy'.format(name, field)) for field in SplitReactionTable.FIELDS]
+
+    def save(self, directory, name):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for (field, path) in zip(self.FIELDS, self.paths(directory, name)):
+            np.save(path, getattr(self, field))
+
+    @classmethod
+    def load(cls, directory, name, mmap_mode='r'):
+        return cls(*[np.load(path, mmap_mode=mmap_mode) for path in cls.paths(directory, name)])
+
+    def smiles_at(self, i):
+        return self.strings[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def index(self, smiles):
+        '''Position of smiles in the table, or -1 if it is not present'''
+        h = np.uint64(smiles_hash(smiles))
+        i = int(np.searchsorted(self.hashes, h))
+        while i < len(self.hashes) and self.hashes[i] == h:
+            if self.smiles_at(i) == smiles:
+                return i
+            i += 1
+        return -1
+
+    def info(self, smiles, refs=False):
+        '''Returns [count, refs] for a reaction SMILES (refs only read from
+        disk if requested), or [0, []] if it has not been seen'''
+        i = self.index(smiles)
+        if i < 0:
+            return [0, []]
+        if not refs:
+            return [int(self.counts[i]), []]
+        blob = self.refs[self.ref_offsets[i]:self.ref_offsets[i + 1]].tobytes().decode('utf-8')
+        return [int(self.counts[i]), blob.split('\n') if blob else []]
+
+    def __contains__(self, smiles):
+        return self.index(smiles) >= 0
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+def split_store_mtime(directory):
+    '''Time the split store in directory was written, or None if it is
+    missing or incomplete'''
+    paths = SplitReactionTable.paths(directory, 'chiral') + SplitReactionTable.paths(directory, 'flat')
+    if not all(os.path.isfile(path) for path in paths):
+        return None
+    return min(os.path.getmtime(path) for path in paths)
+
+
+def build_split_store(file_path, directory):
+    '''Converts a pickled ReactionHistorian (occurrences, occurrences_flat)
+    into the memory-mappable format read by ReactionHistorian.load_split'''
+    MyLogger.print_and_log('Building split reaction history from {}'.format(file_path), reaction_refs_loc)
+    with open(file_path, 'rb') as file:
+        occurrences = pickle.load(file)
+        occurrences_flat = pickle.load(file)
+    SplitReactionTable.from_dict(occurrences).save(directory, 'chiral')
+    SplitReactionTable.from_dict(occurrences_flat).save(directory, 'flat')
+    MyLogger.print_and_log('Saved split reaction history to {}'.format(directory), reaction_refs_loc)
+
+
+if __name__ == '__main__':
+    import makeit.global_config as gc
+    build_split_store(gc.reactionhistorian_data, gc.reactionhistorian_data + '_split')
@@ -6,6 +6,7 @@ import rdkit.Chem as Chem
 from collections import defaultdict
 from tqdm import tqdm
 from makeit.utilities.io.logger import MyLogger
+from makeit.utilities.historian.reaction_refs import SplitReactionTable, split_store_mtime
 import makeit.utilities.io.pickle as pickle
 from pymongo import MongoClient
 from multiprocessing import Manager
@@ -76,7 +77,11 @@ class ReactionHistorian:
             return
 
 
-        if os.path.isfile(file_path):
+        # Prefer the split counts / on-disk refs copy when it is up to date
+        split_mtime = split_store_mtime(file_path + '_split')
+        if split_mtime is not None and (not os.path.isfile(file_path) or split_mtime >= os.path.getmtime(file_path)):
+            self.load_split(file_path + '_split')
+        elif os.path.isfile(file_path):
             with open(file_path, 'rb') as file:
                 self.occurrences = defaultdict(lambda: [0, []], pickle.load(file))
                 self.occurrences_flat = defaultdict(lambda: [0, []], pickle.load(file))
@@ -85,6 +90,22 @@ class ReactionHistorian:
             self.load()
             self.dump_to_file()
 
+    def load_split(self, directory):
+        '''
+        Memory-map the reaction history; reference lists are only read
+        from disk when a lookup asks for refs
+        '''
+        MyLogger.print_and_log('Loading split reaction historian from {}'.format(directory), historian_loc)
+        self.occurrences = SplitReactionTable.load(directory, 'chiral')
+        self.occurrences_flat = SplitReactionTable.load(directory, 'flat')
+
+    def dump_split(self, directory):
+        '''
+        Write the loaded occurrences in the format read by load_split
+        '''
+        SplitReactionTable.from_dict(self.occurrences).save(directory, 'chiral')
+        SplitReactionTable.from_dict(self.occurrences_flat).save(directory, 'flat')
+
     def load(self, online=True, REACTION_DB=None):
         '''
         Loads the object from a MongoDB collection
@@ -152,12 +173,12 @@ class ReactionHistorian:
         re-canonicalizes it in RDKit unl ess the user specifies that
         the string is definitely already canonical.
         '''
-        info = self.occurrences_flat[smiles]
-        if info != [0, 0, [], []]:
+        info = _get_info(self.occurrences_flat, smiles, refs)
+        if info[0]:
             return tup_to_dict(info, refs=refs)
 
-        info = self.occurrences[smiles]
-        if info != [0, 0, [], []]:
+        info = _get_info(self.occurrences, smiles, refs)
+        if info[0]:
             return tup_to_dict(info, refs=refs)
 
         if not alreadyCanonical:
@@ -168,17 +189,23 @@ class ReactionHistorian:
                 return 0.
             smiles = Chem.MolToSmiles(mol, isomericSmiles=isomericSmiles)
 
-            info = self.occurrences_flat[smiles]
-            if info != [0, 0, [], []]:
+            info = _get_info(self.occurrences_flat, smiles, refs)
+            if info[0]:
                 return tup_to_dict(info, refs=refs)
 
-            info = self.occurrences[smiles]
-            if info != [0, 0, [], []]:
+            info = _get_info(self.occurrences, smiles, refs)
+            if info[0]:
                 return tup_to_dict(info, refs=refs)
 
         return tup_to_dict(info, refs=refs)
 
 
+def _get_info(occurrences, smiles, refs):
+    '''[count, refs] from either a dict or a SplitReactionTable'''
+    if isinstance(occurrences, SplitReactionTable):
+        return occurrences.info(smiles, refs=refs)
+    return occurrences.get(smiles, [0, []])
+
 if __name__ == '__main__':
     # Load and dump chemhistorian
     reactionhistorian = ReactionHistorian()
@@ -2,7 +2,7 @@ import os
 import makeit.global_config as gc
 from pymongo import MongoClient
 from makeit.utilities.io.logger import MyLogger
-from makeit.utilities.buyable.pricer import Pricer
+from makeit.utilities.registry import get_shared_pricer
 from makeit.synthetic.context.nearestneighbor import NNContextRecommender
 from makeit.synthetic.context.neuralnetwork import NeuralNetContextRecommender
 from makeit.synthetic.enumeration.transformer import ForwardTransformer
@@ -75,8 +75,7 @@ def load_Pricer(chemical_database, buyable_database):
     Load a pricer using the chemicals database and database of buyable chemicals
     '''
     MyLogger.print_and_log('Loading pricing model...', model_loader_loc)
-    pricerModel = Pricer()
-    pricerModel.load(chemical_database, buyable_database)
+    pricerModel = get_shared_pricer()
     MyLogger.print_and_log('Pricer Loaded.', model_loader_loc)
     return pricerModel
 
@@ -97,7 +96,7 @@ def load_Forward_Transformer(mincount=100, worker_no = 0):
 
 def load_fastfilter():
     ff = FastFilterScorer()
-    ff.load(model_path =gc.FAST_FILTER_MODEL['trained_model_path'])
+    ff.load()
     return ff
 
 
@@ -0,0 +1,89 @@
+'''
+Process-wide registry of the large read-only lookup tables.
+
+Prioritizers, tree builders and web workers all need a Pricer (and often a
+ChemHistorian). Constructing and loading one per object means a worker ends
+up with several copies of the same tables, so instead they ask this module
+for the shared instance. Instances are created lazily on first use, one per
+data file, and stay alive until released explicitly. Callers must treat them
+as read-only.
+'''
+
+import threading
+import makeit.global_config as gc
+from makeit.utilities.io.logger import MyLogger
+registry_loc = 'registry'
+
+_lock = threading.RLock()
+_instances = {}
+
+
+def _pricer_key():
+    from makeit.utilities.io.files import get_pricer_path
+    return ('pricer', get_pricer_path(
+        gc.CHEMICALS['database'],
+        gc.CHEMICALS['collection'],
+        gc.BUYABLES['database'],
+        gc.BUYABLES['collection'],
+    ))
+
+
+def _chemhistorian_key(file_path, refs, compressed):
+    return ('chemhistorian', file_path, refs, compressed)
+
+
+def get_shared_pricer(lazy=False):
+    '''Returns the process-wide Pricer, loading it on first use. With
+    lazy=True, a pricer reading a hashed store only loads its Bloom filter
+    until a lookup gets past it (see Pricer.load), which suits processes
+    that price a few chemicals per request. A shared pricer created lazily
+    is loaded in full when it is asked for with lazy=False'''
+    key = _pricer_key()
+    with _lock:
+        if key not in _instances:
+            from makeit.utilities.buyable.pricer import Pricer
+            MyLogger.print_and_log('Loading shared pricer', registry_loc)
+            pricer = Pricer()
+            pricer.load(lazy=lazy)
+            _instances[key] = pricer
+        if not lazy:
+            _instances[key].load_deferred()
+        return _instances[key]
+
+
+def get_shared_chemhistorian(file_path=gc.historian_data, refs=False, compressed=True):
+    '''Returns the process-wide ChemHistorian for a data file, loading it on
+    first use (see ChemHistorian.load_from_file for the arguments)'''
+    key = _chemhistorian_key(file_path, refs, compressed)
+    with _lock:
+        if key not in _instances:
+            from makeit.utilities.historian.chemicals import ChemHistorian
+            MyLogger.print_and_log('Loading shared chemhistorian', registry_loc)
+            chemhistorian = ChemHistorian()
+            chemhistorian.load_from_file(file_path=file_path, refs=refs, compressed=compressed)
+            _instances[key] = chemhistorian
+        return _instances[key]
+
+
+def release_shared_pricer():
+    '''Drops the registry's reference to the shared Pricer; objects that
+    still hold it keep it alive, later calls load a fresh one'''
+    with _lock:
+        _instances.pop(_pricer_key(), None)
+
+
+def release_shared_chemhistorian(file_path=gc.historian_data, refs=False, compressed=True):
+    with _lock:
+        _instances.pop(_chemhistorian_key(file_path, refs, compressed), None)
+
+
+def clear_registry():
+    '''Drops all shared instances'''
+    with _lock:
+        _instances.clear()
+
+
+def loaded_instances():
+    '''Keys of the instances currently held by the registry'''
+    with _lock:
+        return list(_instances.keys())